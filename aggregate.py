@@ -0,0 +1,107 @@
+"""Partial aggregates of the comments of a stream, written by parsetopspam and storechatlog with --partial on any
+node and combined by the merge command of twitch.py into the top spam and viewership a single node would store."""
+import datetime
+import json
+from export import *
+
+PARTIAL_AGGREGATE_FORMAT = "twitch-partial-aggregate"
+PARTIAL_AGGREGATE_VERSION = 1
+
+
+class PartialAggregate:
+    """
+    Counts of some of the comments of a stream: number of messages and set of users of every text, and number of
+    messages and set of users of every second of chat time. Merging the aggregates of disjoint parts of the comments
+    gives exactly the aggregate of all of them, whatever the parts and the order of merging.
+
+    The users are kept as exact sets rather than HyperLogLog sketches, since the user counts of top spam and the
+    viewers of viewership must equal those of a single node run.
+    """
+
+    def __init__(self, channel_id, stream_id):
+        self.channel_id = channel_id
+        self.stream_id = stream_id
+        self.comments = 0
+        # text -> [number of messages, set of users]
+        self.texts = {}
+        # chat time truncated to the second -> [number of messages, set of users]
+        self.seconds = {}
+
+    def add(self, chat_log):
+        """Count chat_log of the stream."""
+        self.comments += 1
+        text = self.texts.setdefault(chat_log.text, [0, set()])
+        text[0] += 1
+        text[1].add(chat_log.user)
+        second = self.seconds.setdefault(parse_chat_time(chat_log.chat_time), [0, set()])
+        second[0] += 1
+        second[1].add(chat_log.user)
+
+    def merge(self, other):
+        """Add the counts of other, an aggregate of other comments of the same stream."""
+        if (str(other.channel_id), str(other.stream_id)) != (str(self.channel_id), str(self.stream_id)):
+            raise ValueError("cannot merge stream {} on channel {} into stream {} on channel {}".format(
+                other.stream_id, other.channel_id, self.stream_id, self.channel_id))
+        self.comments += other.comments
+        for counts, other_counts in ((self.texts, other.texts), (self.seconds, other.seconds)):
+            for key, (messages, users) in other_counts.items():
+                count = counts.setdefault(key, [0, set()])
+                count[0] += messages
+                count[1] |= users
+
+    def comments_count_and_users(self):
+        """Return number of messages and set of users of every text, as taken by sort_and_insert_spam of SpamDao."""
+        return ({text: messages for text, (messages, _) in self.texts.items()},
+                {text: users for text, (_, users) in self.texts.items()})
+
+    def viewership(self):
+        """Return viewership metrics of the stream in the format of get_viewership_metrics of ChatLogDao."""
+        if not self.seconds:
+            return []
+        return per_minute_viewership_of_seconds([(chat_time, messages, users) for chat_time, (messages, users)
+                                                 in sorted(self.seconds.items())], self.channel_id, self.stream_id)
+
+    def to_dict(self):
+        """Return the aggregate as JSON serializable dictionary, with sorted keys and users."""
+        return {"format": PARTIAL_AGGREGATE_FORMAT, "version": PARTIAL_AGGREGATE_VERSION,
+                "channel_id": self.channel_id, "stream_id": self.stream_id, "comments": self.comments,
+                "texts": [[text, messages, sorted(users)] for text, (messages, users) in
+                          sorted(self.texts.items(), key=lambda item: sqlite_sort_key(item[0]))],
+                "seconds": [[str(chat_time), messages, sorted(users)] for chat_time, (messages, users) in
+                            sorted(self.seconds.items())]}
+
+    @classmethod
+    def from_dict(cls, values):
+        """Return aggregate of a dictionary returned by to_dict."""
+        if values.get("format") != PARTIAL_AGGREGATE_FORMAT or values.get("version") != PARTIAL_AGGREGATE_VERSION:
+            raise ValueError("not a partial aggregate of version {}".format(PARTIAL_AGGREGATE_VERSION))
+        aggregate = cls(values["channel_id"], values["stream_id"])
+        aggregate.comments = values["comments"]
+        aggregate.texts = {text: [messages, set(users)] for text, messages, users in values["texts"]}
+        aggregate.seconds = {datetime.datetime.strptime(chat_time, "%Y-%m-%d %H:%M:%S"): [messages, set(users)]
+                             for chat_time, messages, users in values["seconds"]}
+        return aggregate
+
+    def write(self, file_name):
+        """Write the aggregate to file_name as JSON, compressed as the extension of file_name tells."""
+        compression = next((compression for compression, extension in EXPORT_EXTENSIONS.items()
+                            if extension and file_name.endswith(extension)), "none")
+        with EXPORT_OPENERS[compression](file_name) as file:
+            json.dump(self.to_dict(), file, sort_keys=True)
+
+    @classmethod
+    def read(cls, file_name):
+        """Return aggregate written to file_name by write."""
+        with open_export(file_name) as file:
+            return cls.from_dict(json.load(file))
+
+
+def merge_partial_aggregates(aggregates):
+    """Return list of the aggregates of every stream of aggregates, merged, in order of first appearance."""
+    merged = {}
+    for aggregate in aggregates:
+        stream = (str(aggregate.channel_id), str(aggregate.stream_id))
+        if stream not in merged:
+            merged[stream] = PartialAggregate(aggregate.channel_id, aggregate.stream_id)
+        merged[stream].merge(aggregate)
+    return list(merged.values())
@@ -0,0 +1,259 @@
+"""
+Columnar segment files holding the chat log of one archived stream.
+
+A segment starts with SEGMENT_MAGIC, the length of a JSON header and the header, which describes every column by its
+offset, length and encoding. Users and texts are dictionary encoded: the rows store narrow integer ids and the
+dictionaries are zlib compressed JSON lists. Chat times are stored as delta encoded whole seconds plus the fraction
+of the second and its number of digits, offsets as delta encoded integers. Integer columns are stored raw and 8 byte
+aligned, so that a segment opened with mmap reads them as memoryviews without copying.
+"""
+import calendar
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter
+from itertools import accumulate
+from models import *
+
+SEGMENT_MAGIC = b"TWSEG001"
+SEGMENT_HEADER_LENGTH = struct.Struct("<I")
+CHAT_TIME_PATTERN = re.compile(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,9}))?Z\Z")
+
+
+def narrowest_typecode(values, signed):
+    """Return the array typecode of the smallest integers that hold all values."""
+    low, high = min(values, default=0), max(values, default=0)
+    for typecode in ("b", "h", "i", "q") if signed else ("B", "H", "I", "Q"):
+        bits = array(typecode).itemsize * 8
+        if signed and -(1 << (bits - 1)) <= low and high < 1 << (bits - 1):
+            return typecode
+        if not signed and high < 1 << bits:
+            return typecode
+    raise OverflowError("values do not fit into 64 bits")
+
+
+def delta_encode(values):
+    """Return differences of consecutive values, starting with the first value."""
+    return [value - previous for previous, value in zip([0] + values[:-1], values)]
+
+
+def dictionary_encode(values):
+    """Return list of distinct values in order of first appearance and list of ids of values in that list."""
+    ids = {}
+    encoded = [ids.setdefault(value, len(ids)) for value in values]
+    return list(ids), encoded
+
+
+def split_chat_time(chat_time):
+    """Return whole seconds since the epoch, nanoseconds and number of fraction digits of chat_time, or None if
+    chat_time is not an ISO 8601 UTC time."""
+    match = CHAT_TIME_PATTERN.match(chat_time) if isinstance(chat_time, str) else None
+    if match is None:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+    fraction = match.group(2) or ""
+    return seconds, int(fraction.ljust(9, "0")), len(fraction)
+
+
+def join_chat_time(seconds, nanoseconds, digits):
+    """Return chat time string split by split_chat_time."""
+    chat_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+    if digits:
+        chat_time += "." + str(nanoseconds).rjust(9, "0")[:digits]
+    return chat_time + "Z"
+
+
+def write_chat_log_segment(file_name, channel_id, stream_id, chat_logs):
+    """Write chat_logs of one stream to segment file_name. The file is replaced atomically. Return its size."""
+    users, user_ids = dictionary_encode([chat_log.user for chat_log in chat_logs])
+    texts, text_ids = dictionary_encode([chat_log.text for chat_log in chat_logs])
+    columns = [("user_ids", user_ids, False), ("text_ids", text_ids, False)]
+    dictionaries = [("users", users), ("texts", texts)]
+
+    split_times = [split_chat_time(chat_log.chat_time) for chat_log in chat_logs]
+    if None in split_times:
+        dictionaries.append(("chat_times", [chat_log.chat_time for chat_log in chat_logs]))
+    else:
+        columns.append(("chat_time_seconds", delta_encode([split_time[0] for split_time in split_times]), True))
+        columns.append(("chat_time_nanoseconds", [split_time[1] for split_time in split_times], False))
+        columns.append(("chat_time_digits", [split_time[2] for split_time in split_times], False))
+
+    offsets = [chat_log.offset for chat_log in chat_logs]
+    if all(isinstance(offset, int) for offset in offsets):
+        columns.append(("offsets", delta_encode(offsets), True))
+    else:
+        dictionaries.append(("float_offsets", offsets))
+
+    blocks = []
+    for name, values, signed in columns:
+        typecode = narrowest_typecode(values, signed)
+        blocks.append((name, {"typecode": typecode, "delta": name in ("chat_time_seconds", "offsets")},
+                       array(typecode, values).tobytes()))
+    for name, values in dictionaries:
+        blocks.append((name, {"encoding": "zlib-json"}, zlib.compress(json.dumps(values).encode())))
+
+    header = {"channel_id": channel_id, "stream_id": stream_id, "rows": len(chat_logs), "byteorder": sys.byteorder,
+              "columns": {}}
+    # offsets of the columns depend on the length of the header, so lay out until the header stops growing
+    header_bytes = b""
+    while True:
+        position = len(SEGMENT_MAGIC) + SEGMENT_HEADER_LENGTH.size + len(header_bytes)
+        for name, description, data in blocks:
+            position += -position % 8
+            header["columns"][name] = dict(description, offset=position, length=len(data))
+            position += len(data)
+        new_header_bytes = json.dumps(header, sort_keys=True).encode()
+        if len(new_header_bytes) == len(header_bytes):
+            header_bytes = new_header_bytes
+            break
+        header_bytes = new_header_bytes
+
+    temporary_file_name = file_name + ".tmp"
+    with open(temporary_file_name, "wb") as file:
+        file.write(SEGMENT_MAGIC + SEGMENT_HEADER_LENGTH.pack(len(header_bytes)) + header_bytes)
+        for name, description, data in blocks:
+            file.write(b"\0" * (header["columns"][name]["offset"] - file.tell()))
+            file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_file_name, file_name)
+    return os.path.getsize(file_name)
+
+
+class ChatLogSegment:
+    """Read only view of a segment file mapped into memory. Integer columns are memoryviews of the mapping,
+    dictionaries are decompressed on first use."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.views = {}
+        self.dictionaries = {}
+        with open(file_name, "rb") as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mapping)
+        if self.buffer[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError("{} is not a chat log segment".format(file_name))
+        header_start = len(SEGMENT_MAGIC) + SEGMENT_HEADER_LENGTH.size
+        header_length, = SEGMENT_HEADER_LENGTH.unpack_from(self.buffer, len(SEGMENT_MAGIC))
+        self.header = json.loads(bytes(self.buffer[header_start:header_start + header_length]))
+        if self.header["byteorder"] != sys.byteorder:
+            self.close()
+            raise ValueError("{} was written on a {} endian machine".format(file_name, self.header["byteorder"]))
+        self.channel_id = self.header["channel_id"]
+        self.stream_id = self.header["stream_id"]
+        self.row_count = self.header["rows"]
+
+    def has_column(self, name):
+        """Return whether the segment stores column name."""
+        return name in self.header["columns"]
+
+    def column(self, name):
+        """Return integer column name as a memoryview of the mapping. Delta encoded columns hold the differences."""
+        if name not in self.views:
+            description = self.header["columns"][name]
+            data = self.buffer[description["offset"]:description["offset"] + description["length"]]
+            self.views[name] = data.cast(description["typecode"])
+        return self.views[name]
+
+    def dictionary(self, name):
+        """Return decompressed dictionary name."""
+        if name not in self.dictionaries:
+            description = self.header["columns"][name]
+            data = self.buffer[description["offset"]:description["offset"] + description["length"]]
+            try:
+                self.dictionaries[name] = json.loads(zlib.decompress(data))
+            finally:
+                data.release()
+        return self.dictionaries[name]
+
+    def seconds(self):
+        """Return iterator of whole seconds since the epoch of the chat times, or None if the chat times were not
+        ISO 8601 UTC times."""
+        if not self.has_column("chat_time_seconds"):
+            return None
+        return accumulate(self.column("chat_time_seconds"))
+
+    def chat_times(self):
+        """Return list of chat time strings."""
+        if self.has_column("chat_times"):
+            return self.dictionary("chat_times")
+        return [join_chat_time(seconds, nanoseconds, digits) for seconds, nanoseconds, digits in
+                zip(self.seconds(), self.column("chat_time_nanoseconds"), self.column("chat_time_digits"))]
+
+    def last_chat_time(self):
+        """Return latest chat time of the segment, without the fraction of the second, or None if it is empty."""
+        if self.has_column("chat_times"):
+            return max(self.dictionary("chat_times"), default=None)
+        seconds = max(self.seconds(), default=None)
+        return None if seconds is None else join_chat_time(seconds, 0, 0)
+
+    def offsets(self):
+        """Return list of offsets."""
+        if self.has_column("float_offsets"):
+            return [int(offset) if isinstance(offset, float) and offset.is_integer() else offset
+                    for offset in self.dictionary("float_offsets")]
+        return list(accumulate(self.column("offsets")))
+
+    def chat_logs(self):
+        """Return list of all rows as chat logs, in the order they were written."""
+        users, texts = self.dictionary("users"), self.dictionary("texts")
+        return [ChatLog(self.channel_id, self.stream_id, texts[text_id], users[user_id], chat_time, offset)
+                for user_id, text_id, chat_time, offset in zip(self.column("user_ids"), self.column("text_ids"),
+                                                                self.chat_times(), self.offsets())]
+
+    def user_chat_logs(self, is_user):
+        """Return list of the rows sent by the users for which is_user is true, in the order they were written. The
+        user ids are looked up in the dictionary and only the rows with one of them are decoded."""
+        users = self.dictionary("users")
+        user_ids = set(user_id for user_id, user in enumerate(users) if is_user(user))
+        if not user_ids:
+            return []
+        indexes = [index for index, user_id in enumerate(self.column("user_ids")) if user_id in user_ids]
+        if self.has_column("chat_times"):
+            chat_times = self.dictionary("chat_times")
+            chat_times = [chat_times[index] for index in indexes]
+        else:
+            seconds, nanoseconds = list(self.seconds()), self.column("chat_time_nanoseconds")
+            digits = self.column("chat_time_digits")
+            chat_times = [join_chat_time(seconds[index], nanoseconds[index], digits[index]) for index in indexes]
+        texts, text_ids, offsets = self.dictionary("texts"), self.column("text_ids"), self.offsets()
+        user_ids = self.column("user_ids")
+        return [ChatLog(self.channel_id, self.stream_id, texts[text_ids[index]], users[user_ids[index]], chat_time,
+                        offsets[index]) for index, chat_time in zip(indexes, chat_times)]
+
+    def spam_list(self, channel_id, stream_id, threshold):
+        """Return spam of the messages sent more than threshold times, counted on the id columns without decoding
+        the rows, in the order of get_spam_list of ChatLogDao."""
+        text_ids = self.column("text_ids")
+        occurrences = Counter(text_ids)
+        user_counts = Counter(text_id for text_id, _ in set(zip(text_ids, self.column("user_ids"))))
+        texts = self.dictionary("texts")
+        return rank_spam(channel_id, stream_id, {texts[text_id]: count for text_id, count in occurrences.items()},
+                         {texts[text_id]: count for text_id, count in user_counts.items()}, threshold)
+
+    def count_messages_by_user(self):
+        """Return dictionary that maps (text, user) pairs to the number of times the user sent the text."""
+        texts, users = self.dictionary("texts"), self.dictionary("users")
+        return {(texts[text_id], users[user_id]): count for (text_id, user_id), count in
+                Counter(zip(self.column("text_ids"), self.column("user_ids"))).items()}
+
+    def close(self):
+        """Release the columns and unmap the file."""
+        for view in self.views.values():
+            view.release()
+        self.views = {}
+        self.buffer.release()
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
@@ -0,0 +1,314 @@
+"""
+Benchmarks twitch.py commands on synthetic Twitch chat exports and reports the results as JSON.
+"""
+import bisect
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import *
+
+TWITCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "twitch.py")
+BENCHMARK_CHANNEL_ID = 36029255
+FIRST_STREAM_ID = 497295395
+STREAM_START = datetime.datetime(2019, 10, 20, 18, 0, 0)
+EMOTES = [("LUL", "425618"), ("PogChamp", "305954156"), ("Kappa", "25"), ("KEKW", "1902"), ("PepeLaugh", "1903"),
+          ("TwitchUnity", "196892")]
+WORDS = ["NA", "EU", "gg", "lol", "drop", "is", "this", "live", "wp", "rip", "go", "team", "no", "yes", "F", "?"]
+BADGES = [("subscriber", "12"), ("premium", "1"), ("bits", "100")]
+
+# cold start budgets of the cheap commands, in seconds on top of starting a bare interpreter
+STARTUP_BUDGET_SECONDS = {"--help": 0.03, "gettopspam": 0.06, "querychatlog": 0.06}
+
+
+class ZipfSampler:
+    """Draws indexes 0..size-1 where index k has weight 1 / (k + 1) ** exponent."""
+
+    def __init__(self, size, exponent, random_generator):
+        self.random_generator = random_generator
+        self.cumulative_weights = []
+        total = 0.0
+        for k in range(size):
+            total += 1.0 / (k + 1) ** exponent
+            self.cumulative_weights.append(total)
+
+    def sample(self):
+        """Return a random index."""
+        value = self.random_generator.random() * self.cumulative_weights[-1]
+        return min(bisect.bisect_left(self.cumulative_weights, value), len(self.cumulative_weights) - 1)
+
+
+def generate_vocabulary(size, random_generator):
+    """Return size distinct chat messages, a mix of emotes, words and commands."""
+    vocabulary = []
+    seen = set()
+    while len(vocabulary) < size:
+        length = random_generator.randint(1, 4)
+        tokens = []
+        for _ in range(length):
+            if random_generator.random() < 0.4:
+                tokens.append(random_generator.choice(EMOTES)[0])
+            else:
+                tokens.append(random_generator.choice(WORDS))
+        message = " ".join(tokens)
+        if message in seen:
+            message = "{} {}".format(message, len(vocabulary))
+        seen.add(message)
+        vocabulary.append(message)
+    return vocabulary
+
+
+def make_comment(index, channel_id, stream_id, user, body, offset, badges):
+    """Return comment shaped like the comments of a Twitch chat export."""
+    emote_ids = dict(EMOTES)
+    fragments = []
+    for token in body.split(" "):
+        if token in emote_ids:
+            fragments.append({"emoticon": {"emoticon_id": emote_ids[token], "emoticon_set_id": "0"}, "text": token})
+        else:
+            fragments.append({"text": token})
+    created_at = (STREAM_START + datetime.timedelta(seconds=offset)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return {"_id": "bench{}-{}".format(stream_id, index),
+            "channel_id": str(channel_id),
+            "commenter": {"_id": str(1000000 + user), "display_name": "user{}".format(user),
+                          "name": "user{}".format(user), "type": "user"},
+            "content_id": str(stream_id),
+            "content_offset_seconds": offset,
+            "content_type": "video",
+            "created_at": created_at,
+            "message": {"body": body, "fragments": fragments, "is_action": False,
+                        "user_badges": [{"_id": badge_id, "version": version} for badge_id, version in badges]},
+            "source": "comment",
+            "state": "published"}
+
+
+def generate_chat_export(file_name, comment_count, user_count, zipf_exponent, stream_id, seed,
+                         channel_id=BENCHMARK_CHANNEL_ID, vocabulary_size=5000, duration_seconds=4 * 3600):
+    """Write a Twitch chat export with comment_count comments of user_count distinct users to file_name. Messages
+    are drawn from a vocabulary with Zipf distributed popularity, so the same seed always gives the same file."""
+    random_generator = random.Random(seed)
+    vocabulary = generate_vocabulary(vocabulary_size, random_generator)
+    message_sampler = ZipfSampler(len(vocabulary), zipf_exponent, random_generator)
+    user_badges = [[badge for badge in BADGES if random_generator.random() < 0.2] for _ in range(user_count)]
+
+    offsets = sorted(round(random_generator.random() * duration_seconds, 3) for _ in range(comment_count))
+    with open(file_name, "w") as file:
+        file.write('{"comments": [')
+        for index, offset in enumerate(offsets):
+            user = random_generator.randrange(user_count)
+            comment = make_comment(index, channel_id, stream_id, user, vocabulary[message_sampler.sample()], offset,
+                                   user_badges[user])
+            if index > 0:
+                file.write(",")
+            file.write(json.dumps(comment))
+        file.write("]}")
+
+
+def percentile(values, fraction):
+    """Return nearest-rank percentile of values, fraction between 0 and 1."""
+    ordered = sorted(values)
+    rank = max(1, int(round(fraction * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_twitch_command(arguments, working_directory, script=TWITCH_SCRIPT):
+    """Run twitch.py with arguments in working_directory and return seconds it took and its peak RSS in KB. With
+    script set to None, arguments are passed to the interpreter itself."""
+    command = [sys.executable] + ([script] if script else []) + arguments
+    with tempfile.TemporaryFile() as error_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=working_directory,
+                                   stdout=subprocess.DEVNULL, stderr=error_file)
+        _, status, resource_usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        if os.waitstatus_to_exitcode(status) != 0:
+            error_file.seek(0)
+            raise RuntimeError("twitch.py {} failed: {}".format(" ".join(arguments), error_file.read().decode()))
+    return seconds, resource_usage.ru_maxrss
+
+
+def summarize(command, comment_count, stream_count, runs):
+    """Return benchmark result of command from list of (seconds, peak RSS) runs."""
+    seconds = [run[0] for run in runs]
+    return {"command": command,
+            "comments": comment_count,
+            "streams": stream_count,
+            "runs": len(runs),
+            "seconds": {"min": min(seconds), "p50": percentile(seconds, 0.5), "p90": percentile(seconds, 0.9),
+                        "p99": percentile(seconds, 0.99), "max": max(seconds)},
+            "comments_per_second": comment_count / stream_count / percentile(seconds, 0.5),
+            "peak_rss_kb": max(run[1] for run in runs)}
+
+
+def benchmark_size(comment_count, options, working_directory):
+    """Generate exports with comment_count comments in total and benchmark every command on them."""
+    file_names = []
+    stream_ids = []
+    for stream_index in range(options.streams):
+        stream_id = FIRST_STREAM_ID + stream_index
+        file_name = os.path.join(working_directory, "stream_{}.json".format(stream_id))
+        generate_chat_export(file_name, comment_count // options.streams, options.users, options.zipf, stream_id,
+                             options.seed + stream_index)
+        file_names.append(file_name)
+        stream_ids.append(stream_id)
+
+    def run(arguments_list):
+        runs = []
+        for _ in range(options.repeat):
+            for arguments in arguments_list:
+                runs.append(run_twitch_command(arguments, working_directory))
+        return runs
+
+    per_stream = [[str(BENCHMARK_CHANNEL_ID), str(stream_id)] for stream_id in stream_ids]
+    commands = [("storechatlog", [["storechatlog", file_name] for file_name in file_names]),
+                ("parsetopspam", [["parsetopspam", file_name] for file_name in file_names]),
+                ("gettopspam", [["gettopspam"] + ids for ids in per_stream]),
+                ("gettopspam2", [["gettopspam2"] + ids for ids in per_stream]),
+                ("querychatlog", [["querychatlog", "stream_id eq {}".format(stream_id), "user eq user0"]
+                                  for stream_id in stream_ids]),
+                ("viewership", [["viewership"] + ids for ids in per_stream])]
+
+    results = []
+    for command, arguments_list in commands:
+        if command in options.commands:
+            results.append(summarize(command, comment_count, options.streams, run(arguments_list)))
+    if "parseandreport" in options.commands:
+        results += benchmark_parse_and_report(comment_count, options, working_directory, file_names, per_stream)
+    if "jsondecoders" in options.commands:
+        results += benchmark_json_decoders(comment_count, options, working_directory, file_names)
+    return results
+
+
+def benchmark_json_decoders(comment_count, options, working_directory, file_names):
+    """Run storechatlog with each of options.json_decoders that is installed and report its speedup over the json
+    module of the standard library."""
+    results = []
+    for json_decoder in options.json_decoders:
+        if json_decoder != "json" and importlib.util.find_spec(json_decoder) is None:
+            continue
+        runs = [run_twitch_command(["--json-decoder", json_decoder, "storechatlog", file_name], working_directory)
+                for _ in range(options.repeat) for file_name in file_names]
+        result = summarize("storechatlog", comment_count, options.streams, runs)
+        result["json_decoder"] = json_decoder
+        results.append(result)
+    baseline = [result["seconds"]["p50"] for result in results if result["json_decoder"] == "json"]
+    for result in results:
+        result["speedup"] = baseline[0] / result["seconds"]["p50"] if baseline else None
+    return results
+
+
+def benchmark_parse_and_report(comment_count, options, working_directory, file_names, per_stream):
+    """Store and report every export in one batch process with each of options.backends. The memory backend gives
+    the baseline without storage costs."""
+    script_name = os.path.join(working_directory, "parse_and_report.ndjson")
+    with open(script_name, "w") as script:
+        for file_name, ids in zip(file_names, per_stream):
+            for arguments in (["storechatlog", file_name], ["parsetopspam", file_name], ["gettopspam"] + ids,
+                              ["gettopspam2"] + ids, ["viewership"] + ids,
+                              ["querychatlog", "stream_id eq {}".format(ids[1]), "user eq user0"]):
+                script.write(json.dumps(arguments) + "\n")
+
+    results = []
+    for backend in options.backends:
+        runs = [run_twitch_command(["--backend", backend, "batch", script_name], working_directory)
+                for _ in range(options.repeat)]
+        result = summarize("parseandreport", comment_count, options.streams, runs)
+        result["backend"] = backend
+        results.append(result)
+    return results
+
+
+def benchmark_startup(options, working_directory):
+    """Measure cold start of --help and of the cheap read commands against STARTUP_BUDGET_SECONDS."""
+    file_name = os.path.join(working_directory, "startup.json")
+    generate_chat_export(file_name, 1000, 100, options.zipf, FIRST_STREAM_ID, options.seed)
+    run_twitch_command(["storechatlog", file_name], working_directory)
+    run_twitch_command(["parsetopspam", file_name], working_directory)
+
+    repeat = max(options.repeat, 5)
+    interpreter_runs = [run_twitch_command(["-c", "pass"], working_directory, None) for _ in range(repeat)]
+    interpreter_seconds = percentile([run[0] for run in interpreter_runs], 0.5)
+    commands = [("--help", ["--help"]),
+                ("gettopspam", ["gettopspam", str(BENCHMARK_CHANNEL_ID), str(FIRST_STREAM_ID)]),
+                ("querychatlog", ["querychatlog", "stream_id eq {}".format(FIRST_STREAM_ID), "user eq user0"])]
+
+    results = []
+    for command, arguments in commands:
+        result = summarize(command, 1000, 1, [run_twitch_command(arguments, working_directory)
+                                              for _ in range(repeat)])
+        result["interpreter_seconds"] = interpreter_seconds
+        result["startup_overhead_seconds"] = result["seconds"]["p50"] - interpreter_seconds
+        result["budget_seconds"] = STARTUP_BUDGET_SECONDS[command]
+        result["within_budget"] = result["startup_overhead_seconds"] <= result["budget_seconds"]
+        results.append(result)
+    return results
+
+
+def get_revision():
+    """Return git revision of the benchmarked code, or None outside of a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(TWITCH_SCRIPT), check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup_parser():
+    """Return parser of the benchmark command line arguments."""
+    argument_parser = ArgumentParser(description="Benchmark twitch.py on synthetic chat exports")
+    argument_parser.add_argument("--sizes", default="10000",
+                                 help="comma separated total numbers of comments, e.g. 10000,1000000,10000000")
+    argument_parser.add_argument("--users", type=int, default=5000, help="number of distinct users")
+    argument_parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of message popularity")
+    argument_parser.add_argument("--streams", type=int, default=1, help="number of streams the comments span")
+    argument_parser.add_argument("--repeat", type=int, default=3, help="runs of every command")
+    argument_parser.add_argument("--seed", type=int, default=1)
+    argument_parser.add_argument("--commands", default="storechatlog,parsetopspam,gettopspam,gettopspam2,"
+                                                       "querychatlog,viewership,parseandreport,jsondecoders")
+    argument_parser.add_argument("--backends", default="sqlite,memory",
+                                 help="backends the parseandreport command is run with, e.g. sqlite,memory")
+    argument_parser.add_argument("--json-decoders", default="json,orjson",
+                                 help="decoders the jsondecoders command runs storechatlog with, if installed")
+    argument_parser.add_argument("--startup", action="store_true",
+                                 help="only check cold start of the cheap commands against their budgets")
+    argument_parser.add_argument("--output", help="write results to this file instead of standard output")
+    return argument_parser
+
+
+def main():  # pragma: no cover
+    """
+    starting point of the benchmark
+    """
+    options = setup_parser().parse_args()  # pragma: no cover
+    options.commands = options.commands.split(",")  # pragma: no cover
+    options.backends = options.backends.split(",")  # pragma: no cover
+    options.json_decoders = options.json_decoders.split(",")  # pragma: no cover
+    report = {"python": platform.python_version(), "platform": platform.platform(),  # pragma: no cover
+              "revision": get_revision(),  # pragma: no cover
+              "created_at": datetime.datetime.utcnow().isoformat() + "Z", "results": []}  # pragma: no cover
+    if options.startup:  # pragma: no cover
+        with tempfile.TemporaryDirectory() as working_directory:  # pragma: no cover
+            report["results"] = benchmark_startup(options, working_directory)  # pragma: no cover
+    else:  # pragma: no cover
+        for size in options.sizes.split(","):  # pragma: no cover
+            with tempfile.TemporaryDirectory() as working_directory:  # pragma: no cover
+                report["results"] += benchmark_size(int(size), options, working_directory)  # pragma: no cover
+
+    output = json.dumps(report, indent=2, sort_keys=True)  # pragma: no cover
+    if options.output:  # pragma: no cover
+        with open(options.output, "w") as file:  # pragma: no cover
+            file.write(output + "\n")  # pragma: no cover
+    else:  # pragma: no cover
+        print(output)  # pragma: no cover
+    if not all(result.get("within_budget", True) for result in report["results"]):  # pragma: no cover
+        sys.exit(1)  # pragma: no cover
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()  # pragma: no cover
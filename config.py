@@ -0,0 +1,66 @@
+"""Defaults shared by the command line and the streaming platform. Kept free of imports, so that parsing the
+command line does not load the rest of the application."""
+
+DATABASE_NAME = "twitch.db"
+LOG_FILE_NAME = "twitch.log"
+# segment files of the streams moved out of a database by the archive command are kept in the directory named after
+# the database followed by ARCHIVE_DIRECTORY_SUFFIX, or in ARCHIVE_DIRECTORY inside the directory of the shards
+ARCHIVE_DIRECTORY = "archive"
+ARCHIVE_DIRECTORY_SUFFIX = ".archive"
+
+# number of comments committed to the chat log at once by store_chat_log
+CHAT_LOG_CHUNK_SIZE = 5000
+# number of parsed chunks waiting to be written suggested by the help of storechatlog --queue-depth
+CHAT_LOG_QUEUE_DEPTH = 4
+
+# decoders of chat exports: "auto" picks orjson when it is installed and the json module otherwise
+JSON_DECODERS = ("auto", "json", "orjson")
+
+# number of most recent streams covered by the channel level commands
+CHANNEL_STREAM_COUNT = 50
+
+# fewest occurrences of a message kept in the spam statistics, so that gettopspam --threshold answers every threshold
+# from SPAM_STATS_MIN_OCCURRENCES - 1 on
+SPAM_STATS_MIN_OCCURRENCES = 2
+
+# steps normalizing the text of chat logs into the key their spam is counted under by gettopspam2 --normalized,
+# applied when the chat logs are stored
+SPAM_NORMALIZATION_STEPS = ("nfkc", "casefold", "whitespace", "repeats")
+
+# length in seconds of offset of the windows of the spamtimeline command
+SPAM_TIMELINE_WINDOW_SECONDS = 300
+
+# ways of logging the result of a query: the whole payload, its first TRUNCATED_PAYLOAD_LENGTH characters or only
+# the number of records and bytes
+PAYLOAD_LOGGING_MODES = ("full", "truncated", "summary")
+TRUNCATED_PAYLOAD_LENGTH = 1000
+
+# watch command: files matching WATCH_PATTERN are ingested once their size and modification time stayed the same
+# for WATCH_SETTLE_SECONDS, by WATCH_WORKERS threads
+WATCH_PATTERN = "*.json"
+WATCH_SETTLE_SECONDS = 2.0
+WATCH_POLL_INTERVAL = 1.0
+WATCH_WORKERS = 2
+
+# retention and purge commands: rows deleted per transaction, free pages given back per incremental vacuum step and
+# rows sampled per index by ANALYZE
+RETENTION_BATCH_SIZE = 5000
+RETENTION_VACUUM_PAGES = 1000
+RETENTION_ANALYSIS_LIMIT = 1000
+
+# export command: tables written by default, file formats and compressions, rows per output file (0 for one file per
+# table and stream), rows written at once and streams exported at once
+EXPORT_TABLES = ("chat_log", "top_spam", "viewership_rollup")
+EXPORT_FORMATS = ("csv", "ndjson")
+EXPORT_COMPRESSIONS = ("none", "gzip", "bz2", "xz")
+EXPORT_ROWS_PER_FILE = 1000000
+EXPORT_BATCH_SIZE = 1000
+EXPORT_WORKERS = 4
+EXPORT_DIRECTORY = "export"
+
+# query budgets: SQLite virtual machine instructions between checks of the time budget and of cancellation
+QUERY_PROGRESS_STEPS = 1000
+# batch --jobs: commands answered from indexed lookups, which may use the slots kept from heavy analytics, and number
+# of slots kept for them when --reserved-slots is not given
+CHEAP_COMMANDS = ("createchannel", "gettopspam", "topchatters", "userhistory")
+BATCH_RESERVED_SLOTS = 1
@@ -1,11 +1,463 @@
 """
 Abstract DAO classes and their implementations for twitch.py
 """
+import bisect
+import bz2
+import contextlib
+import gc
+import glob
+import gzip
+import heapq
+import io
+import itertools
 import json
+import lzma
+import os
+import re
 import sqlite3
+import time
+import unicodedata
+from collections import Counter
+from archive import *
+from config import *
+from governor import *
+from instrumentation import *
 from models import *
 import datetime
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class SqliteConnectionFactory:
+    """Opens SQLite connections in WAL mode, so that read only sessions can run while a writer is ingesting."""
+
+    def __init__(self, busy_timeout=30.0, retries=5, retry_delay=0.1):
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def connect(self, database_name, read_only=False):
+        """Return new connection to database_name. Read only connections are opened with mode=ro when the
+        database already exists."""
+        connection_class = InstrumentedConnection if instrumentation.sql_timing_enabled else sqlite3.Connection
+        if read_only and database_name != ":memory:" and os.path.exists(database_name):
+            from urllib.parse import quote
+            connection = sqlite3.connect("file:{}?mode=ro".format(quote(os.path.abspath(database_name))),
+                                         timeout=self.busy_timeout, factory=connection_class, uri=True)
+        else:
+            connection = sqlite3.connect(database_name, timeout=self.busy_timeout, factory=connection_class)
+            if not read_only:
+                self.retry(lambda: connection.execute("pragma journal_mode = wal"))
+                connection.execute("pragma synchronous = normal")
+        connection.execute("pragma busy_timeout = {}".format(int(self.busy_timeout * 1000)))
+        install_query_budget(connection)
+        return connection
+
+    def release(self, connection):
+        """Give back connection obtained from connect."""
+        connection.close()
+
+    def retry(self, function):
+        """Call function, retrying with exponential backoff while the database is locked by another writer."""
+        for attempt in range(self.retries):
+            try:
+                return function()
+            except sqlite3.OperationalError as error:
+                if "locked" not in str(error) and "busy" not in str(error):
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+        return function()
+
+
+class PooledSqliteConnectionFactory(SqliteConnectionFactory):
+    """Keeps one connection per database and mode open between sessions, so that a process running many commands
+    connects only once. Releasing a connection rolls back what was not committed, like closing it would."""
+
+    def __init__(self, busy_timeout=30.0, retries=5, retry_delay=0.1):
+        SqliteConnectionFactory.__init__(self, busy_timeout, retries, retry_delay)
+        self.connections = {}
+
+    def connect(self, database_name, read_only=False):
+        """Overriden from SqliteConnectionFactory."""
+        if (database_name, read_only) not in self.connections:
+            self.connections[(database_name, read_only)] = SqliteConnectionFactory.connect(self, database_name,
+                                                                                           read_only)
+        else:
+            install_query_budget(self.connections[(database_name, read_only)])
+        return self.connections[(database_name, read_only)]
+
+    def release(self, connection):
+        """Overriden from SqliteConnectionFactory."""
+        remove_query_budget(connection)
+        connection.rollback()
+
+    def rollback_all(self):
+        """Roll back what was not committed on every pooled connection, e.g. after a command failed without closing
+        its sessions, so that no write lock outlives the command."""
+        for connection in self.connections.values():
+            remove_query_budget(connection)
+            connection.rollback()
+
+    def close_all(self):
+        """Close every pooled connection, rolling back what was not committed first: a connection still referenced
+        by a traceback would otherwise stay open, and keep its write lock, after close."""
+        self.rollback_all()
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+
+def table_exists(cursor, table_name):
+    """Return True if table_name exists in the database of cursor. The lookup is not counted by the row budget."""
+    return uncounted_cursor(cursor.connection).execute(
+        "select 1 from sqlite_master where type = 'table' and name = ?", (table_name,)).fetchone() is not None
+
+
+default_connection_factory = SqliteConnectionFactory()
+
+NUMERIC_TEXT_PATTERN = re.compile(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*\Z")
+INTEGER_TEXT_PATTERN = re.compile(r"\s*[+-]?\d+\s*\Z")
+
+
+def sqlite_numeric_affinity(value):
+    """Return value as SQLite stores it in a column of numeric or integer affinity: texts that spell a number become
+    that number, and real numbers without a fraction that fit into 64 bits become integers."""
+    if isinstance(value, str):
+        if NUMERIC_TEXT_PATTERN.match(value) is None:
+            return value
+        if INTEGER_TEXT_PATTERN.match(value) is not None and -2 ** 63 <= int(value) < 2 ** 63:
+            return int(value)
+        value = float(value)
+    if isinstance(value, float) and value.is_integer() and -2 ** 63 <= value < 2 ** 63:
+        return int(value)
+    return value
+
+
+def sqlite_sort_key(value):
+    """Return key that orders values like SQLite does: NULL first, then numbers, then texts."""
+    if value is None:
+        return 0, 0
+    if isinstance(value, (int, float)):
+        return 1, value
+    return 2, value
+
+
+def like_pattern(value):
+    """Return regular expression of the pattern of the LIKE operator of SQLite, % and _ being the wildcards. Match it
+    with re.IGNORECASE, as LIKE is case insensitive."""
+    return "".join(".*" if character == "%" else "." if character == "_" else re.escape(character)
+                   for character in value)
+
+
+def full_text_tokens(value):
+    """Return set of the tokens of value as the unicode61 tokenizer of FTS5 splits them: runs of letters and digits,
+    case folded and without diacritics."""
+    text = unicodedata.normalize("NFKD", str(value)).casefold()
+    return set(re.findall(r"[^\W_]+", "".join(character for character in text
+                                                if not unicodedata.combining(character))))
+
+
+def parse_chat_time(chat_time):
+    """Return datetime of chat_time such as 2019-10-23T11:51:19.123Z, without the fraction of the second."""
+    prefix = chat_time[:chat_time.index("T")]
+    suffix = chat_time[chat_time.index("T") + 1:][0:8]
+    return datetime.datetime.strptime(prefix + " " + suffix, "%Y-%m-%d %H:%M:%S")
+
+
+def per_minute_viewership(chat_times_and_users, channel_id, stream_id):
+    """Return viewership metrics of a stream from its (chat time, user) pairs sorted by chat time: number of messages
+    and distinct users in every minute since the first message, in the format of get_viewership_metrics."""
+    seconds = []
+    for chat_time, user in chat_times_and_users:
+        if not seconds or seconds[-1][0] != chat_time:
+            seconds.append([chat_time, 0, set()])
+        seconds[-1][1] += 1
+        seconds[-1][2].add(user)
+    return per_minute_viewership_of_seconds(seconds, channel_id, stream_id)
+
+
+def per_minute_viewership_of_seconds(seconds, channel_id, stream_id):
+    """Return viewership metrics like per_minute_viewership from (chat time, number of messages, set of users) of
+    every second with messages, sorted by chat time. The minutes only depend on these per second counts, so they can
+    be computed from counts gathered apart and merged."""
+    per_minute_dict = {}
+    seen_users = {}
+    current_offset = 1
+    first_time = seconds[0][0]
+    cur_total_seconds = first_time.minute * 60 + first_time.second
+    for chat_time, messages, users in seconds:
+        total_seconds = chat_time.minute * 60 + chat_time.second
+        if total_seconds - cur_total_seconds > 59:
+            current_offset += 1
+            cur_total_seconds = total_seconds
+
+        if current_offset not in per_minute_dict:
+            per_minute_dict[current_offset] = {"offset": current_offset, "viewers": 0, "messages": 0}
+            seen_users[current_offset] = set()
+        per_minute_dict[current_offset]["messages"] += messages
+        seen_users[current_offset] |= users
+        per_minute_dict[current_offset]["viewers"] = len(seen_users[current_offset])
+
+    return [{"channel_id": channel_id, "stream_id": stream_id, "starttime": str(first_time),
+             "per_minute": list(per_minute_dict.values())}]
+
+
+def spam_timeline(offsets_texts_and_users, channel_id, stream_id, window_seconds, threshold, limit):
+    """Return (window, number of messages, spam) for every window of window_seconds seconds of offset that has
+    messages, window n covering offsets from n * window_seconds on, from (offset, text, user) rows sorted by offset.
+    The spam of a window is ranked by rank_spam as soon as the rows leave it, so only the counters of one window are
+    held at a time."""
+    timeline = []
+    window = None
+    occurrences, users = Counter(), {}
+    for offset, text, user in offsets_texts_and_users:
+        row_window = int(offset // window_seconds)
+        if row_window != window:
+            if window is not None:
+                timeline.append((window, sum(occurrences.values()), rank_spam(
+                    channel_id, stream_id, occurrences, {text: len(users[text]) for text in users}, threshold, limit)))
+            window = row_window
+            occurrences, users = Counter(), {}
+        occurrences[text] += 1
+        users.setdefault(text, set()).add(user)
+    if window is not None:
+        timeline.append((window, sum(occurrences.values()), rank_spam(
+            channel_id, stream_id, occurrences, {text: len(users[text]) for text in users}, threshold, limit)))
+    return timeline
+
+
+# normalizes the text of every chat log stored into the key its spam is counted under, see set_spam_normalization
+spam_normalizer = SpamNormalizer(SPAM_NORMALIZATION_STEPS)
+
+
+def set_spam_normalization(steps):
+    """Normalize the spam keys of the chat logs stored from now on with steps of SpamNormalizer."""
+    global spam_normalizer
+    spam_normalizer = SpamNormalizer(steps)
+
+
+def normalized_spam_list(chat_logs, channel_id, stream_id, threshold):
+    """Return spam of chat_logs counted by normalized key like get_normalized_spam_list of ChatLogDao, normalizing
+    the texts of chat_logs that have no stored key."""
+    occurrences, users = Counter(), {}
+    for chat_log in chat_logs:
+        key = spam_normalizer.key(chat_log.text)
+        occurrences[key] += 1
+        users.setdefault(key, set()).add(chat_log.user)
+    return rank_spam(channel_id, stream_id, occurrences, {key: len(users[key]) for key in users}, threshold)
+
+
+JSON_READ_SIZE = 1 << 20
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# compressed exports are recognised by their first bytes, or by their extension when too short to tell
+COMPRESSION_MAGIC_NUMBERS = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"))
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".bz2": "bz2", ".xz": "xz"}
+DECOMPRESSORS = {"gzip": lambda file: gzip.GzipFile(fileobj=file), "bz2": bz2.BZ2File, "xz": lzma.LZMAFile}
+
+
+def detect_compression(filename):
+    """Return "gzip", "bz2" or "xz" when filename is compressed in that format and None otherwise."""
+    with open(filename, "rb") as file:
+        head = file.read(6)
+    for magic_number, compression in COMPRESSION_MAGIC_NUMBERS:
+        if head.startswith(magic_number):
+            return compression
+    if head:
+        return None
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+class DecompressedFile(io.TextIOWrapper):
+    """Text read from decompressor of compressed_file. Closing it closes compressed_file too, which the
+    decompressors leave open when given a file object."""
+
+    def __init__(self, compressed_file, decompressor):
+        super().__init__(decompressor)
+        self.compressed_file = compressed_file
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.compressed_file.close()
+
+
+def open_export(filename, read_size=JSON_READ_SIZE):
+    """
+    Open chat export filename, plain or compressed with gzip, bz2 or xz, for reading text. Compressed files are
+    decompressed while being read, without a temporary file. The compressed bytes are read read_size bytes at a
+    time, so that the decompressor is called with large blocks. Raises FileNotFoundError when there is no such file.
+    """
+    compression = detect_compression(filename)
+    if compression is None:
+        return open(filename, buffering=read_size)
+    file = open(filename, "rb", buffering=read_size)
+    try:
+        decompressed = io.BufferedReader(DECOMPRESSORS[compression](file), buffer_size=read_size)
+    except BaseException:
+        file.close()
+        raise
+    return DecompressedFile(file, decompressed)
+
+
+def stream_json_array(file, key, read_size=JSON_READ_SIZE):
+    """Yield the elements of the array stored under key in the JSON object read from text file, one at a time. The
+    file is read read_size characters at a time, and only the element being decoded is held in memory besides the
+    buffer."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    end_of_file = False
+
+    def refill():
+        nonlocal buffer, position, end_of_file
+        data = file.read(read_size)
+        end_of_file = not data
+        buffer = buffer[position:] + data
+        position = 0
+        return not end_of_file
+
+    def next_character():
+        # first character after the whitespace at position, "" at the end of the file
+        nonlocal position
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or not refill():
+                return buffer[position:position + 1]
+
+    def decode():
+        # JSON value at position; a value reaching the end of the buffer may continue in the next read
+        nonlocal position
+        while True:
+            next_character()
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                if end < len(buffer) or end_of_file:
+                    position = end
+                    return value
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+            refill()
+
+    def expect(characters):
+        nonlocal position
+        character = next_character()
+        if character == "" or character not in characters:
+            raise json.JSONDecodeError("expected one of {!r}".format(characters), buffer, position)
+        position += 1
+        return character
+
+    expect("{")
+    if next_character() == "}":
+        return
+    while True:
+        name = decode()
+        expect(":")
+        if name == key:
+            expect("[")
+            if next_character() == "]":
+                position += 1
+            else:
+                while True:
+                    yield decode()
+                    if expect(",]") == "]":
+                        break
+        else:
+            decode()
+        if expect(",}") == "}":
+            return
+
+
+class JsonDecoder:  # pragma: no cover
+    """
+    Abstract class for decoder of whole chat exports.
+    """
+
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError  # pragma: no cover
+
+    def load(self, file):  # pragma: no cover
+        """Return the value of the JSON document read from text file."""
+        raise NotImplementedError  # pragma: no cover
+
+
+class JsonDecoderStandardImplementation(JsonDecoder):
+    """Extends JsonDecoder abstract class with the json module of the standard library."""
+
+    name = "json"
+
+    def __init__(self):
+        pass
+
+    def load(self, file):
+        """Overriden from JsonDecoder."""
+        return json.load(file)
+
+
+class JsonDecoderOrjsonImplementation(JsonDecoder):
+    """Extends JsonDecoder abstract class with orjson, which decodes the raw UTF-8 bytes of the file several times
+    faster than the json module."""
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+
+    def load(self, file):
+        """Overriden from JsonDecoder. Raises orjson.JSONDecodeError, a subclass of json.JSONDecodeError."""
+        return orjson.loads(file.buffer.read())
+
+
+JSON_DECODER_IMPLEMENTATIONS = {"json": JsonDecoderStandardImplementation, "orjson": JsonDecoderOrjsonImplementation}
+
+
+def available_json_decoders():
+    """Return names of the JSON decoders that can be used in this interpreter, fastest first."""
+    return (["orjson"] if orjson is not None else []) + ["json"]
+
+
+def create_json_decoder(name="auto"):
+    """Return JSON decoder called name, or with "auto" the fastest one available. Raises ValueError when the decoder
+    is unknown or its module is not installed."""
+    if name == "auto":
+        name = available_json_decoders()[0]
+    if name not in JSON_DECODER_IMPLEMENTATIONS:
+        raise ValueError("unknown JSON decoder {}".format(name))
+    return JSON_DECODER_IMPLEMENTATIONS[name]()
+
+
+@contextlib.contextmanager
+def paused_garbage_collection():
+    """Suspend the cyclic garbage collector inside the block. Decoding allocates millions of containers, none of
+    them garbage, and every allocation threshold reached would otherwise trigger a collection that scans them."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def project_comment(comment):
+    """Return copy of Twitch comment with only the fields read by CommentDaoJSONImpl, in the same nesting. The other
+    fields, such as the profile of the commenter, are most of the export and would otherwise be kept in memory. The
+    emote fragments and badges are shared with comment."""
+    message = comment["message"]
+    projected_message = {"body": message["body"]}
+    if "fragments" in message:
+        projected_message["fragments"] = [fragment for fragment in message["fragments"] if "emoticon" in fragment]
+    if "user_badges" in message:
+        projected_message["user_badges"] = message["user_badges"]
+    return {"channel_id": comment["channel_id"], "content_id": comment["content_id"],
+            "created_at": comment["created_at"], "content_offset_seconds": comment["content_offset_seconds"],
+            "commenter": {"display_name": comment["commenter"]["display_name"]}, "message": projected_message}
+
 
 class CommentDao:
     """
@@ -19,6 +471,11 @@ class CommentDao:
         """Retrieve all the comments from the database"""  # pragma: no cover
         raise NotImplementedError  # pragma: no cover
 
+    def iter_comments(self):  # pragma: no cover
+        """Yield the comments one at a time, without holding the whole export in memory unless it is parsed
+        already."""
+        raise NotImplementedError  # pragma: no cover
+
     def get_chat_log_from_comment(self, channel_id, stream_id, comment):  # pragma: no cover
         """Create and return chat log from given comment, and with given channel_id and stream_id."""
         raise NotImplementedError  # pragma: no cover
@@ -27,6 +484,18 @@ class CommentDao:
         """Return channel_id and stream_id of comment at comment_index."""
         raise NotImplementedError  # pragma: no cover
 
+    def get_source_name(self):  # pragma: no cover
+        """Return name that identifies where the comments are read from, used for ingestion checkpoints."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_emotes_from_comment(self, comment):  # pragma: no cover
+        """Return list of (emoticon_id, text) pairs of the emotes in the message of comment."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_badges_from_comment(self, comment):  # pragma: no cover
+        """Return list of (badge, version) pairs of the badges the commenter wore."""
+        raise NotImplementedError  # pragma: no cover
+
     def count_comments_and_users(self):  # pragma: no cover
         """
         Return two dictionaries - first that maps messages to number of occurences and
@@ -36,24 +505,50 @@ class CommentDao:
 
 
 class CommentDaoJSONImpl(CommentDao):
-    """Extends CommentDao abstract class."""
+    """Extends CommentDao abstract class. Comments are decoded with json_decoder, the fastest available by default,
+    and only their fields read by this class are kept."""
 
-    def __init__(self, filename):
+    def __init__(self, filename, json_decoder=None):
         self.filename = filename
+        self.json_decoder = create_json_decoder() if json_decoder is None else json_decoder
+        self.comments = None
 
     def get_all_comments(self):
         """
-        Overriden from CommentDao.
+        Overriden from CommentDao. The file is parsed on the first call only, so that every command run with the
+        same DAO shares one parse.
         """
+        if self.comments is not None:
+            return self.comments
         try:
-            with open(self.filename) as file:
-                json_file = json.load(file)
-                comments = json_file["comments"]
-                return comments
+            with instrumentation.span("comment_dao.json_parse"), open_export(self.filename) as file, \
+                    paused_garbage_collection():
+                json_file = self.json_decoder.load(file)
+                self.comments = [project_comment(comment) for comment in json_file["comments"]]
+                instrumentation.count("bytes_read", "comment_dao.json_parse", os.path.getsize(self.filename))
+                instrumentation.count("rows", "comment_dao.json_parse", len(self.comments))
+                return self.comments
 
         except FileNotFoundError:
             return []
 
+    def iter_comments(self):
+        """Overriden from CommentDao."""
+        if self.comments is not None:
+            yield from self.comments
+            return
+        try:
+            file = open_export(self.filename)
+        except FileNotFoundError:
+            return
+        with file:
+            rows = 0
+            for comment in stream_json_array(file, "comments"):
+                rows += 1
+                yield project_comment(comment)
+            instrumentation.count("bytes_read", "comment_dao.json_stream", os.path.getsize(self.filename))
+            instrumentation.count("rows", "comment_dao.json_stream", rows)
+
     def get_chat_log_from_comment(self, channel_id, stream_id, comment):
         """Create and return chat log from given comment, and with given channel_id and stream_id."""
         return ChatLog(channel_id, stream_id, comment["message"]["body"],
@@ -68,6 +563,19 @@ class CommentDaoJSONImpl(CommentDao):
         channel_id, stream_id = first_comment["channel_id"], first_comment["content_id"]
         return channel_id, stream_id
 
+    def get_source_name(self):
+        """Overriden from CommentDao."""
+        return os.path.abspath(self.filename)
+
+    def get_emotes_from_comment(self, comment):
+        """Overriden from CommentDao."""
+        return [(fragment["emoticon"]["emoticon_id"], fragment["text"])
+                for fragment in comment["message"].get("fragments", []) if "emoticon" in fragment]
+
+    def get_badges_from_comment(self, comment):
+        """Overriden from CommentDao."""
+        return [(badge["_id"], badge["version"]) for badge in comment["message"].get("user_badges", [])]
+
     def count_comments_and_users(self):
         """
         Return two dictionaries - first that maps messages to number of occurences and
@@ -107,8 +615,8 @@ class ChannelDao:  # pragma: no cover
         """Retrieve and return channel with given channel_id."""
         raise NotImplementedError  # pragma: no cover
 
-    def start_session(self):  # pragma: no cover
-        """Start current database connection session."""
+    def start_session(self, read_only=False):  # pragma: no cover
+        """Start current database connection session. Read only sessions never block on a running writer."""
         raise NotImplementedError  # pragma: no cover
 
     def close_session(self):  # pragma: no cover
@@ -125,34 +633,40 @@ class ChannelDaoSqlLiteImplementation(ChannelDao):
     Extends ChannelDao abstract class.
     """
 
-    def __init__(self, database_name):
+    def __init__(self, database_name, connection_factory=default_connection_factory):
         self.database_name = database_name
+        self.connection_factory = connection_factory
         self.database_connection = None
         self.cursor = None
+        self.read_only = False
 
     def save_changes(self):
         """Overriden from ChannelDao."""
-        self.database_connection.commit()
+        self.connection_factory.retry(self.database_connection.commit)
 
     def close_session(self):
         """
         Overriden from ChannelDao.
         """
-        self.database_connection.close()
+        self.connection_factory.release(self.database_connection)
 
-    def start_session(self):
+    def start_session(self, read_only=False):
         """
         Overriden from ChannelDao.
         """
-        self.database_connection = sqlite3.connect(self.database_name)
+        self.read_only = read_only
+        self.database_connection = self.connection_factory.connect(self.database_name, read_only)
         self.cursor = self.database_connection.cursor()
 
     def __create_table_if_not_exists(self):
         """
-        Overriden from ChannelDao.
+        Create the table unless the session is read only. Return whether the table exists.
         """
+        if self.read_only:
+            return table_exists(self.cursor, "channels")
         self.cursor.execute("""CREATE TABLE if not exists channels
             (channel_id integer primary key, channel_name text)""")
+        return True
 
     def insert(self, channel):
         """
@@ -166,7 +680,8 @@ class ChannelDaoSqlLiteImplementation(ChannelDao):
         """
         Overriden from ChannelDao.
         """
-        self.__create_table_if_not_exists()
+        if not self.__create_table_if_not_exists():
+            return []
 
         rows = self.cursor.execute("select * from channels where channel_id = {}".format(channel_id))
         return rows
@@ -192,8 +707,8 @@ class SpamDao:  # pragma: no cover
         """Delete spam message with channel_id and stream_id from database."""
         raise NotImplementedError  # pragma: no cover
 
-    def start_session(self):  # pragma: no cover
-        """Start current database connection session."""
+    def start_session(self, read_only=False):  # pragma: no cover
+        """Start current database connection session. Read only sessions never block on a running writer."""
         raise NotImplementedError  # pragma: no cover
 
     def close_session(self):  # pragma: no cover
@@ -204,6 +719,24 @@ class SpamDao:  # pragma: no cover
         """Commit changes to the database"""
         raise NotImplementedError  # pragma: no cover
 
+    def export_tables(self, tasks, export):  # pragma: no cover
+        """Call export(table_name, channel_id, stream_id, columns, rows) for every (table_name, channel_id,
+        stream_id) in tasks, with table_name top_spam, like ChatLogDao.export_tables. Return the results of export in
+        the order of tasks."""
+        raise NotImplementedError  # pragma: no cover
+
+    def insert_spam_stats(self, comments_count, comments_user_count, channel_id, stream_id):  # pragma: no cover
+        """Store number of occurrences and users of every message of comments_count sent at least
+        SPAM_STATS_MIN_OCCURRENCES times, with comments_count and comments_user_count as for sort_and_insert_spam.
+        Return number of messages stored."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_top_spam(self, channel_id, stream_id, threshold, limit=None):  # pragma: no cover
+        """Return at most limit, all without limit, spam of the stream stored by insert_spam_stats sent more than
+        threshold times, ranked like get_all_wth_channel_and_stream_id. threshold must be at least
+        SPAM_STATS_MIN_OCCURRENCES - 1."""
+        raise NotImplementedError  # pragma: no cover
+
     def sort_and_insert_spam(self, comments_count, comments_user_count, channel_id, stream_id, threshold=10,
                              reverse=True):
         """Sort and store spam based on the key-value pairs comments_count, comments_user_count, and also
@@ -224,26 +757,64 @@ class SpamDao:  # pragma: no cover
 class SpamDaoSqlLiteImplementation(SpamDao):
     """Extends SpamDao abstract class."""
 
-    def __init__(self, database_name):
+    def __init__(self, database_name, connection_factory=default_connection_factory):
         self.database_name = database_name
+        self.connection_factory = connection_factory
         self.database_connection = None
         self.cursor = None
+        self.read_only = False
         self.spam_factory = SpamFactory()
 
     def save_changes(self):
         """Overriden from SpamDao."""
-        self.database_connection.commit()
+        self.connection_factory.retry(self.database_connection.commit)
 
     def __create_table_if_not_exists(self):
+        if self.read_only:
+            return table_exists(self.cursor, "top_spam")
         self.cursor.execute("""create table if not exists top_spam (channel_id integer NOT NULL,
         stream_id integer NOT NULL, spam_text string, spam_occurrences integer,
         spam_user_count integer, FOREIGN KEY(channel_id) REFERENCES channels(channel_id))""")
+        return True
+
+    def __create_stats_table_if_not_exists(self):
+        if self.read_only:
+            return table_exists(self.cursor, "spam_stats")
+        self.cursor.execute("""create table if not exists spam_stats (channel_id integer NOT NULL,
+        stream_id integer NOT NULL, spam_text string, spam_occurrences integer, spam_user_count integer)""")
+        # get_top_spam reads the spam of a stream in order of this index and stops at threshold and limit
+        self.cursor.execute("""create index if not exists spam_stats_rank on spam_stats (channel_id, stream_id,
+        spam_occurrences desc, spam_user_count desc, spam_text)""")
+        return True
+
+    def insert_spam_stats(self, comments_count, comments_user_count, channel_id, stream_id):
+        """
+        Overriden from SpamDao.
+        """
+        self.__create_stats_table_if_not_exists()
+        rows = [(channel_id, stream_id, text, count, len(comments_user_count[text]))
+                for text, count in comments_count.items() if count >= SPAM_STATS_MIN_OCCURRENCES]
+        self.cursor.executemany("insert into spam_stats values(?,?,?,?,?)", rows)
+        return len(rows)
+
+    def get_top_spam(self, channel_id, stream_id, threshold, limit=None):
+        """
+        Overriden from SpamDao.
+        """
+        if not self.__create_stats_table_if_not_exists():
+            return []
+        rows = self.cursor.execute("""select channel_id, stream_id, spam_text, spam_occurrences, spam_user_count
+        from spam_stats where channel_id = ? and stream_id = ? and spam_occurrences > ?
+        order by spam_occurrences desc, spam_user_count desc, spam_text limit ?""",
+                                   (channel_id, stream_id, threshold, -1 if limit is None else limit))
+        return [self.spam_factory.from_vector(row) for row in rows]
 
     def get_all_wth_channel_and_stream_id(self, channel_id, stream_id):
         """
         Overriden from SpamDao.
         """
-        self.__create_table_if_not_exists()
+        if not self.__create_table_if_not_exists():
+            return []
         rows = self.cursor.execute(("""select * from top_spam where channel_id = {} and stream_id = {}
             order by spam_occurrences desc, spam_user_count desc, spam_text""").format(
             channel_id, stream_id))
@@ -269,36 +840,50 @@ class SpamDaoSqlLiteImplementation(SpamDao):
         Overriden from SpamDao.
         """
         self.__create_table_if_not_exists()
+        self.__create_stats_table_if_not_exists()
 
         self.cursor.execute("delete from top_spam where channel_id = ? and stream_id = ?", (channel_id, stream_id))
+        self.cursor.execute("delete from spam_stats where channel_id = ? and stream_id = ?", (channel_id, stream_id))
+
+    def export_tables(self, tasks, export):
+        """
+        Overriden from SpamDao.
+        """
+        table_ready = self.__create_table_if_not_exists()
+        results = []
+        for table_name, channel_id, stream_id in tasks:
+            rows = iter(())
+            if table_ready:
+                rows = self.database_connection.execute("""select {} from top_spam where channel_id = ? and stream_id
+                = ? order by {}""".format(", ".join(EXPORT_COLUMNS[table_name]), EXPORT_ORDER[table_name]),
+                                                        (channel_id, stream_id))
+            results.append(export(table_name, channel_id, stream_id, EXPORT_COLUMNS[table_name], rows))
+        return results
 
     def sort_and_insert_spam(self, comments_count, comments_user_count, channel_id, stream_id, threshold=10,
                              reverse=True):
         """Overriden from SpamDao.
         """
-        sorted_comments_count = sorted(comments_count.items(), key=lambda kv: kv[1], reverse=reverse)
-        count = 0
-
-        for i, (key, value) in enumerate(sorted_comments_count):
-            comment_user_number = len(comments_user_count[key])
-            if value > threshold:
-                new_spam = Spam(channel_id, stream_id, key, value, comment_user_number)
-                self.insert(new_spam)
-                count += 1
-
-        return count
+        spam_list = rank_spam(channel_id, stream_id, comments_count,
+                              {text: len(users) for text, users in comments_user_count.items()}, threshold)
+        if not reverse:
+            spam_list.reverse()
+        for spam in spam_list:
+            self.insert(spam)
+        return len(spam_list)
 
     def close_session(self):
         """
         Overriden from SpamDao.
         """
-        self.database_connection.close()
+        self.connection_factory.release(self.database_connection)
 
-    def start_session(self):
+    def start_session(self, read_only=False):
         """
         Overriden from SpamDao.
         """
-        self.database_connection = sqlite3.connect(self.database_name)
+        self.read_only = read_only
+        self.database_connection = self.connection_factory.connect(self.database_name, read_only)
         self.cursor = self.database_connection.cursor()
 
 
@@ -319,7 +904,8 @@ class ChatLogDao:  # pragma: no cover
         raise NotImplementedError  # pragma: no cover
 
     def select_where_filter_conditions_are_satisfied(self, arguments):  # pragma: no cover
-        """Generate and execute query based on the given arguments."""
+        """Generate and execute query based on the given arguments. Raise ValueError if a match filter covers a stream
+        missing from the full text index."""
         raise NotImplementedError  # pragma: no cover
 
     def get_all_with_channel_and_stream_id(self, channel_id, stream_id):  # pragma: no cover
@@ -327,8 +913,8 @@ class ChatLogDao:  # pragma: no cover
         stream id match given channel_id and stream_id."""
         raise NotImplementedError  # pragma: no cover
 
-    def start_session(self):  # pragma: no cover
-        """Start current database connection session."""
+    def start_session(self, read_only=False):  # pragma: no cover
+        """Start current database connection session. Read only sessions never block on a running writer."""
         raise NotImplementedError  # pragma: no cover
 
     def close_session(self):  # pragma: no cover
@@ -349,142 +935,572 @@ class ChatLogDao:  # pragma: no cover
         """Convert chat_time into a datetime object in each chat log and return updated chat logs."""
         raise NotImplementedError  # pragma: no cover
 
+    def get_checkpoint(self, source_name, channel_id, stream_id):  # pragma: no cover
+        """Return index of the first comment of source_name that has not been committed for given channel_id and
+        stream_id yet, or None if there is no checkpoint for it."""
+        raise NotImplementedError  # pragma: no cover
+
+    def save_checkpoint(self, source_name, channel_id, stream_id, comment_index):  # pragma: no cover
+        """Record that comments of source_name before comment_index have been stored. The checkpoint is committed
+        together with the chat log rows on the next save_changes."""
+        raise NotImplementedError  # pragma: no cover
+
+    def save_viewership_rollup(self, channel_id, stream_id, viewership):  # pragma: no cover
+        """Store viewership metrics of the stream, as returned by get_viewership_metrics, so that they are not
+        computed from the chat log again."""
+        raise NotImplementedError  # pragma: no cover
+
+    def insert_full_text(self, chat_log):  # pragma: no cover
+        """Add text and user of chat_log to the full text index searched by the match filter."""
+        raise NotImplementedError  # pragma: no cover
+
+    def save_full_text_stream(self, channel_id, stream_id):  # pragma: no cover
+        """Record that every message of the stream was added to the full text index, so that the match filter may
+        search it. The record is deleted with the chat log of the stream."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_stream_ids(self, channel_id, limit=None):  # pragma: no cover
+        """Return ids of the streams of the channel that have chat log, newest (highest id) first, at most limit."""
+        raise NotImplementedError  # pragma: no cover
+
+    def count_messages_by_user(self, channel_id, stream_ids):  # pragma: no cover
+        """Return list with a dictionary for every stream in stream_ids, mapping (text, user) pairs to the number of
+        times the user sent the text in that stream."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_viewership_by_stream(self, channel_id, stream_ids):  # pragma: no cover
+        """Return list with the result of get_viewership_metrics for every stream in stream_ids."""
+        raise NotImplementedError  # pragma: no cover
+
+    def refresh_user_activity(self, channel_id, stream_id):  # pragma: no cover
+        """Recompute number of messages and first and last chat time of every user of the stream from its chat log.
+        The activity is kept when the chat log is deleted or archived."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_top_chatters(self, channel_id, stream_id, limit):  # pragma: no cover
+        """Return activity of the limit users who sent most messages in the stream, most active first."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_user_activity(self, user):  # pragma: no cover
+        """Return activity of user in every stream the user chatted in, oldest first."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_recent_messages(self, user, limit):  # pragma: no cover
+        """Return the limit most recent chat logs of user over every stream, in order of chat time."""
+        raise NotImplementedError  # pragma: no cover
+
+    def insert_emotes(self, emotes):  # pragma: no cover
+        """Store (channel_id, stream_id, message_index, offset, emoticon_id, emote) rows of the emotes used in the
+        messages of a stream, message_index being the position of the message in the stream."""
+        raise NotImplementedError  # pragma: no cover
+
+    def insert_badges(self, badges):  # pragma: no cover
+        """Store (channel_id, stream_id, message_index, user, badge, version) rows of the badges worn by the senders
+        of the messages of a stream."""
+        raise NotImplementedError  # pragma: no cover
+
+    def delete_emotes_and_badges(self, channel_id, stream_id):  # pragma: no cover
+        """Delete emotes and badges of the stream. They are kept when only the chat log is deleted or archived."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_top_emotes_per_minute(self, channel_id, stream_id, limit):  # pragma: no cover
+        """Return the limit most used emotes of every minute of the stream, minutes counted from the offset."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_badge_share(self, channel_id, stream_id, badge):  # pragma: no cover
+        """Return share of the messages and chatters of the stream that wore badge."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_last_chat_times(self, channel_id=None):  # pragma: no cover
+        """Return dictionary that maps (channel_id, stream_id) of every stored stream, or only of the streams of
+        channel_id if given, to the chat time of its last message."""
+        raise NotImplementedError  # pragma: no cover
+
+    def delete_stream_batch(self, channel_id, stream_id, batch_size):  # pragma: no cover
+        """Delete at most batch_size rows of the stream from the chat log or, once it is empty, from the tables
+        derived from it. Return number of rows deleted, 0 once nothing of the stream is left."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_spam_timeline(self, channel_id, stream_id, window_seconds, threshold, limit):  # pragma: no cover
+        """Return (window, number of messages, spam) for every window of window_seconds seconds of offset of the
+        stream that has messages, in order, with at most limit spam of the window ranked like get_spam_list. The
+        stream is read once, in order of offset."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_normalized_spam_list(self, channel_id, stream_id, threshold):  # pragma: no cover
+        """Return spam of the stream like get_spam_list, with messages of the same normalized key counted as one
+        message whose text is the key."""
+        raise NotImplementedError  # pragma: no cover
+
+    def export_tables(self, tasks, export, max_workers=None):  # pragma: no cover
+        """Call export(table_name, channel_id, stream_id, columns, rows) for every (table_name, channel_id,
+        stream_id) in tasks, one of chat_log, viewership_rollup and user_activity, with columns as in EXPORT_COLUMNS
+        and rows an iterator over the rows of the stream in the table, read while they are consumed. Calls may run
+        in parallel, on at most max_workers threads. Return the results of export in the order of tasks."""
+        raise NotImplementedError  # pragma: no cover
+
 
 class ChatLogDaoSqlLiteImplementation(ChatLogDao):
     """Extends ChatLogDao abstract class"""
 
-    def __init__(self, database_name):
+    def __init__(self, database_name, connection_factory=default_connection_factory):
         self.database_name = database_name
+        self.connection_factory = connection_factory
         self.database_connection = None
         self.cursor = None
+        self.read_only = False
         self.operation_keyword_mapping = {"eq": " = ", "gt": " > ", "lt": " < ", "gteq": " >= ", "lteq": " <= ",
                                           "like": " like "}
         self.chat_log_factory = ChatLogFactory()
         self.spam_factory = SpamFactory()
+        self.max_workers = None
+        # whether the chat log table is known to exist in the current session
+        self.table_ready = False
 
     def __create_table_if_not_exists(self):
+        if self.table_ready:
+            return True
+        if self.read_only:
+            self.table_ready = table_exists(self.cursor, "chat_log")
+            return self.table_ready
         self.cursor.execute("""create table if not exists chat_log (channel_id integer
         NOT NULL, stream_id integer NOT NULL, text string, user string, chat_time
-        datetime, offset int, FOREIGN KEY(channel_id) REFERENCES channels(channel_id))""")
+        datetime, offset int, spam_key text, spam_hash integer,
+        FOREIGN KEY(channel_id) REFERENCES channels(channel_id))""")
+        self.__add_spam_key_columns_if_missing()
+        # the stream of a channel is the unit of every analytic, and its normalized spam is grouped by hash in the
+        # order of the index
+        self.cursor.execute("""create index if not exists chat_log_channel_stream on chat_log (channel_id, stream_id,
+        spam_hash)""")
+        self.cursor.execute("create index if not exists chat_log_user on chat_log (user, chat_time)")
+        self.table_ready = True
+        return True
+
+    def __has_spam_key_columns(self):
+        return "spam_hash" in [row[1] for row in uncounted_cursor(self.database_connection).execute(
+            "pragma table_info(chat_log)")]
+
+    def __add_spam_key_columns_if_missing(self):
+        # chat logs stored before the spam keys were introduced get theirs when the table is first written to
+        if self.__has_spam_key_columns():
+            return
+        self.cursor.execute("alter table chat_log add column spam_key text")
+        self.cursor.execute("alter table chat_log add column spam_hash integer")
+        # created again with the hash by __create_table_if_not_exists
+        self.cursor.execute("drop index if exists chat_log_channel_stream")
+        rows = self.cursor.execute("select rowid, text from chat_log").fetchall()
+        with instrumentation.span("chat_log_dao.add_spam_keys"):
+            self.cursor.executemany("update chat_log set spam_key = ?, spam_hash = ? where rowid = ?",
+                                    [spam_normalizer.key_and_hash(text) + (rowid,) for rowid, text in rows])
+        instrumentation.count("rows", "chat_log_dao.add_spam_keys", len(rows))
+
+    def __create_progress_table_if_not_exists(self):
+        self.cursor.execute("""create table if not exists ingest_progress (source_name text primary key,
+        channel_id integer NOT NULL, stream_id integer NOT NULL, comment_index integer NOT NULL)""")
+
+    def get_checkpoint(self, source_name, channel_id, stream_id):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_progress_table_if_not_exists()
+        row = self.cursor.execute("""select comment_index from ingest_progress where source_name = ? and
+        channel_id = ? and stream_id = ?""", (source_name, channel_id, stream_id)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def save_checkpoint(self, source_name, channel_id, stream_id, comment_index):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_progress_table_if_not_exists()
+        self.cursor.execute("insert or replace into ingest_progress values (?,?,?,?)",
+                            (source_name, channel_id, stream_id, comment_index))
+
+    def __create_emote_and_badge_tables_if_not_exists(self):
+        if self.read_only:
+            return table_exists(self.cursor, "chat_emote") and table_exists(self.cursor, "chat_badge")
+        self.cursor.execute("""create table if not exists chat_emote (channel_id integer NOT NULL, stream_id integer
+        NOT NULL, message_index integer NOT NULL, offset int, emoticon_id text, emote text)""")
+        self.cursor.execute("create index if not exists chat_emote_stream on chat_emote (channel_id, stream_id, emote)")
+        self.cursor.execute("""create table if not exists chat_badge (channel_id integer NOT NULL, stream_id integer
+        NOT NULL, message_index integer NOT NULL, user text, badge text, version text)""")
+        self.cursor.execute("create index if not exists chat_badge_stream on chat_badge (channel_id, stream_id, badge)")
+        return True
+
+    def insert_emotes(self, emotes):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_emote_and_badge_tables_if_not_exists()
+        self.cursor.executemany("insert into chat_emote values (?,?,?,?,?,?)", emotes)
+
+    def insert_badges(self, badges):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_emote_and_badge_tables_if_not_exists()
+        self.cursor.executemany("insert into chat_badge values (?,?,?,?,?,?)", badges)
+
+    def delete_emotes_and_badges(self, channel_id, stream_id):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_emote_and_badge_tables_if_not_exists()
+        self.cursor.execute("delete from chat_emote where channel_id = ? and stream_id = ?", (channel_id, stream_id))
+        self.cursor.execute("delete from chat_badge where channel_id = ? and stream_id = ?", (channel_id, stream_id))
+
+    def get_top_emotes_per_minute(self, channel_id, stream_id, limit):
+        """
+        Overriden from ChatLogDao.
+        """
+        if not self.__create_emote_and_badge_tables_if_not_exists():
+            return []
+        rows = self.cursor.execute("""select cast(offset / 60 as integer), emote, count(*) from chat_emote where
+        channel_id = ? and stream_id = ? group by 1, 2 order by 1, 3 desc, 2""", (channel_id, stream_id))
+        per_minute = []
+        for minute, emote, count in rows:
+            if not per_minute or per_minute[-1]["minute"] != minute:
+                per_minute.append({"minute": minute, "emotes": []})
+            if len(per_minute[-1]["emotes"]) < limit:
+                per_minute[-1]["emotes"].append({"emote": emote, "count": count})
+        return per_minute
+
+    def get_badge_share(self, channel_id, stream_id, badge):
+        """
+        Overriden from ChatLogDao. Messages and chatters of the stream are taken from the user activity.
+        """
+        badge_messages, badge_chatters = 0, 0
+        if self.__create_emote_and_badge_tables_if_not_exists():
+            badge_messages, badge_chatters = self.cursor.execute(
+                """select count(*), count(distinct user) from chat_badge where channel_id = ? and stream_id = ? and
+                badge = ?""", (channel_id, stream_id, badge)).fetchone()
+        messages, chatters = 0, 0
+        activity_table = self.__activity_table()
+        if activity_table is not None:
+            messages, chatters = self.cursor.execute("""select coalesce(sum(messages), 0), count(*) from {} where
+            channel_id = ? and stream_id = ?""".format(activity_table), (channel_id, stream_id)).fetchone()
+        return {"channel_id": channel_id, "stream_id": stream_id, "badge": badge, "messages": messages,
+                "badge_messages": badge_messages,
+                "message_share": round(badge_messages / messages, 4) if messages else 0.0,
+                "chatters": chatters, "badge_chatters": badge_chatters,
+                "chatter_share": round(badge_chatters / chatters, 4) if chatters else 0.0}
+
+    def get_last_chat_times(self, channel_id=None):
+        """
+        Overriden from ChatLogDao.
+        """
+        if not self.__create_table_if_not_exists():
+            return {}
+        if channel_id is None:
+            rows = self.cursor.execute("""select channel_id, stream_id, max(chat_time) from chat_log group by
+            channel_id, stream_id""")
+        else:
+            rows = self.cursor.execute("""select channel_id, stream_id, max(chat_time) from chat_log where channel_id
+            = ? group by stream_id""", (channel_id,))
+        return {(row[0], row[1]): row[2] for row in rows}
+
+    def delete_stream_batch(self, channel_id, stream_id, batch_size):
+        """
+        Overriden from ChatLogDao. The chat log goes first, so that an interrupted deletion leaves the derived
+        tables to be deleted by the next run, and the checkpoints last, so that storechatlog --resume reloads the
+        source.
+        """
+        self.__create_table_if_not_exists()
+        for table_name in ("chat_log", "chat_log_fts_streams", "chat_log_fts", "chat_emote", "chat_badge",
+                           "user_activity", "viewership_rollup", "ingest_progress"):
+            if table_name != "chat_log" and not table_exists(self.cursor, table_name):
+                continue
+            deleted = self.cursor.execute("""delete from {0} where rowid in (select rowid from {0} where {1} limit
+            ?)""".format(table_name, self.__stream_condition(table_name)),
+                                          (int(channel_id), int(stream_id), batch_size)).rowcount
+            if deleted:
+                return deleted
+        return 0
+
+    def __export_table(self, table_name, channel_id, stream_id, export):
+        rows = iter(())
+        if table_exists(self.cursor, table_name):
+            # a cursor of its own, so that the rows are fetched while export consumes them
+            rows = self.database_connection.execute("""select {} from {} where channel_id = ? and stream_id = ? order
+            by {}""".format(", ".join(EXPORT_COLUMNS[table_name]), table_name, EXPORT_ORDER[table_name]),
+                                                    (channel_id, stream_id))
+        return export(table_name, channel_id, stream_id, EXPORT_COLUMNS[table_name], rows)
+
+    def export_tables(self, tasks, export, max_workers=None):
+        """
+        Overriden from ChatLogDao. The tables are read in parallel, each on a connection of its own.
+        """
+        fan_out_executor = ShardFanOutExecutor(type(self), max_workers)
+        return fan_out_executor.starmap(
+            [(self.database_name, lambda chat_log_dao, task=task: chat_log_dao.__export_table(*task, export))
+             for task in tasks])
+
+    def __create_activity_table_if_not_exists(self):
+        if self.read_only:
+            return table_exists(self.cursor, "user_activity")
+        created = not table_exists(self.cursor, "user_activity")
+        self.cursor.execute("""create table if not exists user_activity (user text NOT NULL, channel_id integer NOT
+        NULL, stream_id integer NOT NULL, messages integer NOT NULL, first_seen datetime, last_seen datetime, primary
+        key (user, channel_id, stream_id))""")
+        self.cursor.execute("""create index if not exists user_activity_stream on user_activity (channel_id,
+        stream_id, messages)""")
+        if created and self.__create_table_if_not_exists():
+            # chat logs stored before the user activity was introduced get theirs when the table is first created
+            with instrumentation.span("chat_log_dao.add_user_activity"):
+                self.cursor.execute("insert into user_activity " + USER_ACTIVITY_OF_CHAT_LOG)
+        return True
+
+    def __activity_table(self):
+        # read only sessions of a database written before the user activity was introduced aggregate the chat log
+        if self.__create_activity_table_if_not_exists():
+            return "user_activity"
+        if self.__create_table_if_not_exists():
+            return "({})".format(USER_ACTIVITY_OF_CHAT_LOG)
+        return None
+
+    def refresh_user_activity(self, channel_id, stream_id):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_table_if_not_exists()
+        self.__create_activity_table_if_not_exists()
+        self.cursor.execute("delete from user_activity where channel_id = ? and stream_id = ?", (channel_id, stream_id))
+        self.cursor.execute("""insert into user_activity select user, channel_id, stream_id, count(*), min(chat_time),
+        max(chat_time) from chat_log where channel_id = ? and stream_id = ? group by user""", (channel_id, stream_id))
+
+    def __activity_to_dict(self, row):
+        return {"user": row[0], "channel_id": row[1], "stream_id": row[2], "messages": row[3], "first_seen": row[4],
+                "last_seen": row[5]}
+
+    def get_top_chatters(self, channel_id, stream_id, limit):
+        """
+        Overriden from ChatLogDao.
+        """
+        activity_table = self.__activity_table()
+        if activity_table is None:
+            return []
+        rows = self.cursor.execute("""select * from {} where channel_id = ? and stream_id = ? order by messages desc,
+        user limit ?""".format(activity_table), (channel_id, stream_id, limit))
+        return [self.__activity_to_dict(row) for row in rows]
+
+    def get_user_activity(self, user):
+        """
+        Overriden from ChatLogDao.
+        """
+        activity_table = self.__activity_table()
+        if activity_table is None:
+            return []
+        rows = self.cursor.execute("select * from {} where user = ? order by first_seen, channel_id, stream_id"
+                                   .format(activity_table), (user,))
+        return [self.__activity_to_dict(row) for row in rows]
+
+    def get_recent_messages(self, user, limit):
+        """
+        Overriden from ChatLogDao. Reads the newest messages backwards through the chat_log_user index.
+        """
+        if not self.__create_table_if_not_exists():
+            return []
+        rows = self.cursor.execute("""select {} from chat_log where user = ? order by chat_time desc, rowid desc
+        limit ?""".format(", ".join(CHAT_LOG_COLUMNS)), (user, limit)).fetchall()
+        return [self.chat_log_factory.from_vector(row) for row in reversed(rows)]
+
+    def get_stream_ids(self, channel_id, limit=None):
+        """
+        Overriden from ChatLogDao.
+        """
+        if not self.__create_table_if_not_exists():
+            return []
+        rows = self.cursor.execute("""select distinct stream_id from chat_log where channel_id = ? order by stream_id
+        desc limit ?""", (channel_id, -1 if limit is None else limit))
+        return [row[0] for row in rows]
+
+    def count_stream_messages_by_user(self, channel_id, stream_id):
+        """Return dictionary that maps (text, user) pairs of the stream to the number of times the user sent the
+        text."""
+        if not self.__create_table_if_not_exists():
+            return {}
+        rows = self.cursor.execute("""select text, user, count(*) from chat_log where channel_id = ? and stream_id = ?
+        group by text, user""", (channel_id, stream_id))
+        return {(text, user): count for text, user, count in rows}
+
+    def count_messages_by_user(self, channel_id, stream_ids):
+        """
+        Overriden from ChatLogDao. The streams are counted in parallel, each on a connection of its own.
+        """
+        fan_out_executor = ShardFanOutExecutor(type(self), self.max_workers)
+        return fan_out_executor.starmap(
+            [(self.database_name, lambda chat_log_dao, stream_id=stream_id:
+              chat_log_dao.count_stream_messages_by_user(channel_id, stream_id)) for stream_id in stream_ids])
+
+    def get_viewership_by_stream(self, channel_id, stream_ids):
+        """
+        Overriden from ChatLogDao. The streams are computed in parallel, each on a connection of its own.
+        """
+        fan_out_executor = ShardFanOutExecutor(type(self), self.max_workers)
+        return fan_out_executor.starmap(
+            [(self.database_name, lambda chat_log_dao, stream_id=stream_id:
+              chat_log_dao.get_viewership_metrics(channel_id, stream_id)) for stream_id in stream_ids])
 
     def get_spam_list(self, channel_id, stream_id, threshold):
         """Implemented for enhancement get_top_spam2. Generate and return spam based on the data stored for chat
         logs."""
         chat_logs = self.get_all_with_channel_and_stream_id(channel_id, stream_id)
-        spam_occurences = {}
-        seen_messages_and_users = []
-        spam_user_count = {}
-        for chat_log in chat_logs:
-            if chat_log.text not in spam_occurences:
-                spam_occurences[chat_log.text] = 1
-            else:
-                spam_occurences[chat_log.text] += 1
-            if (chat_log.user, chat_log.text) not in seen_messages_and_users:
-                seen_messages_and_users.append((chat_log.user, chat_log.text))
-
-                if chat_log.text not in spam_user_count:
-                    spam_user_count[chat_log.text] = 1
-                else:
-                    spam_user_count[chat_log.text] += 1
-        self.start_session()
-        self.cursor.execute("""create table if not exists temp_spam (channel_id integer NOT NULL,
-        stream_id integer NOT NULL, spam_text string, spam_occurrences integer,
-        spam_user_count integer, FOREIGN KEY(channel_id) REFERENCES channels(channel_id))""")
-        seen_messages = []
-        for chat_log in chat_logs:
-            if spam_occurences[chat_log.text] > threshold:
-                if chat_log.text not in seen_messages:
-                    spam = Spam(channel_id, stream_id, chat_log.text, spam_occurences[chat_log.text],
-                                spam_user_count[chat_log.text])
-                    seen_messages.append(chat_log.text)
-                    self.cursor.execute("insert into temp_spam values(?,?,?,?,?)",
-                                        (spam.channel_id, spam.stream_id, spam.spam_text, spam.spam_occurences,
-                                         spam.spam_user_count))
-        self.save_changes()
-        spam_list = self.cursor.execute(("""select * from temp_spam order by spam_occurrences desc, 
-        spam_user_count desc, spam_text"""))
-        result = []
-        for spam in spam_list:
-            spam_instance = self.spam_factory.from_vector(spam)
-            result.append(spam_instance)
-        self.cursor.execute("drop table if exists temp_spam")
-        self.close_session()
-        return result
+        with instrumentation.span("chat_log_dao.count_spam"):
+            occurrences = Counter(chat_log.text for chat_log in chat_logs)
+            user_counts = Counter(text for text, _ in set((chat_log.text, chat_log.user) for chat_log in chat_logs))
+            # same order as get_all_wth_channel_and_stream_id of SpamDao, without writing to the database
+            return rank_spam(channel_id, stream_id, occurrences, user_counts, threshold)
 
-    def parse_chat_times(self, chat_logs):  # pragma: no cover
-        """Convert chat_time into a datetime object in each chat log and return updated chat logs."""
-        for i in range(len(chat_logs)):  # pragma: no cover
-            chat_time = chat_logs[i].chat_time  # pragma: no cover
+    def get_spam_timeline(self, channel_id, stream_id, window_seconds, threshold, limit):
+        """
+        Overriden from ChatLogDao.
+        """
+        if not self.__create_table_if_not_exists():
+            return []
+        rows = self.cursor.execute("""select offset, text, user from chat_log where channel_id = ? and stream_id = ?
+        order by offset, rowid""", (channel_id, stream_id))
+        with instrumentation.span("chat_log_dao.spam_timeline"):
+            return spam_timeline(rows, channel_id, stream_id, window_seconds, threshold, limit)
 
-            prefix = chat_time[:chat_time.index("T")]  # pragma: no cover
-            suffix = chat_time[chat_time.index("T") + 1:][0:8]  # pragma: no cover
-            chat_time = prefix + ' ' + suffix  # pragma: no cover
+    def get_normalized_spam_list(self, channel_id, stream_id, threshold):
+        """
+        Overriden from ChatLogDao. Grouped by the stored hashes of the normalized keys.
+        """
+        if not self.__create_table_if_not_exists():
+            return []
+        if not self.__has_spam_key_columns():
+            # read only session on a table not written to since the spam keys were introduced
+            return normalized_spam_list(self.get_all_with_channel_and_stream_id(channel_id, stream_id), channel_id,
+                                        stream_id, threshold)
+        with instrumentation.span("chat_log_dao.count_normalized_spam"):
+            rows = self.cursor.execute("""select min(spam_key), count(*), count(distinct user) from chat_log
+            where channel_id = ? and stream_id = ? group by spam_hash having count(*) > ?""",
+                                       (channel_id, stream_id, threshold)).fetchall()
+            return rank_spam(channel_id, stream_id, {key: count for key, count, _ in rows},
+                             {key: user_count for key, _, user_count in rows}, threshold)
 
-            chat_logs[i].chat_time = datetime.datetime.strptime(chat_time, '%Y-%m-%d %H:%M:%S')  # pragma: no cover
+    def parse_chat_times(self, chat_logs):  # pragma: no cover
+        """Convert chat_time into a datetime object in each chat log and return updated chat logs."""
+        for chat_log in chat_logs:  # pragma: no cover
+            chat_log.chat_time = parse_chat_time(chat_log.chat_time)  # pragma: no cover
 
         return chat_logs  # pragma: no cover
 
-    def __sort_chat_log_by_minute(self, chat_logs, channel_id, stream_id):  # pragma: no cover
-        per_minute_dict = {}  # pragma: no cover
-        seen_users = {}  # pragma: no cover
-        current_offset = 1  # pragma: no cover
-        cur_total_seconds = (chat_logs[0].chat_time.time().minute * 60 +  # pragma: no cover
-                             chat_logs[0].chat_time.time().second)  # pragma: no cover
-        for chat_log in chat_logs:  # pragma: no cover
-            if (chat_log.chat_time.time().minute * 60 +   # pragma: no cover
-                    chat_log.chat_time.time().second - cur_total_seconds <= 59):  # pragma: no cover
-                pass  # pragma: no cover
-            else:  # pragma: no cover
-                current_offset += 1  # pragma: no cover
-                cur_total_seconds = (chat_log.chat_time.time().minute * 60 +   # pragma: no cover
-                                     chat_log.chat_time.time().second)  # pragma: no cover
-
-            if current_offset not in per_minute_dict:  # pragma: no cover
-                per_minute_dict[current_offset] = {"offset": current_offset, "viewers": 1,   # pragma: no cover
-                                                   "messages": 1}  # pragma: no cover
-                seen_users[current_offset] = [chat_log.user]  # pragma: no cover
-            else:  # pragma: no cover
-                per_minute_dict[current_offset]["messages"] += 1  # pragma: no cover
-                if chat_log.user not in seen_users[current_offset]:  # pragma: no cover
-                    per_minute_dict[current_offset]["viewers"] += 1  # pragma: no cover
-                    seen_users[current_offset].append(chat_log.user)  # pragma: no cover
-
-        per_minute_list = []  # pragma: no cover
-        for item in per_minute_dict.items():  # pragma: no cover
-            per_minute_list.append(item[1])  # pragma: no cover
-
-        result = [{"channel_id": channel_id, "stream_id": stream_id, "starttime": str(  # pragma: no cover
-            chat_logs[0].chat_time),  # pragma: no cover
-                   "per_minute": per_minute_list  # pragma: no cover
-                   }]  # pragma: no cover
-
-        return result  # pragma: no cover
-
     def get_viewership_metrics(self, channel_id, stream_id):  # pragma: no cover
         """Returns per minute message and viewer counts for the specified stream and channel that
         has been persisted via the storechatlog command. If no such data has been persisted, returns empty list.
         """
+        rollup = self.__get_viewership_rollup(channel_id, stream_id)  # pragma: no cover
+        if rollup:  # pragma: no cover
+            return rollup  # pragma: no cover
         chat_logs = self.get_all_with_channel_and_stream_id(channel_id, stream_id)  # pragma: no cover
         chat_logs = self.parse_chat_times(chat_logs)  # pragma: no cover
         chat_logs.sort()  # pragma: no cover
-        viewership_stats = self.__sort_chat_log_by_minute(chat_logs, channel_id, stream_id)  # pragma: no cover
+        viewership_stats = per_minute_viewership([(chat_log.chat_time, chat_log.user) for chat_log in chat_logs],
+                                                 channel_id, stream_id)  # pragma: no cover
         return viewership_stats  # pragma: no cover
 
+    def __get_viewership_rollup(self, channel_id, stream_id):
+        if not table_exists(self.cursor, "viewership_rollup"):
+            return []
+        rows = self.cursor.execute("""select start_time, minute, viewers, messages from viewership_rollup where
+        channel_id = ? and stream_id = ? order by minute""", (channel_id, stream_id)).fetchall()
+        if not rows:
+            return []
+        return [{"channel_id": channel_id, "stream_id": stream_id, "starttime": rows[0][0],
+                 "per_minute": [{"offset": minute, "viewers": viewers, "messages": messages}
+                                for _, minute, viewers, messages in rows]}]
+
+    def save_viewership_rollup(self, channel_id, stream_id, viewership):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.cursor.execute("""create table if not exists viewership_rollup (channel_id integer NOT NULL, stream_id
+        integer NOT NULL, start_time text NOT NULL, minute integer NOT NULL, viewers integer NOT NULL, messages
+        integer NOT NULL, primary key (channel_id, stream_id, minute))""")
+        self.cursor.execute("delete from viewership_rollup where channel_id = ? and stream_id = ?",
+                            (channel_id, stream_id))
+        for stream in viewership:
+            self.cursor.executemany("insert into viewership_rollup values (?,?,?,?,?,?)",
+                                    [(channel_id, stream_id, stream["starttime"], minute["offset"],
+                                      minute["viewers"], minute["messages"]) for minute in stream["per_minute"]])
+
+    def insert_full_text(self, chat_log):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.cursor.execute("""create virtual table if not exists chat_log_fts using fts5(text, user,
+        channel_id unindexed, stream_id unindexed)""")
+        self.cursor.execute("insert into chat_log_fts values (?,?,?,?)", (chat_log.text, chat_log.user,
+                                                                         int(chat_log.channel_id),
+                                                                         int(chat_log.stream_id)))
+
+    def __create_full_text_streams_table_if_not_exists(self):
+        if self.read_only:
+            return table_exists(self.cursor, "chat_log_fts_streams")
+        created = not table_exists(self.cursor, "chat_log_fts_streams")
+        self.cursor.execute("""create table if not exists chat_log_fts_streams (channel_id integer NOT NULL, stream_id
+        integer NOT NULL, primary key (channel_id, stream_id))""")
+        if created and table_exists(self.cursor, "chat_log_fts"):
+            # streams indexed before the indexed streams were recorded are indexed whole, as ingest is one transaction
+            self.cursor.execute("insert into chat_log_fts_streams " + FULL_TEXT_STREAMS_OF_INDEX)
+        return True
+
+    def __full_text_streams_table(self):
+        # read only sessions of a database indexed before the indexed streams were recorded read the index itself
+        if self.__create_full_text_streams_table_if_not_exists():
+            return "chat_log_fts_streams"
+        if table_exists(self.cursor, "chat_log_fts"):
+            return "({})".format(FULL_TEXT_STREAMS_OF_INDEX)
+        return None
+
+    def save_full_text_stream(self, channel_id, stream_id):
+        """
+        Overriden from ChatLogDao.
+        """
+        self.__create_full_text_streams_table_if_not_exists()
+        self.cursor.execute("insert or ignore into chat_log_fts_streams values (?,?)", (int(channel_id),
+                                                                                        int(stream_id)))
+
+    def __check_full_text_index(self, filters):
+        # the rows of a stream missing from the index would be left out of the result without a word
+        query = "select channel_id, stream_id from chat_log where "
+        query = self.__append_comparisons_from_filters(filters, query, ["text", "user", "chat_time"],
+                                                       self.operation_keyword_mapping)
+        full_text_streams = self.__full_text_streams_table()
+        if full_text_streams is not None:
+            query += "(channel_id, stream_id) not in (select channel_id, stream_id from {}) AND ".format(
+                full_text_streams)
+        unindexed = self.cursor.execute(query + "1 limit 1").fetchone()
+        if unindexed is not None:
+            raise ValueError("stream {} on channel {} has no full text index for the match filter, store it with "
+                             "ingest --full-text".format(unindexed[1], unindexed[0]))
+
+    def __stream_condition(self, table_name):
+        # columns of the full text index have no type affinity, and older indexes hold the ids as text
+        if table_name == "chat_log_fts":
+            return "cast(channel_id as integer) = ? and cast(stream_id as integer) = ?"
+        return "channel_id = ? and stream_id = ?"
+
     def get_all_with_channel_and_stream_id(self, channel_id, stream_id):
         """implemented for enhancement get_top_spam2. Return all the rows from chat_log table where channel id and
         stream id match given channel_id and stream_id."""
-        self.__create_table_if_not_exists()
-        rows = self.cursor.execute("select * from chat_log where channel_id = {} and stream_id = {}".
-                                   format(channel_id, stream_id))
-        chat_logs = []
-        for row in rows:
-            chat_log = self.chat_log_factory.from_vector(row)
-            chat_logs.append(chat_log)
+        if not self.__create_table_if_not_exists():
+            return []
+        with instrumentation.span("chat_log_dao.get_all_with_channel_and_stream_id"):
+            rows = self.cursor.execute("select {} from chat_log where channel_id = {} and stream_id = {} order by rowid"
+                                       .format(", ".join(CHAT_LOG_COLUMNS), channel_id, stream_id))
+            chat_logs = []
+            for row in rows:
+                chat_log = self.chat_log_factory.from_vector(row)
+                chat_logs.append(chat_log)
+        instrumentation.count("rows", "chat_log_dao.get_all_with_channel_and_stream_id", len(chat_logs))
         return chat_logs
 
     def save_changes(self):
         """Overriden from ChatLogDao."""
-        self.database_connection.commit()
+        self.connection_factory.retry(self.database_connection.commit)
 
     def insert(self, chat_log):
         """
@@ -492,9 +1508,10 @@ class ChatLogDaoSqlLiteImplementation(ChatLogDao):
         """
         self.__create_table_if_not_exists()
 
-        self.cursor.execute("insert into chat_log VALUES (?,?,?,?,?,?)", (chat_log.channel_id, chat_log.stream_id,
-                                                                          chat_log.text, chat_log.user,
-                                                                          chat_log.chat_time, chat_log.offset))
+        self.cursor.execute("""insert into chat_log (channel_id, stream_id, text, user, chat_time, offset, spam_key,
+        spam_hash) values (?,?,?,?,?,?,?,?)""", (chat_log.channel_id, chat_log.stream_id, chat_log.text, chat_log.user,
+                                                 chat_log.chat_time, chat_log.offset)
+                            + spam_normalizer.key_and_hash(chat_log.text))
 
     def delete_with_channel_id_stream_id(self, channel_id, stream_id):
         """
@@ -503,19 +1520,26 @@ class ChatLogDaoSqlLiteImplementation(ChatLogDao):
         self.__create_table_if_not_exists()
 
         self.cursor.execute("delete from chat_log where channel_id = ? and stream_id = ?", (channel_id, stream_id))
+        # rollups and full text index derived from the deleted rows
+        for table_name in ("viewership_rollup", "chat_log_fts_streams", "chat_log_fts"):
+            if table_exists(self.cursor, table_name):
+                self.cursor.execute("delete from {} where {}".format(table_name, self.__stream_condition(table_name)),
+                                    (int(channel_id), int(stream_id)))
 
     def close_session(self):
         """
         Overriden from ChatLogDao.
         """
-        self.database_connection.close()
+        self.connection_factory.release(self.database_connection)
 
-    def start_session(self):
+    def start_session(self, read_only=False):
         """
         Overriden from ChatLogDao.
         """
-        self.database_connection = sqlite3.connect(self.database_name)
+        self.read_only = read_only
+        self.database_connection = self.connection_factory.connect(self.database_name, read_only)
         self.cursor = self.database_connection.cursor()
+        self.table_ready = False
 
     def __append_comparisons_from_filters(self, filters, query, string_column_names, operation_keyword_mapping):
         for filter_arg in filters:
@@ -526,6 +1550,12 @@ class ChatLogDaoSqlLiteImplementation(ChatLogDao):
             operation = filter_arg[first_pos + 1:last_pos]
 
             fragment = column
+            if operation == "match":
+                # words of the text or user indexed by insert_full_text
+                fragment += " in (select {0} from chat_log_fts where chat_log_fts.{0} match '{1}') AND ".format(
+                    column, value)
+                query += fragment
+                continue
             fragment += operation_keyword_mapping[operation]
 
             if column in string_column_names:
@@ -540,13 +1570,19 @@ class ChatLogDaoSqlLiteImplementation(ChatLogDao):
         """
         Overriden from ChatLogDao.
         """
-        self.__create_table_if_not_exists()
+        if not self.__create_table_if_not_exists():
+            return []
+        match_filters = [filter_arg for filter_arg in filters if filter_arg.split(" ")[1:2] == ["match"]]
+        if match_filters:
+            self.__check_full_text_index([filter_arg for filter_arg in filters if filter_arg not in match_filters])
+            if not table_exists(self.cursor, "chat_log_fts"):
+                return []
 
-        query = "select * from chat_log "
+        query = "select {} from chat_log ".format(", ".join(CHAT_LOG_COLUMNS))
         if len(filters) > 0:
             query += "where "
 
-        query = self.__append_comparisons_from_filters(filters, query, ["text", "user"],
+        query = self.__append_comparisons_from_filters(filters, query, ["text", "user", "chat_time"],
                                                        self.operation_keyword_mapping)
         if len(filters) > 0:
             query = query[:-4]
@@ -559,3 +1595,1477 @@ class ChatLogDaoSqlLiteImplementation(ChatLogDao):
             chat_log = self.chat_log_factory.from_vector(row)
             chat_logs.append(chat_log)
         return chat_logs
+
+
+class IngestQueueDao:  # pragma: no cover
+    """
+    Abstract class for tool that allows to manage the persistent queue of chat export files waiting to be ingested.
+    """
+
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError  # pragma: no cover
+
+    def enqueue(self, path, size, modified_time):  # pragma: no cover
+        """Queue file at path unless that version of it, identified by size and modified_time, is already queued or
+        processed. Return whether the file was queued."""
+        raise NotImplementedError  # pragma: no cover
+
+    def claim(self):  # pragma: no cover
+        """Mark the oldest pending file as running and return its path, or None if nothing is pending."""
+        raise NotImplementedError  # pragma: no cover
+
+    def finish(self, path, state, error=None):  # pragma: no cover
+        """Set state of file at path to "done" or "failed"."""
+        raise NotImplementedError  # pragma: no cover
+
+    def requeue_running(self):  # pragma: no cover
+        """Put files left running by a process that stopped back to pending. Return their number."""
+        raise NotImplementedError  # pragma: no cover
+
+    def count_by_state(self):  # pragma: no cover
+        """Return dictionary that maps states to number of files in that state."""
+        raise NotImplementedError  # pragma: no cover
+
+    def start_session(self, read_only=False):  # pragma: no cover
+        """Start current database connection session."""
+        raise NotImplementedError  # pragma: no cover
+
+    def close_session(self):  # pragma: no cover
+        """Close current database connection session."""
+        raise NotImplementedError  # pragma: no cover
+
+    def save_changes(self):  # pragma: no cover
+        """Commit changes to the database"""
+        raise NotImplementedError  # pragma: no cover
+
+
+class IngestQueueDaoSqlLiteImplementation(IngestQueueDao):
+    """Extends IngestQueueDao abstract class"""
+
+    def __init__(self, database_name, connection_factory=default_connection_factory):
+        self.database_name = database_name
+        self.connection_factory = connection_factory
+        self.database_connection = None
+        self.cursor = None
+        self.read_only = False
+
+    def __create_table_if_not_exists(self):
+        if self.read_only:
+            return table_exists(self.cursor, "ingest_queue")
+        self.cursor.execute("""create table if not exists ingest_queue (path text primary key, size integer NOT NULL,
+        modified_time integer NOT NULL, state text NOT NULL, attempts integer NOT NULL default 0, error text,
+        queued_at real NOT NULL)""")
+        return True
+
+    def enqueue(self, path, size, modified_time):
+        """
+        Overriden from IngestQueueDao.
+        """
+        self.__create_table_if_not_exists()
+        row = self.cursor.execute("select size, modified_time from ingest_queue where path = ?", (path,)).fetchone()
+        if row is not None and tuple(row) == (size, modified_time):
+            return False
+        self.cursor.execute("insert or replace into ingest_queue (path, size, modified_time, state, queued_at) "
+                            "values (?,?,?,'pending',?)", (path, size, modified_time, time.time()))
+        return True
+
+    def claim(self):
+        """
+        Overriden from IngestQueueDao.
+        """
+        self.__create_table_if_not_exists()
+        row = self.cursor.execute("select path from ingest_queue where state = 'pending' order by queued_at, path "
+                                  "limit 1").fetchone()
+        if row is None:
+            return None
+        self.cursor.execute("update ingest_queue set state = 'running', attempts = attempts + 1 where path = ?",
+                            (row[0],))
+        return row[0]
+
+    def finish(self, path, state, error=None):
+        """
+        Overriden from IngestQueueDao.
+        """
+        self.__create_table_if_not_exists()
+        self.cursor.execute("update ingest_queue set state = ?, error = ? where path = ?", (state, error, path))
+
+    def requeue_running(self):
+        """
+        Overriden from IngestQueueDao.
+        """
+        self.__create_table_if_not_exists()
+        return self.cursor.execute("update ingest_queue set state = 'pending' where state = 'running'").rowcount
+
+    def count_by_state(self):
+        """
+        Overriden from IngestQueueDao.
+        """
+        if not self.__create_table_if_not_exists():
+            return {}
+        return dict(self.cursor.execute("select state, count(*) from ingest_queue group by state"))
+
+    def save_changes(self):
+        """Overriden from IngestQueueDao."""
+        self.connection_factory.retry(self.database_connection.commit)
+
+    def close_session(self):
+        """
+        Overriden from IngestQueueDao.
+        """
+        self.connection_factory.release(self.database_connection)
+
+    def start_session(self, read_only=False):
+        """
+        Overriden from IngestQueueDao.
+        """
+        self.read_only = read_only
+        self.database_connection = self.connection_factory.connect(self.database_name, read_only)
+        self.cursor = self.database_connection.cursor()
+
+
+# columns of chat_log read into ChatLog, in the order of its arguments
+CHAT_LOG_COLUMNS = ("channel_id", "stream_id", "text", "user", "chat_time", "offset")
+# rows of the user_activity table computed from the whole chat log
+USER_ACTIVITY_OF_CHAT_LOG = """select user, channel_id, stream_id, count(*) as messages, min(chat_time) as first_seen,
+max(chat_time) as last_seen from chat_log group by user, channel_id, stream_id"""
+# streams of the chat_log_fts_streams table found in the full text index
+FULL_TEXT_STREAMS_OF_INDEX = """select distinct cast(channel_id as integer) as channel_id, cast(stream_id as integer) as
+stream_id from chat_log_fts"""
+
+# every table created by the DAOs, dropped by purge.py
+TABLE_NAMES = ("chat_log", "top_spam", "spam_stats", "channels", "ingest_progress", "ingest_queue", "viewership_rollup",
+               "chat_log_fts", "chat_log_fts_streams", "user_activity", "chat_emote", "chat_badge")
+
+# columns written by the export command for each table it exports, and the order of the rows of a stream
+EXPORT_COLUMNS = {"chat_log": CHAT_LOG_COLUMNS,
+                  "top_spam": ("channel_id", "stream_id", "spam_text", "spam_occurrences", "spam_user_count"),
+                  "viewership_rollup": ("channel_id", "stream_id", "start_time", "minute", "viewers", "messages"),
+                  "user_activity": ("user", "channel_id", "stream_id", "messages", "first_seen", "last_seen")}
+EXPORT_ORDER = {"chat_log": "rowid", "top_spam": "spam_occurrences desc, spam_user_count desc, spam_text",
+                "viewership_rollup": "minute", "user_activity": "messages desc, user"}
+
+
+class DatabaseMaintenanceDao:  # pragma: no cover
+    """
+    Abstract class for keeping the storage of the other DAOs compact and its statistics current.
+    """
+
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError  # pragma: no cover
+
+    def get_storage_stats(self):  # pragma: no cover
+        """Return dictionary with number of pages, number of free pages and page size of the storage."""
+        raise NotImplementedError  # pragma: no cover
+
+    def vacuum_incrementally(self, pages):  # pragma: no cover
+        """Give at most pages free pages back to the file system. Return number of pages given back."""
+        raise NotImplementedError  # pragma: no cover
+
+    def analyze(self, analysis_limit):  # pragma: no cover
+        """Update the statistics of the query planner, looking at about analysis_limit rows of every index."""
+        raise NotImplementedError  # pragma: no cover
+
+    def drop_tables(self, table_names):  # pragma: no cover
+        """Drop the tables of table_names that exist."""
+        raise NotImplementedError  # pragma: no cover
+
+    def start_session(self, read_only=False):  # pragma: no cover
+        """Start maintenance session."""
+        raise NotImplementedError  # pragma: no cover
+
+    def close_session(self):  # pragma: no cover
+        """Close maintenance session."""
+        raise NotImplementedError  # pragma: no cover
+
+    def save_changes(self):  # pragma: no cover
+        """Commit the changes."""
+        raise NotImplementedError  # pragma: no cover
+
+
+class DatabaseMaintenanceDaoSqlLiteImplementation(DatabaseMaintenanceDao):
+    """Extends DatabaseMaintenanceDao abstract class"""
+
+    def __init__(self, database_name, connection_factory=default_connection_factory):
+        self.database_name = database_name
+        self.connection_factory = connection_factory
+        self.database_connection = None
+        self.cursor = None
+
+    def get_storage_stats(self):
+        """
+        Overriden from DatabaseMaintenanceDao.
+        """
+        return {name: self.cursor.execute("pragma {}".format(name)).fetchone()[0]
+                for name in ("page_count", "freelist_count", "page_size")}
+
+    def vacuum_incrementally(self, pages):
+        """
+        Overriden from DatabaseMaintenanceDao. Databases created without incremental auto vacuum are converted by
+        one full VACUUM, which blocks writers while it copies the database.
+        """
+        free_pages = self.cursor.execute("pragma freelist_count").fetchone()[0]
+        if self.cursor.execute("pragma auto_vacuum").fetchone()[0] != 2:
+            self.save_changes()
+            self.cursor.execute("pragma auto_vacuum = incremental")
+            self.connection_factory.retry(lambda: self.cursor.execute("vacuum"))
+        else:
+            self.cursor.execute("pragma incremental_vacuum({})".format(int(pages))).fetchall()
+        return free_pages - self.cursor.execute("pragma freelist_count").fetchone()[0]
+
+    def analyze(self, analysis_limit):
+        """
+        Overriden from DatabaseMaintenanceDao.
+        """
+        self.cursor.execute("pragma analysis_limit = {}".format(int(analysis_limit)))
+        self.cursor.execute("analyze")
+
+    def drop_tables(self, table_names):
+        """
+        Overriden from DatabaseMaintenanceDao.
+        """
+        for table_name in table_names:
+            self.cursor.execute("drop table if exists {}".format(table_name))
+
+    def save_changes(self):
+        """Overriden from DatabaseMaintenanceDao."""
+        self.connection_factory.retry(self.database_connection.commit)
+
+    def close_session(self):
+        """
+        Overriden from DatabaseMaintenanceDao.
+        """
+        self.connection_factory.release(self.database_connection)
+
+    def start_session(self, read_only=False):
+        """
+        Overriden from DatabaseMaintenanceDao.
+        """
+        self.database_connection = self.connection_factory.connect(self.database_name, read_only)
+        # the pragmas read by maintenance are no results of the command
+        self.cursor = uncounted_cursor(self.database_connection)
+
+
+class ShardRouter:
+    """Routes every channel to its own SQLite database file inside shard_directory."""
+
+    def __init__(self, shard_directory):
+        self.shard_directory = shard_directory
+        os.makedirs(shard_directory, exist_ok=True)
+
+    def database_name(self, channel_id):
+        """Return name of the database file that stores rows of given channel_id."""
+        return os.path.join(self.shard_directory, "channel_{}.db".format(int(channel_id)))
+
+    def all_database_names(self):
+        """Return names of the database files of all the existing shards."""
+        return sorted(glob.glob(os.path.join(self.shard_directory, "channel_*.db")))
+
+
+class ShardFanOutExecutor:
+    """Runs a function against several shards, or several streams of one database, in parallel, each with its own
+    DAO and connection."""
+
+    def __init__(self, shard_dao_class, max_workers=None):
+        self.shard_dao_class = shard_dao_class
+        self.max_workers = max_workers
+
+    def __run_on_shard(self, database_name, function, budget):
+        # connections cannot be shared between the threads, so every shard gets a connection of its own, enforcing
+        # the budget of the thread that submitted the task
+        with query_budget(budget):
+            shard_dao = self.shard_dao_class(database_name)
+            shard_dao.start_session(read_only=True)
+            try:
+                return function(shard_dao)
+            finally:
+                shard_dao.close_session()
+
+    def map(self, database_names, function):
+        """Call function with a DAO of every shard in database_names and return the results in the same order."""
+        return self.starmap([(database_name, function) for database_name in database_names])
+
+    def starmap(self, tasks):
+        """Call the function of every (database name, function) pair in tasks with a DAO of its own for the
+        database and return the results in the same order."""
+        if len(tasks) <= 1:
+            return [self.__run_on_shard(database_name, function, current_query_budget())
+                    for database_name, function in tasks]
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.__run_on_shard, database_name, function, current_query_budget())
+                       for database_name, function in tasks]
+            return [future.result() for future in futures]
+
+
+class ShardedDaoBase:
+    """Keeps one session of shard_dao_class per channel shard opened during the current session."""
+
+    def __init__(self, shard_router, shard_dao_class, connection_factory=default_connection_factory):
+        self.shard_router = shard_router
+        self.shard_dao_class = shard_dao_class
+        self.connection_factory = connection_factory
+        self.shard_daos = {}
+        self.read_only = False
+
+    def get_shard(self, channel_id):
+        """Return DAO for the shard of given channel_id, starting its session on first use."""
+        database_name = self.shard_router.database_name(channel_id)
+        if database_name not in self.shard_daos:
+            shard_dao = self.shard_dao_class(database_name, self.connection_factory)
+            shard_dao.start_session(self.read_only)
+            self.shard_daos[database_name] = shard_dao
+        return self.shard_daos[database_name]
+
+    def start_session(self, read_only=False):
+        """Shards are opened lazily by get_shard."""
+        self.read_only = read_only
+        self.shard_daos = {}
+
+    def save_changes(self):
+        """Commit changes of every shard used in the current session."""
+        for shard_dao in self.shard_daos.values():
+            shard_dao.save_changes()
+
+    def close_session(self):
+        """Close every shard used in the current session."""
+        for shard_dao in self.shard_daos.values():
+            shard_dao.close_session()
+        self.shard_daos = {}
+
+
+class ChannelDaoShardedImplementation(ShardedDaoBase, ChannelDao):
+    """Extends ChannelDao abstract class. Stores every channel in its own shard."""
+
+    def __init__(self, shard_router, connection_factory=default_connection_factory):
+        ShardedDaoBase.__init__(self, shard_router, ChannelDaoSqlLiteImplementation, connection_factory)
+
+    def insert(self, channel):
+        """Overriden from ChannelDao."""
+        self.get_shard(channel.id).insert(channel)
+
+    def find_by_id(self, channel_id):
+        """Overriden from ChannelDao."""
+        return self.get_shard(channel_id).find_by_id(channel_id)
+
+
+class DatabaseMaintenanceDaoShardedImplementation(ShardedDaoBase, DatabaseMaintenanceDao):
+    """Extends DatabaseMaintenanceDao abstract class. Maintains every existing shard."""
+
+    def __init__(self, shard_router, connection_factory=default_connection_factory):
+        ShardedDaoBase.__init__(self, shard_router, DatabaseMaintenanceDaoSqlLiteImplementation, connection_factory)
+
+    def __all_shards(self):
+        for database_name in self.shard_router.all_database_names():
+            if database_name not in self.shard_daos:
+                shard_dao = self.shard_dao_class(database_name, self.connection_factory)
+                shard_dao.start_session(self.read_only)
+                self.shard_daos[database_name] = shard_dao
+        return list(self.shard_daos.values())
+
+    def get_storage_stats(self):
+        """Overriden from DatabaseMaintenanceDao. Pages are summed over the shards."""
+        storage_stats = {"page_count": 0, "freelist_count": 0, "page_size": 0}
+        for shard_dao in self.__all_shards():
+            shard_stats = shard_dao.get_storage_stats()
+            storage_stats["page_count"] += shard_stats["page_count"]
+            storage_stats["freelist_count"] += shard_stats["freelist_count"]
+            storage_stats["page_size"] = max(storage_stats["page_size"], shard_stats["page_size"])
+        return storage_stats
+
+    def vacuum_incrementally(self, pages):
+        """Overriden from DatabaseMaintenanceDao. Every shard gives back at most pages free pages."""
+        return sum(shard_dao.vacuum_incrementally(pages) for shard_dao in self.__all_shards())
+
+    def analyze(self, analysis_limit):
+        """Overriden from DatabaseMaintenanceDao."""
+        for shard_dao in self.__all_shards():
+            shard_dao.analyze(analysis_limit)
+
+    def drop_tables(self, table_names):
+        """Overriden from DatabaseMaintenanceDao."""
+        for shard_dao in self.__all_shards():
+            shard_dao.drop_tables(table_names)
+
+
+class SpamDaoShardedImplementation(ShardedDaoBase, SpamDao):
+    """Extends SpamDao abstract class. Stores spam of every channel in the shard of the channel."""
+
+    def __init__(self, shard_router, connection_factory=default_connection_factory):
+        ShardedDaoBase.__init__(self, shard_router, SpamDaoSqlLiteImplementation, connection_factory)
+
+    def get_all_wth_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from SpamDao."""
+        return self.get_shard(channel_id).get_all_wth_channel_and_stream_id(channel_id, stream_id)
+
+    def insert(self, spam):
+        """Overriden from SpamDao."""
+        self.get_shard(spam.channel_id).insert(spam)
+
+    def delete_with_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from SpamDao."""
+        self.get_shard(channel_id).delete_with_channel_and_stream_id(channel_id, stream_id)
+
+    def export_tables(self, tasks, export):
+        """Overriden from SpamDao."""
+        return [self.get_shard(task[1]).export_tables([task], export)[0] for task in tasks]
+
+    def insert_spam_stats(self, comments_count, comments_user_count, channel_id, stream_id):
+        """Overriden from SpamDao."""
+        return self.get_shard(channel_id).insert_spam_stats(comments_count, comments_user_count, channel_id,
+                                                            stream_id)
+
+    def get_top_spam(self, channel_id, stream_id, threshold, limit=None):
+        """Overriden from SpamDao."""
+        return self.get_shard(channel_id).get_top_spam(channel_id, stream_id, threshold, limit)
+
+    def sort_and_insert_spam(self, comments_count, comments_user_count, channel_id, stream_id, threshold=10,
+                             reverse=True):
+        """Overriden from SpamDao."""
+        return self.get_shard(channel_id).sort_and_insert_spam(comments_count, comments_user_count, channel_id,
+                                                               stream_id, threshold, reverse)
+
+
+class ChatLogDaoShardedImplementation(ShardedDaoBase, ChatLogDao):
+    """Extends ChatLogDao abstract class. Stores chat log of every channel in the shard of the channel and fans
+    queries that are not restricted to a single channel out to all the shards."""
+
+    def __init__(self, shard_router, connection_factory=default_connection_factory, max_workers=None):
+        ShardedDaoBase.__init__(self, shard_router, ChatLogDaoSqlLiteImplementation, connection_factory)
+        self.fan_out_executor = ShardFanOutExecutor(ChatLogDaoSqlLiteImplementation, max_workers)
+
+    def insert(self, chat_log):
+        """Overriden from ChatLogDao."""
+        self.get_shard(chat_log.channel_id).insert(chat_log)
+
+    def delete_with_channel_id_stream_id(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.get_shard(channel_id).delete_with_channel_id_stream_id(channel_id, stream_id)
+
+    def get_all_with_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_all_with_channel_and_stream_id(channel_id, stream_id)
+
+    def get_spam_list(self, channel_id, stream_id, threshold):
+        """Generate and return spam based on the chat log stored in the shard of channel_id."""
+        return self.get_shard(channel_id).get_spam_list(channel_id, stream_id, threshold)
+
+    def get_spam_timeline(self, channel_id, stream_id, window_seconds, threshold, limit):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_spam_timeline(channel_id, stream_id, window_seconds, threshold, limit)
+
+    def get_normalized_spam_list(self, channel_id, stream_id, threshold):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_normalized_spam_list(channel_id, stream_id, threshold)
+
+    def get_viewership_metrics(self, channel_id, stream_id):  # pragma: no cover
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_viewership_metrics(channel_id, stream_id)  # pragma: no cover
+
+    def parse_chat_times(self, chat_logs):  # pragma: no cover
+        """Overriden from ChatLogDao."""
+        return self.shard_dao_class(":memory:").parse_chat_times(chat_logs)  # pragma: no cover
+
+    def get_checkpoint(self, source_name, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_checkpoint(source_name, channel_id, stream_id)
+
+    def save_checkpoint(self, source_name, channel_id, stream_id, comment_index):
+        """Overriden from ChatLogDao."""
+        self.get_shard(channel_id).save_checkpoint(source_name, channel_id, stream_id, comment_index)
+
+    def save_viewership_rollup(self, channel_id, stream_id, viewership):
+        """Overriden from ChatLogDao."""
+        self.get_shard(channel_id).save_viewership_rollup(channel_id, stream_id, viewership)
+
+    def insert_full_text(self, chat_log):
+        """Overriden from ChatLogDao."""
+        self.get_shard(chat_log.channel_id).insert_full_text(chat_log)
+
+    def save_full_text_stream(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.get_shard(channel_id).save_full_text_stream(channel_id, stream_id)
+
+    def get_stream_ids(self, channel_id, limit=None):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_stream_ids(channel_id, limit)
+
+    def count_messages_by_user(self, channel_id, stream_ids):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).count_messages_by_user(channel_id, stream_ids)
+
+    def get_viewership_by_stream(self, channel_id, stream_ids):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_viewership_by_stream(channel_id, stream_ids)
+
+    def refresh_user_activity(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.get_shard(channel_id).refresh_user_activity(channel_id, stream_id)
+
+    def get_top_chatters(self, channel_id, stream_id, limit):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_top_chatters(channel_id, stream_id, limit)
+
+    def insert_emotes(self, emotes):
+        """Overriden from ChatLogDao."""
+        for emote in emotes:
+            self.get_shard(emote[0]).insert_emotes([emote])
+
+    def insert_badges(self, badges):
+        """Overriden from ChatLogDao."""
+        for badge in badges:
+            self.get_shard(badge[0]).insert_badges([badge])
+
+    def delete_emotes_and_badges(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.get_shard(channel_id).delete_emotes_and_badges(channel_id, stream_id)
+
+    def get_top_emotes_per_minute(self, channel_id, stream_id, limit):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_top_emotes_per_minute(channel_id, stream_id, limit)
+
+    def get_badge_share(self, channel_id, stream_id, badge):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).get_badge_share(channel_id, stream_id, badge)
+
+    def get_last_chat_times(self, channel_id=None):
+        """Overriden from ChatLogDao. Without channel_id queries the shards in parallel."""
+        if channel_id is not None:
+            return self.get_shard(channel_id).get_last_chat_times(channel_id)
+        last_chat_times = {}
+        for shard_last_chat_times in self.fan_out_executor.map(self.shard_router.all_database_names(),
+                                                               lambda shard_dao: shard_dao.get_last_chat_times()):
+            last_chat_times.update(shard_last_chat_times)
+        return last_chat_times
+
+    def delete_stream_batch(self, channel_id, stream_id, batch_size):
+        """Overriden from ChatLogDao."""
+        return self.get_shard(channel_id).delete_stream_batch(channel_id, stream_id, batch_size)
+
+    def export_tables(self, tasks, export, max_workers=None):
+        """Overriden from ChatLogDao. Every table is read in parallel from the shard of its channel."""
+        fan_out_executor = ShardFanOutExecutor(ChatLogDaoSqlLiteImplementation, max_workers)
+        return fan_out_executor.starmap(
+            [(self.shard_router.database_name(task[1]), lambda shard_dao, task=task: shard_dao.export_tables(
+                [task], export)[0]) for task in tasks])
+
+    def get_user_activity(self, user):
+        """Overriden from ChatLogDao. Queries the shards in parallel."""
+        shard_results = self.fan_out_executor.map(self.shard_router.all_database_names(),
+                                                  lambda shard_dao: shard_dao.get_user_activity(user))
+        return sorted((activity for shard_result in shard_results for activity in shard_result),
+                      key=lambda activity: (activity["first_seen"], activity["channel_id"], activity["stream_id"]))
+
+    def get_recent_messages(self, user, limit):
+        """Overriden from ChatLogDao. Queries the shards in parallel."""
+        shard_results = self.fan_out_executor.map(self.shard_router.all_database_names(),
+                                                  lambda shard_dao: shard_dao.get_recent_messages(user, limit))
+        chat_logs = list(heapq.merge(*shard_results, key=lambda chat_log: chat_log.chat_time))
+        return chat_logs[max(len(chat_logs) - limit, 0):]
+
+    def __shards_for_filters(self, filters):
+        for filter_arg in filters:
+            parts = filter_arg.split(" ")
+            if len(parts) == 3 and parts[0] == "channel_id" and parts[1] == "eq" and parts[2].lstrip("-").isdigit():
+                database_name = self.shard_router.database_name(parts[2])
+                return [database_name] if os.path.exists(database_name) else []
+        return self.shard_router.all_database_names()
+
+    def select_where_filter_conditions_are_satisfied(self, filters):
+        """
+        Overriden from ChatLogDao. Queries the shards in parallel and merges their results by chat_time.
+        """
+        shard_results = self.fan_out_executor.map(
+            self.__shards_for_filters(filters),
+            lambda shard_dao: shard_dao.select_where_filter_conditions_are_satisfied(filters))
+        return list(heapq.merge(*shard_results, key=lambda chat_log: chat_log.chat_time))
+
+
+class ChatLogDaoArchiveImplementation(ChatLogDao):
+    """Extends ChatLogDao abstract class. Chat logs of streams moved to the archive by archive_stream are read from
+    their segment files in archive_directory, everything else is delegated to chat_log_dao."""
+
+    def __init__(self, chat_log_dao, archive_directory):
+        self.chat_log_dao = chat_log_dao
+        self.archive_directory = archive_directory
+        self.filter_operations = {"eq": lambda a, b: a == b, "gt": lambda a, b: a > b, "lt": lambda a, b: a < b,
+                                  "gteq": lambda a, b: a >= b, "lteq": lambda a, b: a <= b}
+
+    def segment_name(self, channel_id, stream_id):
+        """Return name of the segment file of given stream."""
+        return os.path.join(self.archive_directory, "{}_{}.seg".format(int(channel_id), int(stream_id)))
+
+    def open_segment(self, channel_id, stream_id):
+        """Return ChatLogSegment of given stream, or None if the stream is not archived."""
+        segment_name = self.segment_name(channel_id, stream_id)
+        if not os.path.exists(segment_name):
+            return None
+        return ChatLogSegment(segment_name)
+
+    def archive_stream(self, channel_id, stream_id):
+        """Move chat log of given stream from the database to its segment file. The segment is written before the
+        rows are deleted, so a process stopped before the deletion is committed leaves the stream in both, and
+        archiving it again finishes the move. Return number of rows and size of the segment, or None if the stream has
+        no chat log."""
+        chat_logs = self.chat_log_dao.get_all_with_channel_and_stream_id(channel_id, stream_id)
+        if not chat_logs:
+            return None
+        os.makedirs(self.archive_directory, exist_ok=True)
+        size = write_chat_log_segment(self.segment_name(channel_id, stream_id), int(channel_id), int(stream_id),
+                                      chat_logs)
+        self.chat_log_dao.delete_with_channel_id_stream_id(channel_id, stream_id)
+        return len(chat_logs), size
+
+    def restore_stream(self, channel_id, stream_id):
+        """Insert chat log of given archived stream back into the database. The segment file is removed by
+        remove_segment once the rows are committed. Return number of rows, or None if the stream is not archived."""
+        segment = self.open_segment(channel_id, stream_id)
+        if segment is None:
+            return None
+        with segment:
+            chat_logs = segment.chat_logs()
+        self.chat_log_dao.delete_with_channel_id_stream_id(channel_id, stream_id)
+        for chat_log in chat_logs:
+            self.chat_log_dao.insert(chat_log)
+        return len(chat_logs)
+
+    def is_archived(self, channel_id, stream_id):
+        """Return whether the chat log of given stream is in a segment file."""
+        return os.path.exists(self.segment_name(channel_id, stream_id))
+
+    def remove_segment(self, channel_id, stream_id):
+        """Remove segment file of given stream if there is one."""
+        try:
+            os.remove(self.segment_name(channel_id, stream_id))
+        except FileNotFoundError:
+            pass
+
+    def insert(self, chat_log):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.insert(chat_log)
+
+    def delete_with_channel_id_stream_id(self, channel_id, stream_id):
+        """Overriden from ChatLogDao. Also removes the segment of the stream, so that storing it again does not
+        duplicate its chat log."""
+        self.chat_log_dao.delete_with_channel_id_stream_id(channel_id, stream_id)
+        self.remove_segment(channel_id, stream_id)
+
+    def get_all_with_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        segment = self.open_segment(channel_id, stream_id)
+        if segment is None:
+            return self.chat_log_dao.get_all_with_channel_and_stream_id(channel_id, stream_id)
+        with segment:
+            return segment.chat_logs()
+
+    def get_spam_list(self, channel_id, stream_id, threshold):
+        """Generate and return spam of the stream, counted on the id columns of its segment if it is archived."""
+        segment = self.open_segment(channel_id, stream_id)
+        if segment is None:
+            return self.chat_log_dao.get_spam_list(channel_id, stream_id, threshold)
+        with segment, instrumentation.span("chat_log_dao.count_spam"):
+            return segment.spam_list(channel_id, stream_id, threshold)
+
+    def get_spam_timeline(self, channel_id, stream_id, window_seconds, threshold, limit):
+        """Overriden from ChatLogDao."""
+        segment = self.open_segment(channel_id, stream_id)
+        if segment is None:
+            return self.chat_log_dao.get_spam_timeline(channel_id, stream_id, window_seconds, threshold, limit)
+        with segment:
+            chat_logs = sorted(segment.chat_logs(), key=lambda chat_log: sqlite_sort_key(chat_log.offset))
+        with instrumentation.span("chat_log_dao.spam_timeline"):
+            return spam_timeline(((chat_log.offset, chat_log.text, chat_log.user) for chat_log in chat_logs),
+                                 channel_id, stream_id, window_seconds, threshold, limit)
+
+    def get_normalized_spam_list(self, channel_id, stream_id, threshold):
+        """Overriden from ChatLogDao. Segments keep no spam keys, so the texts of archived streams are normalized
+        again."""
+        segment = self.open_segment(channel_id, stream_id)
+        if segment is None:
+            return self.chat_log_dao.get_normalized_spam_list(channel_id, stream_id, threshold)
+        with segment, instrumentation.span("chat_log_dao.count_normalized_spam"):
+            return normalized_spam_list(segment.chat_logs(), channel_id, stream_id, threshold)
+
+    def get_viewership_metrics(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        segment = self.open_segment(channel_id, stream_id)
+        if segment is None:
+            return self.chat_log_dao.get_viewership_metrics(channel_id, stream_id)  # pragma: no cover
+        with segment:
+            seconds = segment.seconds()
+            if seconds is None:
+                chat_times = [parse_chat_time(chat_time) for chat_time in segment.chat_times()]  # pragma: no cover
+            else:
+                epoch = datetime.datetime(1970, 1, 1)
+                chat_times = [epoch + datetime.timedelta(seconds=second) for second in seconds]
+            # user ids stand in for the users, as only distinct users are counted
+            chat_times_and_users = sorted(zip(chat_times, segment.column("user_ids")),
+                                          key=lambda chat_time_and_user: chat_time_and_user[0])
+        if not chat_times_and_users:
+            return []  # pragma: no cover
+        return per_minute_viewership(chat_times_and_users, channel_id, stream_id)
+
+    def parse_chat_times(self, chat_logs):  # pragma: no cover
+        """Overriden from ChatLogDao."""
+        return self.chat_log_dao.parse_chat_times(chat_logs)  # pragma: no cover
+
+    def __archived_stream_ids(self, channel_id):
+        prefix = "{}_".format(int(channel_id))
+        return [int(os.path.basename(segment_name)[len(prefix):-len(".seg")]) for segment_name in
+                glob.glob(os.path.join(self.archive_directory, prefix + "*.seg"))]
+
+    def get_stream_ids(self, channel_id, limit=None):
+        """Overriden from ChatLogDao. Includes the archived streams."""
+        stream_ids = set(self.chat_log_dao.get_stream_ids(channel_id)) | set(self.__archived_stream_ids(channel_id))
+        return sorted(stream_ids, reverse=True)[:limit]
+
+    def __map_streams(self, channel_id, stream_ids, from_database, from_segment):
+        # archived streams are read from their segments, the others by a single call of from_database
+        archived_stream_ids = set(stream_id for stream_id in stream_ids
+                                  if os.path.exists(self.segment_name(channel_id, stream_id)))
+        database_results = iter(from_database([stream_id for stream_id in stream_ids
+                                               if stream_id not in archived_stream_ids]))
+        results = []
+        for stream_id in stream_ids:
+            if stream_id in archived_stream_ids:
+                with self.open_segment(channel_id, stream_id) as segment:
+                    results.append(from_segment(segment, stream_id))
+            else:
+                results.append(next(database_results))
+        return results
+
+    def refresh_user_activity(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.refresh_user_activity(channel_id, stream_id)
+
+    def get_top_chatters(self, channel_id, stream_id, limit):
+        """Overriden from ChatLogDao."""
+        return self.chat_log_dao.get_top_chatters(channel_id, stream_id, limit)
+
+    def get_user_activity(self, user):
+        """Overriden from ChatLogDao."""
+        return self.chat_log_dao.get_user_activity(user)
+
+    def __streams_of(self, chat_logs):
+        # a stream both in the database and in a segment was being archived when the process stopped, and the
+        # segment, written from the same rows, is skipped until archive_stream finishes the move
+        return set((int(chat_log.channel_id), int(chat_log.stream_id)) for chat_log in chat_logs)
+
+    def get_recent_messages(self, user, limit):
+        """Overriden from ChatLogDao. Merges the messages of the database with those of the segments of the streams
+        the user chatted in, which the user activity keeps after archiving."""
+        chat_logs = self.chat_log_dao.get_recent_messages(user, limit)
+        if not os.path.isdir(self.archive_directory):
+            return chat_logs
+        user = sqlite_numeric_affinity(user)
+        database_streams = self.__streams_of(chat_logs)
+        archived_chat_logs = []
+        for activity in self.chat_log_dao.get_user_activity(user):
+            segment = None
+            if (int(activity["channel_id"]), int(activity["stream_id"])) not in database_streams:
+                segment = self.open_segment(activity["channel_id"], activity["stream_id"])
+            if segment is None:
+                continue
+            with segment:
+                archived_chat_logs.extend(segment.user_chat_logs(
+                    lambda segment_user: sqlite_numeric_affinity(segment_user) == user))
+        archived_chat_logs.sort(key=lambda chat_log: chat_log.chat_time)
+        chat_logs = list(heapq.merge(chat_logs, archived_chat_logs, key=lambda chat_log: chat_log.chat_time))
+        return chat_logs[max(len(chat_logs) - limit, 0):]
+
+    def insert_emotes(self, emotes):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.insert_emotes(emotes)
+
+    def insert_badges(self, badges):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.insert_badges(badges)
+
+    def delete_emotes_and_badges(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.delete_emotes_and_badges(channel_id, stream_id)
+
+    def get_top_emotes_per_minute(self, channel_id, stream_id, limit):
+        """Overriden from ChatLogDao."""
+        return self.chat_log_dao.get_top_emotes_per_minute(channel_id, stream_id, limit)
+
+    def get_badge_share(self, channel_id, stream_id, badge):
+        """Overriden from ChatLogDao."""
+        return self.chat_log_dao.get_badge_share(channel_id, stream_id, badge)
+
+    def get_last_chat_times(self, channel_id=None):
+        """Overriden from ChatLogDao. Includes the archived streams."""
+        last_chat_times = self.chat_log_dao.get_last_chat_times(channel_id)
+        pattern = "*_*.seg" if channel_id is None else "{}_*.seg".format(int(channel_id))
+        for segment_name in glob.glob(os.path.join(self.archive_directory, pattern)):
+            with ChatLogSegment(segment_name) as segment:
+                last_chat_times[(segment.channel_id, segment.stream_id)] = segment.last_chat_time()
+        return last_chat_times
+
+    def delete_stream_batch(self, channel_id, stream_id, batch_size):
+        """Overriden from ChatLogDao. Removes the segment of the stream once the database holds nothing of it."""
+        deleted = self.chat_log_dao.delete_stream_batch(channel_id, stream_id, batch_size)
+        if not deleted:
+            self.remove_segment(channel_id, stream_id)
+        return deleted
+
+    def export_tables(self, tasks, export, max_workers=None):
+        """Overriden from ChatLogDao. Chat logs of archived streams are read from their segments."""
+        archived_tasks = set(task for task in tasks if task[0] == "chat_log" and self.is_archived(task[1], task[2]))
+        database_results = iter(self.chat_log_dao.export_tables([task for task in tasks if task not in archived_tasks],
+                                                                export, max_workers))
+        results = []
+        for task in tasks:
+            if task in archived_tasks:
+                with self.open_segment(task[1], task[2]) as segment:
+                    rows = ((chat_log.channel_id, chat_log.stream_id, chat_log.text, chat_log.user,
+                             chat_log.chat_time, chat_log.offset) for chat_log in segment.chat_logs())
+                    results.append(export(*task, EXPORT_COLUMNS["chat_log"], rows))
+            else:
+                results.append(next(database_results))
+        return results
+
+    def count_messages_by_user(self, channel_id, stream_ids):
+        """Overriden from ChatLogDao."""
+        return self.__map_streams(
+            channel_id, stream_ids,
+            lambda database_stream_ids: self.chat_log_dao.count_messages_by_user(channel_id, database_stream_ids),
+            lambda segment, stream_id: segment.count_messages_by_user())
+
+    def get_viewership_by_stream(self, channel_id, stream_ids):
+        """Overriden from ChatLogDao."""
+        return self.__map_streams(
+            channel_id, stream_ids,
+            lambda database_stream_ids: self.chat_log_dao.get_viewership_by_stream(channel_id, database_stream_ids),
+            lambda segment, stream_id: self.get_viewership_metrics(channel_id, stream_id))
+
+    def get_checkpoint(self, source_name, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        return self.chat_log_dao.get_checkpoint(source_name, channel_id, stream_id)
+
+    def save_checkpoint(self, source_name, channel_id, stream_id, comment_index):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.save_checkpoint(source_name, channel_id, stream_id, comment_index)
+
+    def save_viewership_rollup(self, channel_id, stream_id, viewership):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.save_viewership_rollup(channel_id, stream_id, viewership)
+
+    def insert_full_text(self, chat_log):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.insert_full_text(chat_log)
+
+    def save_full_text_stream(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.save_full_text_stream(channel_id, stream_id)
+
+    def __matches_filters(self, chat_log, filters):
+        for filter_arg in filters:
+            first_pos = filter_arg.index(" ")
+            last_pos = filter_arg.rindex(" ")
+            column = filter_arg[0:first_pos]
+            value = filter_arg[last_pos + 1:]
+            operation = filter_arg[first_pos + 1:last_pos]
+            column_value = getattr(chat_log, column)
+
+            if operation == "match":
+                # archived streams are not in the full text index, so their messages are tokenized as FTS5 does
+                tokens = full_text_tokens(value)
+                if not tokens or not tokens <= full_text_tokens(column_value):
+                    return False
+                continue
+            if operation == "like":
+                if re.fullmatch(like_pattern(value), str(column_value), re.IGNORECASE | re.DOTALL) is None:
+                    return False
+                continue
+            if column not in ("text", "user", "chat_time"):
+                try:
+                    value = float(value)
+                except ValueError:
+                    return False
+            if not self.filter_operations[operation](column_value, value):
+                return False
+        return True
+
+    def __select_from_segments(self, filters, database_streams):
+        restrictions = {}
+        for filter_arg in filters:
+            parts = filter_arg.split(" ")
+            if len(parts) == 3 and parts[0] in ("channel_id", "stream_id") and parts[1] == "eq":
+                restrictions[parts[0]] = parts[2]
+
+        chat_logs = []
+        for segment_name in sorted(glob.glob(os.path.join(self.archive_directory, "*.seg"))):
+            channel_id, stream_id = os.path.basename(segment_name)[:-len(".seg")].split("_")
+            if restrictions.get("channel_id", channel_id) != channel_id or \
+                    restrictions.get("stream_id", stream_id) != stream_id or \
+                    (int(channel_id), int(stream_id)) in database_streams:
+                continue
+            with ChatLogSegment(segment_name) as segment:
+                chat_logs.extend(chat_log for chat_log in segment.chat_logs()
+                                 if self.__matches_filters(chat_log, filters))
+        chat_logs.sort(key=lambda chat_log: chat_log.chat_time)
+        return chat_logs
+
+    def select_where_filter_conditions_are_satisfied(self, filters):
+        """
+        Overriden from ChatLogDao. Merges the chat log of the database with the matching rows of the segments, which
+        are skipped when the filters name another channel or stream, or when the database still holds the stream.
+        """
+        chat_logs = self.chat_log_dao.select_where_filter_conditions_are_satisfied(filters)
+        if not os.path.isdir(self.archive_directory):
+            return chat_logs
+        return list(heapq.merge(chat_logs, self.__select_from_segments(filters, self.__streams_of(chat_logs)),
+                                key=lambda chat_log: chat_log.chat_time))
+
+    def start_session(self, read_only=False):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.start_session(read_only)
+
+    def save_changes(self):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.save_changes()
+
+    def close_session(self):
+        """Overriden from ChatLogDao."""
+        self.chat_log_dao.close_session()
+
+
+class MemoryDatabase:
+    """Tables of the in-memory DAOs. DAOs given the same MemoryDatabase see each other's rows, like DAOs of one
+    SQLite database do, until the process exits."""
+
+    def __init__(self):
+        self.channels = {}
+        # (channel_id, stream_id) -> rows of the stream
+        self.top_spam = {}
+        self.spam_stats = {}
+        self.chat_log = {}
+        self.full_text = {}
+        # stream -> True once every message of the stream is in full_text
+        self.full_text_streams = {}
+        self.viewership_rollup = {}
+        self.user_activity = {}
+        self.chat_emote = {}
+        self.chat_badge = {}
+        # user -> chat logs of the user in order of insertion
+        self.chat_log_user = {}
+        # source name -> (channel_id, stream_id, comment_index)
+        self.ingest_progress = {}
+
+    def drop(self, table_name):
+        """Remove every row of table_name, if the memory keeps such a table."""
+        table_name = {"chat_log_fts": "full_text", "chat_log_fts_streams": "full_text_streams"}.get(table_name,
+                                                                                                 table_name)
+        if isinstance(getattr(self, table_name, None), dict):
+            getattr(self, table_name).clear()
+            if table_name == "chat_log":
+                self.chat_log_user.clear()
+
+
+class MemoryChatLogStream:
+    """Chat log of one stream kept in memory, both in order of insertion and sorted by chat time."""
+
+    def __init__(self):
+        self.rows = []
+        self.time_keys = []
+        self.rows_by_time = []
+
+    def append(self, chat_log):
+        """Add chat_log. Chat logs of equal chat time keep their order of insertion."""
+        key = sqlite_sort_key(chat_log.chat_time)
+        position = bisect.bisect_right(self.time_keys, key)
+        self.rows.append(chat_log)
+        self.time_keys.insert(position, key)
+        self.rows_by_time.insert(position, chat_log)
+
+    def rows_in_time_range(self, low=None, high=None):
+        """Return chat logs sorted by chat time whose sort keys are within [low, high], both optional."""
+        start = 0 if low is None else bisect.bisect_left(self.time_keys, low)
+        end = len(self.time_keys) if high is None else bisect.bisect_right(self.time_keys, high)
+        return self.rows_by_time[start:end]
+
+
+class ChannelDaoMemoryImplementation(ChannelDao):
+    """Extends ChannelDao abstract class. Keeps the channels in memory_database."""
+
+    def __init__(self, memory_database):
+        self.memory_database = memory_database
+
+    def insert(self, channel):
+        """Overriden from ChannelDao. Raises IntegrityError for a known channel, as the SQLite implementation."""
+        channel_id = sqlite_numeric_affinity(channel.id)
+        if channel_id in self.memory_database.channels:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: channels.channel_id")
+        self.memory_database.channels[channel_id] = channel.name
+
+    def find_by_id(self, channel_id):
+        """Overriden from ChannelDao."""
+        channel_id = sqlite_numeric_affinity(channel_id)
+        if channel_id not in self.memory_database.channels:
+            return []
+        return [(channel_id, self.memory_database.channels[channel_id])]
+
+    def start_session(self, read_only=False):
+        """Overriden from ChannelDao. Changes are visible at once, so there is nothing to start."""
+
+    def close_session(self):
+        """Overriden from ChannelDao."""
+
+    def save_changes(self):
+        """Overriden from ChannelDao."""
+
+
+class SpamDaoMemoryImplementation(SpamDao):
+    """Extends SpamDao abstract class. Keeps the top spam of every stream in memory_database."""
+
+    def __init__(self, memory_database):
+        self.memory_database = memory_database
+
+    def get_all_wth_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from SpamDao."""
+        spam_list = self.memory_database.top_spam.get(
+            (sqlite_numeric_affinity(channel_id), sqlite_numeric_affinity(stream_id)), [])
+        return sorted(spam_list, key=lambda spam: (-spam.spam_occurences, -spam.spam_user_count,
+                                                   sqlite_sort_key(spam.spam_text)))
+
+    def insert(self, spam):
+        """Overriden from SpamDao."""
+        stream = (sqlite_numeric_affinity(spam.channel_id), sqlite_numeric_affinity(spam.stream_id))
+        self.memory_database.top_spam.setdefault(stream, []).append(
+            Spam(stream[0], stream[1], sqlite_numeric_affinity(spam.spam_text), spam.spam_occurences,
+                 spam.spam_user_count))
+
+    def delete_with_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from SpamDao."""
+        stream = (sqlite_numeric_affinity(channel_id), sqlite_numeric_affinity(stream_id))
+        self.memory_database.top_spam.pop(stream, None)
+        self.memory_database.spam_stats.pop(stream, None)
+
+    def insert_spam_stats(self, comments_count, comments_user_count, channel_id, stream_id):
+        """Overriden from SpamDao. The spam of a stream is kept ranked, like the index of the SQLite table."""
+        stream = (sqlite_numeric_affinity(channel_id), sqlite_numeric_affinity(stream_id))
+        spam_list = rank_spam(stream[0], stream[1], comments_count,
+                              {text: len(users) for text, users in comments_user_count.items()},
+                              SPAM_STATS_MIN_OCCURRENCES - 1)
+        spam_list = [Spam(spam.channel_id, spam.stream_id, sqlite_numeric_affinity(spam.spam_text),
+                          spam.spam_occurences, spam.spam_user_count) for spam in spam_list]
+        self.memory_database.spam_stats[stream] = sorted(self.memory_database.spam_stats.get(stream, []) + spam_list,
+                                                         key=spam_rank_key)
+        return len(spam_list)
+
+    def get_top_spam(self, channel_id, stream_id, threshold, limit=None):
+        """Overriden from SpamDao."""
+        spam_list = self.memory_database.spam_stats.get(
+            (sqlite_numeric_affinity(channel_id), sqlite_numeric_affinity(stream_id)), [])
+        top_spam = itertools.takewhile(lambda spam: spam.spam_occurences > threshold, spam_list)
+        return [Spam(spam.channel_id, spam.stream_id, spam.spam_text, spam.spam_occurences, spam.spam_user_count)
+                for spam in itertools.islice(top_spam, limit)]
+
+    def export_tables(self, tasks, export):
+        """Overriden from SpamDao."""
+        return [export(table_name, channel_id, stream_id, EXPORT_COLUMNS[table_name],
+                       ((spam.channel_id, spam.stream_id, spam.spam_text, spam.spam_occurences, spam.spam_user_count)
+                        for spam in self.get_all_wth_channel_and_stream_id(channel_id, stream_id)))
+                for table_name, channel_id, stream_id in tasks]
+
+    def sort_and_insert_spam(self, comments_count, comments_user_count, channel_id, stream_id, threshold=10,
+                             reverse=True):
+        """Overriden from SpamDao."""
+        spam_list = rank_spam(channel_id, stream_id, comments_count,
+                              {text: len(users) for text, users in comments_user_count.items()}, threshold)
+        if not reverse:
+            spam_list.reverse()
+        for spam in spam_list:
+            self.insert(spam)
+        return len(spam_list)
+
+    def start_session(self, read_only=False):
+        """Overriden from SpamDao. Changes are visible at once, so there is nothing to start."""
+
+    def close_session(self):
+        """Overriden from SpamDao."""
+
+    def save_changes(self):
+        """Overriden from SpamDao."""
+
+
+class ChatLogDaoMemoryImplementation(ChatLogDao):
+    """
+    Extends ChatLogDao abstract class. Keeps the chat log in memory_database, hashed by stream and by user, with the
+    rows of every stream also sorted by chat time, so that a parse and report job never touches the disk.
+
+    Values are converted like the columns of the SQLite implementation convert them, so both return the same rows.
+    """
+
+    def __init__(self, memory_database):
+        self.memory_database = memory_database
+        self.filter_operations = {"eq": lambda a, b: a == b, "gt": lambda a, b: a > b, "lt": lambda a, b: a < b,
+                                  "gteq": lambda a, b: a >= b, "lteq": lambda a, b: a <= b}
+
+    def __stream(self, channel_id, stream_id):
+        return sqlite_numeric_affinity(channel_id), sqlite_numeric_affinity(stream_id)
+
+    def __copy(self, chat_log):
+        # callers such as parse_chat_times change the chat logs they get
+        return ChatLog(chat_log.channel_id, chat_log.stream_id, chat_log.text, chat_log.user, chat_log.chat_time,
+                       chat_log.offset)
+
+    def insert(self, chat_log):
+        """Overriden from ChatLogDao."""
+        channel_id, stream_id = self.__stream(chat_log.channel_id, chat_log.stream_id)
+        stored = ChatLog(channel_id, stream_id, sqlite_numeric_affinity(chat_log.text),
+                         sqlite_numeric_affinity(chat_log.user), sqlite_numeric_affinity(chat_log.chat_time),
+                         sqlite_numeric_affinity(chat_log.offset))
+        self.memory_database.chat_log.setdefault((channel_id, stream_id), MemoryChatLogStream()).append(stored)
+        self.memory_database.chat_log_user.setdefault(stored.user, []).append(stored)
+
+    def __delete_chat_log(self, stream):
+        chat_log_stream = self.memory_database.chat_log.pop(stream, None)
+        if chat_log_stream is None:
+            return 0
+        for user in set(chat_log.user for chat_log in chat_log_stream.rows):
+            remaining = [chat_log for chat_log in self.memory_database.chat_log_user[user]
+                         if (chat_log.channel_id, chat_log.stream_id) != stream]
+            if remaining:
+                self.memory_database.chat_log_user[user] = remaining
+            else:
+                del self.memory_database.chat_log_user[user]
+        return len(chat_log_stream.rows)
+
+    def delete_with_channel_id_stream_id(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        stream = self.__stream(channel_id, stream_id)
+        self.__delete_chat_log(stream)
+        self.memory_database.viewership_rollup.pop(stream, None)
+        self.memory_database.full_text.pop(stream, None)
+        self.memory_database.full_text_streams.pop(stream, None)
+
+    def get_all_with_channel_and_stream_id(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        chat_log_stream = self.memory_database.chat_log.get(self.__stream(channel_id, stream_id))
+        if chat_log_stream is None:
+            return []
+        return [self.__copy(chat_log) for chat_log in chat_log_stream.rows]
+
+    def get_spam_list(self, channel_id, stream_id, threshold):
+        """Generate and return spam of the stream, in the order of get_all_wth_channel_and_stream_id of SpamDao."""
+        channel_id, stream_id = self.__stream(channel_id, stream_id)
+        chat_log_stream = self.memory_database.chat_log.get((channel_id, stream_id))
+        if chat_log_stream is None:
+            return []
+        with instrumentation.span("chat_log_dao.count_spam"):
+            occurrences = Counter(chat_log.text for chat_log in chat_log_stream.rows)
+            user_counts = Counter(text for text, _ in set((chat_log.text, chat_log.user)
+                                                          for chat_log in chat_log_stream.rows))
+            return rank_spam(channel_id, stream_id, occurrences, user_counts, threshold)
+
+    def get_spam_timeline(self, channel_id, stream_id, window_seconds, threshold, limit):
+        """Overriden from ChatLogDao."""
+        channel_id, stream_id = self.__stream(channel_id, stream_id)
+        chat_logs = self.memory_database.chat_log.get((channel_id, stream_id), MemoryChatLogStream()).rows
+        with instrumentation.span("chat_log_dao.spam_timeline"):
+            return spam_timeline(((chat_log.offset, chat_log.text, chat_log.user) for chat_log in
+                                  sorted(chat_logs, key=lambda chat_log: sqlite_sort_key(chat_log.offset))),
+                                 channel_id, stream_id, window_seconds, threshold, limit)
+
+    def get_normalized_spam_list(self, channel_id, stream_id, threshold):
+        """Overriden from ChatLogDao. The keys are computed when counting, from the texts kept in memory."""
+        channel_id, stream_id = self.__stream(channel_id, stream_id)
+        chat_logs = self.memory_database.chat_log.get((channel_id, stream_id), MemoryChatLogStream()).rows
+        with instrumentation.span("chat_log_dao.count_normalized_spam"):
+            return normalized_spam_list(chat_logs, channel_id, stream_id, threshold)
+
+    def parse_chat_times(self, chat_logs):  # pragma: no cover
+        """Overriden from ChatLogDao."""
+        for chat_log in chat_logs:  # pragma: no cover
+            chat_log.chat_time = parse_chat_time(chat_log.chat_time)  # pragma: no cover
+        return chat_logs  # pragma: no cover
+
+    def get_viewership_metrics(self, channel_id, stream_id):
+        """Overriden from ChatLogDao. The rows sorted by chat time need no sorting."""
+        stream = self.__stream(channel_id, stream_id)
+        if stream in self.memory_database.viewership_rollup:
+            start_time, per_minute = self.memory_database.viewership_rollup[stream]
+            return [{"channel_id": channel_id, "stream_id": stream_id, "starttime": start_time,
+                     "per_minute": [dict(minute) for minute in per_minute]}]
+        chat_log_stream = self.memory_database.chat_log.get(stream)
+        if chat_log_stream is None:
+            return []
+        return per_minute_viewership([(parse_chat_time(chat_log.chat_time), chat_log.user)
+                                      for chat_log in chat_log_stream.rows_by_time], channel_id, stream_id)
+
+    def get_checkpoint(self, source_name, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        checkpoint = self.memory_database.ingest_progress.get(source_name)
+        if checkpoint is None or checkpoint[:2] != self.__stream(channel_id, stream_id):
+            return None
+        return checkpoint[2]
+
+    def save_checkpoint(self, source_name, channel_id, stream_id, comment_index):
+        """Overriden from ChatLogDao."""
+        self.memory_database.ingest_progress[source_name] = self.__stream(channel_id, stream_id) + (comment_index,)
+
+    def save_viewership_rollup(self, channel_id, stream_id, viewership):
+        """Overriden from ChatLogDao."""
+        self.memory_database.viewership_rollup.pop(self.__stream(channel_id, stream_id), None)
+        for stream in viewership:
+            self.memory_database.viewership_rollup[self.__stream(channel_id, stream_id)] = (
+                stream["starttime"], [dict(minute) for minute in stream["per_minute"]])
+
+    def insert_full_text(self, chat_log):
+        """Overriden from ChatLogDao. Every token maps to the texts or users that contain it."""
+        index = self.memory_database.full_text.setdefault(self.__stream(chat_log.channel_id, chat_log.stream_id),
+                                                          {"text": {}, "user": {}})
+        for column in ("text", "user"):
+            value = getattr(chat_log, column)
+            for token in full_text_tokens(value):
+                index[column].setdefault(token, set()).add(sqlite_numeric_affinity(value))
+
+    def save_full_text_stream(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.memory_database.full_text_streams[self.__stream(channel_id, stream_id)] = True
+
+    def __full_text_matches(self, column, words):
+        tokens = full_text_tokens(words)
+        matches = set()
+        for index in self.memory_database.full_text.values():
+            values = [index[column].get(token, set()) for token in tokens]
+            if values:
+                matches |= set.intersection(*values)
+        return matches
+
+    def get_stream_ids(self, channel_id, limit=None):
+        """Overriden from ChatLogDao."""
+        channel_id = sqlite_numeric_affinity(channel_id)
+        stream_ids = sorted((stream_id for stream_channel_id, stream_id in self.memory_database.chat_log
+                             if stream_channel_id == channel_id), key=sqlite_sort_key, reverse=True)
+        return stream_ids[:limit]
+
+    def count_messages_by_user(self, channel_id, stream_ids):
+        """Overriden from ChatLogDao."""
+        return [dict(Counter((chat_log.text, chat_log.user) for chat_log in self.memory_database.chat_log.get(
+            self.__stream(channel_id, stream_id), MemoryChatLogStream()).rows)) for stream_id in stream_ids]
+
+    def get_viewership_by_stream(self, channel_id, stream_ids):
+        """Overriden from ChatLogDao."""
+        return [self.get_viewership_metrics(channel_id, stream_id) for stream_id in stream_ids]
+
+    def refresh_user_activity(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        channel_id, stream_id = self.__stream(channel_id, stream_id)
+        activity = {}
+        for chat_log in self.memory_database.chat_log.get((channel_id, stream_id), MemoryChatLogStream()).rows_by_time:
+            if chat_log.user not in activity:
+                activity[chat_log.user] = {"user": chat_log.user, "channel_id": channel_id, "stream_id": stream_id,
+                                           "messages": 0, "first_seen": chat_log.chat_time}
+            activity[chat_log.user]["messages"] += 1
+            activity[chat_log.user]["last_seen"] = chat_log.chat_time
+        self.memory_database.user_activity[(channel_id, stream_id)] = activity
+
+    def get_top_chatters(self, channel_id, stream_id, limit):
+        """Overriden from ChatLogDao."""
+        activity = self.memory_database.user_activity.get(self.__stream(channel_id, stream_id), {})
+        return [dict(user_activity) for user_activity in sorted(
+            activity.values(), key=lambda user_activity: (-user_activity["messages"],
+                                                          sqlite_sort_key(user_activity["user"])))[:limit]]
+
+    def get_user_activity(self, user):
+        """Overriden from ChatLogDao."""
+        user = sqlite_numeric_affinity(user)
+        streams = [dict(activity[user]) for activity in self.memory_database.user_activity.values() if user in activity]
+        streams.sort(key=lambda user_activity: (sqlite_sort_key(user_activity["first_seen"]),
+                                                user_activity["channel_id"], user_activity["stream_id"]))
+        return streams
+
+    def get_recent_messages(self, user, limit):
+        """Overriden from ChatLogDao."""
+        chat_logs = sorted(self.memory_database.chat_log_user.get(sqlite_numeric_affinity(user), []),
+                           key=lambda chat_log: sqlite_sort_key(chat_log.chat_time))
+        return [self.__copy(chat_log) for chat_log in chat_logs[max(len(chat_logs) - limit, 0):]]
+
+    def insert_emotes(self, emotes):
+        """Overriden from ChatLogDao."""
+        for emote in emotes:
+            self.memory_database.chat_emote.setdefault(self.__stream(emote[0], emote[1]), []).append(emote)
+
+    def insert_badges(self, badges):
+        """Overriden from ChatLogDao."""
+        for badge in badges:
+            self.memory_database.chat_badge.setdefault(self.__stream(badge[0], badge[1]), []).append(badge)
+
+    def delete_emotes_and_badges(self, channel_id, stream_id):
+        """Overriden from ChatLogDao."""
+        self.memory_database.chat_emote.pop(self.__stream(channel_id, stream_id), None)
+        self.memory_database.chat_badge.pop(self.__stream(channel_id, stream_id), None)
+
+    def get_top_emotes_per_minute(self, channel_id, stream_id, limit):
+        """Overriden from ChatLogDao."""
+        counts = Counter((int(sqlite_numeric_affinity(offset) / 60), emote) for _, _, _, offset, _, emote in
+                         self.memory_database.chat_emote.get(self.__stream(channel_id, stream_id), []))
+        per_minute = []
+        for (minute, emote), count in sorted(counts.items(), key=lambda item: (item[0][0], -item[1], item[0][1])):
+            if not per_minute or per_minute[-1]["minute"] != minute:
+                per_minute.append({"minute": minute, "emotes": []})
+            if len(per_minute[-1]["emotes"]) < limit:
+                per_minute[-1]["emotes"].append({"emote": emote, "count": count})
+        return per_minute
+
+    def get_badge_share(self, channel_id, stream_id, badge):
+        """Overriden from ChatLogDao. Messages and chatters of the stream are taken from the user activity."""
+        stream = self.__stream(channel_id, stream_id)
+        badge_rows = [row for row in self.memory_database.chat_badge.get(stream, []) if row[4] == badge]
+        badge_messages, badge_chatters = len(badge_rows), len(set(row[3] for row in badge_rows))
+        activity = self.memory_database.user_activity.get(stream, {})
+        messages, chatters = sum(user_activity["messages"] for user_activity in activity.values()), len(activity)
+        return {"channel_id": channel_id, "stream_id": stream_id, "badge": badge, "messages": messages,
+                "badge_messages": badge_messages,
+                "message_share": round(badge_messages / messages, 4) if messages else 0.0,
+                "chatters": chatters, "badge_chatters": badge_chatters,
+                "chatter_share": round(badge_chatters / chatters, 4) if chatters else 0.0}
+
+    def get_last_chat_times(self, channel_id=None):
+        """Overriden from ChatLogDao."""
+        channel_id = sqlite_numeric_affinity(channel_id)
+        return {stream: chat_log_stream.rows_by_time[-1].chat_time
+                for stream, chat_log_stream in self.memory_database.chat_log.items()
+                if channel_id is None or stream[0] == channel_id}
+
+    def delete_stream_batch(self, channel_id, stream_id, batch_size):
+        """Overriden from ChatLogDao. Nothing waits on the memory, so the first call deletes the whole stream and
+        returns the number of rows deleted."""
+        stream = self.__stream(channel_id, stream_id)
+        deleted = self.__delete_chat_log(stream)
+        for table in (self.memory_database.full_text, self.memory_database.full_text_streams,
+                      self.memory_database.viewership_rollup):
+            deleted += 1 if table.pop(stream, None) is not None else 0
+        for table in (self.memory_database.chat_emote, self.memory_database.chat_badge,
+                      self.memory_database.user_activity):
+            deleted += len(table.pop(stream, ()))
+        for source_name, checkpoint in list(self.memory_database.ingest_progress.items()):
+            if checkpoint[:2] == stream:
+                del self.memory_database.ingest_progress[source_name]
+                deleted += 1
+        return deleted
+
+    def __export_rows(self, table_name, channel_id, stream_id):
+        stream = self.__stream(channel_id, stream_id)
+        if table_name == "chat_log":
+            chat_logs = self.memory_database.chat_log.get(stream, MemoryChatLogStream()).rows
+            return ((chat_log.channel_id, chat_log.stream_id, chat_log.text, chat_log.user, chat_log.chat_time,
+                     chat_log.offset) for chat_log in chat_logs)
+        if table_name == "viewership_rollup":
+            if stream not in self.memory_database.viewership_rollup:
+                return iter(())
+            start_time, per_minute = self.memory_database.viewership_rollup[stream]
+            return ((stream[0], stream[1], start_time, minute["offset"], minute["viewers"], minute["messages"])
+                    for minute in sorted(per_minute, key=lambda minute: minute["offset"]))
+        return ((activity["user"], activity["channel_id"], activity["stream_id"], activity["messages"],
+                 activity["first_seen"], activity["last_seen"])
+                for activity in self.get_top_chatters(channel_id, stream_id, None))
+
+    def export_tables(self, tasks, export, max_workers=None):
+        """Overriden from ChatLogDao. The tables are exported one after the other."""
+        return [export(table_name, channel_id, stream_id, EXPORT_COLUMNS[table_name],
+                       self.__export_rows(table_name, channel_id, stream_id))
+                for table_name, channel_id, stream_id in tasks]
+
+    def __matches_filters(self, chat_log, filters, full_text_matches):
+        for column, operation, value in filters:
+            column_value = getattr(chat_log, column)
+            if operation == "match":
+                if column_value not in full_text_matches[column, value]:
+                    return False
+            elif operation == "like":
+                if re.fullmatch(like_pattern(value), str(column_value), re.IGNORECASE | re.DOTALL) is None:
+                    return False
+            elif not self.filter_operations[operation](sqlite_sort_key(column_value),
+                                                       sqlite_sort_key(sqlite_numeric_affinity(value))):
+                return False
+        return True
+
+    def select_where_filter_conditions_are_satisfied(self, filters):
+        """
+        Overriden from ChatLogDao. Equality filters on the stream and user pick the rows through the hash indexes
+        and range filters on the chat time through the rows sorted by chat time.
+        """
+        parsed_filters = []
+        for filter_arg in filters:
+            first_pos = filter_arg.index(" ")
+            last_pos = filter_arg.rindex(" ")
+            parsed_filters.append((filter_arg[0:first_pos], filter_arg[first_pos + 1:last_pos],
+                                   filter_arg[last_pos + 1:]))
+        full_text_matches = {(column, value): self.__full_text_matches(column, value)
+                             for column, operation, value in parsed_filters if operation == "match"}
+
+        equal = {column: sqlite_numeric_affinity(value) for column, operation, value in parsed_filters
+                 if operation == "eq"}
+        if "user" in equal:
+            candidates = sorted(self.memory_database.chat_log_user.get(equal["user"], []),
+                                key=lambda chat_log: sqlite_sort_key(chat_log.chat_time))
+        else:
+            low, high = None, None
+            for column, operation, value in parsed_filters:
+                key = sqlite_sort_key(sqlite_numeric_affinity(value))
+                if column == "chat_time" and operation in ("eq", "gt", "gteq"):
+                    low = key if low is None else max(low, key)
+                if column == "chat_time" and operation in ("eq", "lt", "lteq"):
+                    high = key if high is None else min(high, key)
+            streams = [chat_log_stream for (channel_id, stream_id), chat_log_stream in
+                       self.memory_database.chat_log.items() if equal.get("channel_id", channel_id) == channel_id and
+                       equal.get("stream_id", stream_id) == stream_id]
+            candidates = heapq.merge(*[chat_log_stream.rows_in_time_range(low, high) for chat_log_stream in streams],
+                                     key=lambda chat_log: sqlite_sort_key(chat_log.chat_time))
+        match_filters = [parsed_filter for parsed_filter in parsed_filters if parsed_filter[1] == "match"]
+        chat_logs = [chat_log for chat_log in candidates if self.__matches_filters(
+            chat_log, [parsed_filter for parsed_filter in parsed_filters if parsed_filter not in match_filters], {})]
+        if match_filters:
+            # the rows of a stream missing from the index would be left out of the result without a word
+            for chat_log in chat_logs:
+                if self.__stream(chat_log.channel_id, chat_log.stream_id) not in self.memory_database.full_text_streams:
+                    raise ValueError("stream {} on channel {} has no full text index for the match filter, store it "
+                                     "with ingest --full-text".format(chat_log.stream_id, chat_log.channel_id))
+            chat_logs = [chat_log for chat_log in chat_logs
+                         if self.__matches_filters(chat_log, match_filters, full_text_matches)]
+        return [self.__copy(chat_log) for chat_log in chat_logs]
+
+    def start_session(self, read_only=False):
+        """Overriden from ChatLogDao. Changes are visible at once, so there is nothing to start."""
+
+    def close_session(self):
+        """Overriden from ChatLogDao."""
+
+    def save_changes(self):
+        """Overriden from ChatLogDao."""
+
+
+class DatabaseMaintenanceDaoMemoryImplementation(DatabaseMaintenanceDao):
+    """Extends DatabaseMaintenanceDao abstract class. Memory has no pages to give back."""
+
+    def __init__(self, memory_database):
+        self.memory_database = memory_database
+
+    def get_storage_stats(self):
+        """Overriden from DatabaseMaintenanceDao."""
+        return {"page_count": 0, "freelist_count": 0, "page_size": 0}
+
+    def vacuum_incrementally(self, pages):
+        """Overriden from DatabaseMaintenanceDao."""
+        return 0
+
+    def analyze(self, analysis_limit):
+        """Overriden from DatabaseMaintenanceDao. The hash indexes need no statistics."""
+
+    def drop_tables(self, table_names):
+        """Overriden from DatabaseMaintenanceDao."""
+        for table_name in table_names:
+            self.memory_database.drop(table_name)
+
+    def start_session(self, read_only=False):
+        """Overriden from DatabaseMaintenanceDao."""
+
+    def close_session(self):
+        """Overriden from DatabaseMaintenanceDao."""
+
+    def save_changes(self):
+        """Overriden from DatabaseMaintenanceDao."""
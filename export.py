@@ -0,0 +1,124 @@
+"""Streams tables of stored streams to CSV or NDJSON files, for the export command of twitch.py."""
+import bz2
+import csv
+import gzip
+import itertools
+import json
+import lzma
+import os
+from config import *
+from dao import *
+
+# level 6 compresses nearly as well as the default 9 of gzip in a fraction of the time
+EXPORT_OPENERS = {"none": lambda file_name: open(file_name, "w", encoding="utf-8", newline=""),
+                  "gzip": lambda file_name: gzip.open(file_name, "wt", compresslevel=6, encoding="utf-8", newline=""),
+                  "bz2": lambda file_name: bz2.open(file_name, "wt", encoding="utf-8", newline=""),
+                  "xz": lambda file_name: lzma.open(file_name, "wt", encoding="utf-8", newline="")}
+EXPORT_EXTENSIONS = {"none": "", "gzip": ".gz", "bz2": ".bz2", "xz": ".xz"}
+
+
+class TableExporter:
+    """
+    Writes the rows of one table of one stream to files in directory, starting a new file every rows_per_file rows.
+    Rows are taken EXPORT_BATCH_SIZE at a time from their iterator, so memory use does not grow with the table.
+    """
+
+    def __init__(self, directory, export_format="csv", compression="none", rows_per_file=EXPORT_ROWS_PER_FILE):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError("unknown export format {}".format(export_format))
+        if compression not in EXPORT_COMPRESSIONS:
+            raise ValueError("unknown compression {}".format(compression))
+        self.directory = directory
+        self.export_format = export_format
+        self.compression = compression
+        self.rows_per_file = rows_per_file
+
+    def file_name(self, table_name, channel_id, stream_id, part):
+        """Return name of file number part of the table of the stream."""
+        return os.path.join(self.directory, "{}_{}_{}_{:04d}.{}{}".format(
+            table_name, channel_id, stream_id, part, self.export_format, EXPORT_EXTENSIONS[self.compression]))
+
+    def __open_part(self, files, table_name, channel_id, stream_id, columns):
+        # open the next file of the table and add it to files, return it and the function that writes rows to it
+        file_name = self.file_name(table_name, channel_id, stream_id, len(files))
+        files.append({"table": table_name, "channel_id": channel_id, "stream_id": stream_id, "file": file_name,
+                      "rows": 0})
+        file = EXPORT_OPENERS[self.compression](file_name)
+        if self.export_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            return file, writer.writerows
+        return file, lambda rows: file.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+    def export(self, table_name, channel_id, stream_id, columns, rows):
+        """Write rows of the table of the stream, with given column names. Return list of the files written, each
+        with its number of rows. A table without rows is written to one file holding only the CSV header."""
+        os.makedirs(self.directory, exist_ok=True)
+        rows = iter(rows)
+        files = []
+        file = None
+        with instrumentation.span("export.write"):
+            try:
+                while True:
+                    batch_size = EXPORT_BATCH_SIZE
+                    if self.rows_per_file:
+                        batch_size = min(batch_size, self.rows_per_file - (0 if file is None else files[-1]["rows"]))
+                    batch = list(itertools.islice(rows, batch_size))
+                    if not batch:
+                        break
+                    if file is None:
+                        file, write_rows = self.__open_part(files, table_name, channel_id, stream_id, columns)
+                    write_rows(batch)
+                    files[-1]["rows"] += len(batch)
+                    if self.rows_per_file and files[-1]["rows"] >= self.rows_per_file:
+                        file.close()
+                        file = None
+                if not files:
+                    file, _ = self.__open_part(files, table_name, channel_id, stream_id, columns)
+            finally:
+                if file is not None:
+                    file.close()
+        instrumentation.count("rows", "export.write", sum(exported_file["rows"] for exported_file in files))
+        return files
+
+
+class ExportService:
+    """Exports tables of streams with a TableExporter, several streams at once. Chat log tables are read by the chat
+    log DAO and top spam by the spam DAO, each in a read only session, so that ingestion goes on meanwhile."""
+
+    def __init__(self, chat_log_dao, spam_dao, table_exporter, workers=EXPORT_WORKERS):
+        self.chat_log_dao = chat_log_dao
+        self.spam_dao = spam_dao
+        self.table_exporter = table_exporter
+        self.workers = workers
+
+    def export_streams(self, streams, table_names=EXPORT_TABLES):
+        """Export table_names of every (channel_id, stream_id) in streams. Return report with the files written and
+        the number of rows exported of every table."""
+        unknown_tables = [table_name for table_name in table_names if table_name not in EXPORT_COLUMNS]
+        if unknown_tables:
+            raise ValueError("cannot export {}".format(", ".join(unknown_tables)))
+        tasks = [(table_name, int(channel_id), int(stream_id)) for channel_id, stream_id in streams
+                 for table_name in table_names]
+        files = []
+        spam_tasks = [task for task in tasks if task[0] == "top_spam"]
+        if spam_tasks:
+            self.spam_dao.start_session(read_only=True)
+            try:
+                files += self.spam_dao.export_tables(spam_tasks, self.table_exporter.export)
+            finally:
+                self.spam_dao.close_session()
+        chat_log_tasks = [task for task in tasks if task[0] != "top_spam"]
+        if chat_log_tasks:
+            self.chat_log_dao.start_session(read_only=True)
+            try:
+                files += self.chat_log_dao.export_tables(chat_log_tasks, self.table_exporter.export, self.workers)
+            finally:
+                self.chat_log_dao.close_session()
+
+        files = sorted((exported_file for table_files in files for exported_file in table_files),
+                       key=lambda exported_file: exported_file["file"])
+        rows = {table_name: 0 for table_name in table_names}
+        for exported_file in files:
+            rows[exported_file["table"]] += exported_file["rows"]
+        return {"files": files, "rows": rows}
@@ -0,0 +1,197 @@
+"""Time and row budgets of the queries of a command, their cancellation, and admission control of commands running at
+once, so that a careless query cannot tie up the CPU and the database while other commands wait."""
+import io
+import itertools
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from config import *
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when the queries of a command ran out of their budget or were cancelled."""
+
+
+class QueryBudget:
+    """Lets the queries of one command run for at most max_seconds and return at most max_rows rows, None for no
+    limit. The queries stop at the first check after cancel is called, from any thread."""
+
+    def __init__(self, max_seconds=None, max_rows=None):
+        self.max_seconds = max_seconds
+        self.max_rows = max_rows
+        self.deadline = None if max_seconds is None else time.monotonic() + max_seconds
+        self.reason = None
+        self.cancelled = False
+        self.rows = itertools.count(1)
+
+    def cancel(self):
+        """Stop the running queries of the command and fail the ones it starts later."""
+        self.cancelled = True
+
+    def exceeded(self):
+        """Return True, and set reason, if the command was cancelled or ran out of time."""
+        if self.reason is None:
+            if self.cancelled:
+                self.reason = "query cancelled"
+            elif self.deadline is not None and time.monotonic() > self.deadline:
+                self.reason = "query ran longer than {} seconds".format(self.max_seconds)
+        return self.reason is not None
+
+    def progress_handler(self):
+        """Progress handler of SQLite connections: a true result interrupts the running statement."""
+        try:
+            return self.exceeded()
+        except KeyboardInterrupt:
+            # the handler runs on the thread of the query, so Ctrl-C lands here while a statement runs
+            self.cancel()
+            return self.exceeded()
+
+    def row_factory(self, cursor, row):
+        """Row factory of SQLite connections counting the rows returned to the command."""
+        if next(self.rows) > self.max_rows:
+            self.reason = "query returned more than {} rows".format(self.max_rows)
+            raise QueryBudgetExceeded(self.reason)
+        return row
+
+
+local_budget = threading.local()
+active_budgets = []
+active_budgets_lock = threading.Lock()
+
+
+def current_query_budget():
+    """Return budget of the queries of the current thread, None if they have none."""
+    return getattr(local_budget, "budget", None)
+
+
+@contextmanager
+def query_budget(budget):
+    """Run the with block with budget as the budget of the queries of the current thread. Connections opened inside
+    the block enforce it, and interrupted statements are raised as QueryBudgetExceeded."""
+    previous = current_query_budget()
+    local_budget.budget = budget
+    with active_budgets_lock:
+        active_budgets.append(budget)
+    try:
+        yield budget
+    except sqlite3.OperationalError as error:
+        if budget is not None and budget.reason is not None:
+            raise QueryBudgetExceeded(budget.reason) from error
+        raise
+    finally:
+        with active_budgets_lock:
+            active_budgets.remove(budget)
+        local_budget.budget = previous
+
+
+def cancel_query_budgets():
+    """Cancel the queries of every thread running with a budget."""
+    with active_budgets_lock:
+        for budget in active_budgets:
+            if budget is not None:
+                budget.cancel()
+
+
+def install_query_budget(connection):
+    """Make connection enforce the budget of the current thread, or nothing without one. Called whenever a session
+    gets the connection, as pooled connections outlive the commands."""
+    budget = current_query_budget()
+    if budget is None:
+        remove_query_budget(connection)
+        return
+    connection.set_progress_handler(budget.progress_handler, QUERY_PROGRESS_STEPS)
+    # counting rows costs a call per row, so only commands with a row budget pay for it
+    connection.row_factory = None if budget.max_rows is None else budget.row_factory
+
+
+def uncounted_cursor(connection):
+    """Return cursor of connection whose rows are not counted by the row budget, for lookups of the schema and of
+    settings, which are no results of the command."""
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    return cursor
+
+
+def remove_query_budget(connection):
+    """Stop connection from enforcing a budget, so that rolling back an interrupted transaction is not interrupted
+    too."""
+    connection.set_progress_handler(None, 0)
+    connection.row_factory = None
+
+
+class AdmissionController:
+    """
+    Runs at most slots commands at once, reserved_slots of them kept for cheap commands.
+
+    Heavy analytics may hold at most slots - reserved_slots slots, so however many of them are waiting, a cheap
+    lookup is admitted as soon as it reaches a free slot instead of queueing behind them.
+    """
+
+    def __init__(self, slots, reserved_slots=0):
+        if slots < 1 or not 0 <= reserved_slots < slots:
+            raise ValueError("{} slots cannot keep {} of them for cheap commands".format(slots, reserved_slots))
+        self.slots = slots
+        self.reserved_slots = reserved_slots
+        self.condition = threading.Condition()
+        self.running = 0
+        self.running_heavy = 0
+
+    def __can_admit(self, cheap):
+        if self.running >= self.slots:
+            return False
+        return cheap or self.running_heavy < self.slots - self.reserved_slots
+
+    def admit(self, jobs, is_cheap):
+        """Remove from list jobs and return the first job that fits a free slot, is_cheap telling whether a job is a
+        cheap command, waiting until one does. Return None once jobs is empty."""
+        with self.condition:
+            while True:
+                if not jobs:
+                    return None
+                for position, job in enumerate(jobs):
+                    cheap = is_cheap(job)
+                    if self.__can_admit(cheap):
+                        self.running += 1
+                        self.running_heavy += 0 if cheap else 1
+                        return jobs.pop(position)
+                self.condition.wait()
+
+    def release(self, cheap):
+        """Give back the slot of a finished job admitted by admit."""
+        with self.condition:
+            self.running -= 1
+            self.running_heavy -= 0 if cheap else 1
+            self.condition.notify_all()
+
+    def clear(self, jobs):
+        """Drop the jobs not admitted yet, so that the threads waiting in admit return."""
+        with self.condition:
+            del jobs[:]
+            self.condition.notify_all()
+
+
+class ThreadOutput(io.TextIOBase):
+    """Standard output of commands running on several threads: what a thread writes inside capture goes to its own
+    buffer, everything else to stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        """Overriden from TextIOBase."""
+        return getattr(self.local, "buffer", self.stream).write(text)
+
+    def flush(self):
+        """Overriden from TextIOBase."""
+        getattr(self.local, "buffer", self.stream).flush()
+
+    @contextmanager
+    def capture(self, buffer):
+        """Send what the current thread writes inside the with block to buffer."""
+        self.local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            del self.local.buffer
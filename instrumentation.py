@@ -0,0 +1,99 @@
+"""Timing spans and counters for the stages of twitch.py commands, exported in Prometheus text format."""
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Instrumentation:
+    """Collects number of calls, total and maximum duration of named stages, and counters such as rows and bytes
+    processed by the stages."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sql_timing_enabled = False
+        self.stage_calls = {}
+        self.stage_seconds = {}
+        self.stage_max_seconds = {}
+        self.counters = {}
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self.lock:
+            self.stage_calls = {}
+            self.stage_seconds = {}
+            self.stage_max_seconds = {}
+            self.counters = {}
+
+    @contextmanager
+    def span(self, stage):
+        """Record duration of the with block as one call of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        """Record one call of stage that took given number of seconds."""
+        with self.lock:
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_max_seconds[stage] = max(self.stage_max_seconds.get(stage, 0.0), seconds)
+
+    def count(self, counter, stage, value=1):
+        """Add value to counter of stage, e.g. count("rows", "storechatlog.insert", 5000)."""
+        with self.lock:
+            self.counters[(counter, stage)] = self.counters.get((counter, stage), 0) + value
+
+    def to_prometheus(self):
+        """Return everything recorded so far in Prometheus text exposition format."""
+        with self.lock:
+            lines = ["# HELP twitch_stage_duration_seconds Time spent in a stage of a command.",
+                     "# TYPE twitch_stage_duration_seconds summary"]
+            for stage in sorted(self.stage_calls):
+                lines.append('twitch_stage_duration_seconds_sum{{stage="{}"}} {:.9f}'.format(
+                    stage, self.stage_seconds[stage]))
+                lines.append('twitch_stage_duration_seconds_count{{stage="{}"}} {}'.format(
+                    stage, self.stage_calls[stage]))
+
+            lines.append("# HELP twitch_stage_duration_seconds_max Longest single call of a stage.")
+            lines.append("# TYPE twitch_stage_duration_seconds_max gauge")
+            for stage in sorted(self.stage_calls):
+                lines.append('twitch_stage_duration_seconds_max{{stage="{}"}} {:.9f}'.format(
+                    stage, self.stage_max_seconds[stage]))
+
+            for counter in sorted(set(counter for counter, stage in self.counters)):
+                lines.append("# TYPE twitch_{}_total counter".format(counter))
+                for (name, stage), value in sorted(self.counters.items()):
+                    if name == counter:
+                        lines.append('twitch_{}_total{{stage="{}"}} {}'.format(counter, stage, value))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_name):
+        """Write everything recorded so far to file_name in Prometheus text exposition format."""
+        with open(file_name, "w") as file:
+            file.write(self.to_prometheus())
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records duration of every statement it executes as stage sql.<statement keyword>."""
+
+    def execute(self, sql, parameters=()):
+        """Execute sql and record how long it took."""
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            instrumentation.record("sql." + sql.split(None, 1)[0].lower(), time.perf_counter() - start)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors are InstrumentedCursor instances."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        """Return new InstrumentedCursor."""
+        return super().cursor(factory)
+
+
+instrumentation = Instrumentation()
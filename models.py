@@ -1,4 +1,7 @@
 """models for channel, spam, and chat log."""
+import hashlib
+import heapq
+import unicodedata
 
 
 class KeyValueModel:
@@ -78,6 +81,61 @@ class Spam(KeyValueModel):
                                                  self.spam_occurences, self.spam_user_count)
 
 
+def spam_rank_key(spam):
+    """Sort key of spam: most occurrences first, then most users, then text, numbers before texts like SQLite orders
+    them."""
+    return -spam.spam_occurences, -spam.spam_user_count, isinstance(spam.spam_text, str), spam.spam_text
+
+
+def rank_spam(channel_id, stream_id, occurrences, user_counts, threshold=10, limit=None):
+    """Return Spam of the texts that occurrences, a mapping of text to number of messages, counts more than threshold
+    times, with their numbers of users from user_counts, ordered by spam_rank_key. At most limit if given."""
+    spam_list = [Spam(channel_id, stream_id, text, count, user_counts[text]) for text, count in occurrences.items()
+                 if count > threshold]
+    if limit is not None:
+        return heapq.nsmallest(limit, spam_list, key=spam_rank_key)
+    spam_list.sort(key=spam_rank_key)
+    return spam_list
+
+
+class SpamNormalizer:
+    """Maps the text of a message to the key its spam is counted under, so that "KEKW", "kekw " and "KEKW KEKW" are
+    one message, and to a 64 bit hash of the key. steps are applied in the order of STEPS; repeats splits the text
+    into whitespace separated tokens, so it collapses whitespace as well."""
+
+    STEPS = ("nfkc", "casefold", "whitespace", "repeats")
+
+    def __init__(self, steps=STEPS):
+        unknown_steps = set(steps) - set(self.STEPS)
+        if unknown_steps:
+            raise ValueError("unknown spam normalization steps {}".format(", ".join(sorted(unknown_steps))))
+        self.steps = tuple(step for step in self.STEPS if step in steps)
+
+    def key(self, text):
+        """Return normalized key of text."""
+        key = str(text)
+        if "nfkc" in self.steps:
+            key = unicodedata.normalize("NFKC", key)
+        if "casefold" in self.steps:
+            key = key.casefold()
+        if "repeats" in self.steps:
+            tokens = key.split()
+            key = " ".join(token for index, token in enumerate(tokens) if index == 0 or token != tokens[index - 1])
+        elif "whitespace" in self.steps:
+            key = " ".join(key.split())
+        return key
+
+    @staticmethod
+    def hash(key):
+        """Return signed 64 bit hash of key, which fits an SQLite integer."""
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+    def key_and_hash(self, text):
+        """Return normalized key of text and its hash."""
+        key = self.key(text)
+        return key, self.hash(key)
+
+
 class ChatLogFactory:
     """Creates chat log instance from given values"""
 
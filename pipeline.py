@@ -0,0 +1,271 @@
+"""Sinks of the ingest command, which stores everything derived from a chat export in one pass over its comments."""
+import queue
+import threading
+import time
+from dao import *
+
+
+class IngestSink:  # pragma: no cover
+    """
+    Abstract class for consumer of the comments of one stream.
+    """
+
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError  # pragma: no cover
+
+    def start(self, channel_id, stream_id):  # pragma: no cover
+        """Prepare for the comments of given stream."""
+        raise NotImplementedError  # pragma: no cover
+
+    def consume(self, comment, chat_log):  # pragma: no cover
+        """Process one comment and the chat log created from it."""
+        raise NotImplementedError  # pragma: no cover
+
+    def finish(self):  # pragma: no cover
+        """Write what is left after the last comment and return number of records written."""
+        raise NotImplementedError  # pragma: no cover
+
+
+class ChatLogSink(IngestSink):
+    """Replaces the chat log of the stream, as storechatlog does."""
+
+    def __init__(self, chat_log_dao, source_name):
+        self.chat_log_dao = chat_log_dao
+        self.source_name = source_name
+        self.channel_id = None
+        self.stream_id = None
+        self.count = 0
+
+    def start(self, channel_id, stream_id):
+        """Overriden from IngestSink."""
+        self.channel_id, self.stream_id = channel_id, stream_id
+        self.count = 0
+        self.chat_log_dao.delete_with_channel_id_stream_id(channel_id, stream_id)
+
+    def consume(self, comment, chat_log):
+        """Overriden from IngestSink."""
+        self.chat_log_dao.insert(chat_log)
+        self.count += 1
+
+    def finish(self):
+        """Overriden from IngestSink. The checkpoint tells storechatlog --resume that the source is complete."""
+        self.chat_log_dao.refresh_user_activity(self.channel_id, self.stream_id)
+        self.chat_log_dao.save_checkpoint(self.source_name, self.channel_id, self.stream_id, self.count)
+        return self.count
+
+
+class TopSpamSink(IngestSink):
+    """Counts messages and their users and replaces the top spam and spam statistics of the stream, as parsetopspam
+    does."""
+
+    def __init__(self, spam_dao):
+        self.spam_dao = spam_dao
+        self.channel_id = None
+        self.stream_id = None
+        self.comments_count = {}
+        self.comments_user_count = {}
+
+    def start(self, channel_id, stream_id):
+        """Overriden from IngestSink."""
+        self.channel_id, self.stream_id = channel_id, stream_id
+        self.comments_count = {}
+        self.comments_user_count = {}
+
+    def consume(self, comment, chat_log):
+        """Overriden from IngestSink."""
+        self.comments_count[chat_log.text] = self.comments_count.get(chat_log.text, 0) + 1
+        self.comments_user_count.setdefault(chat_log.text, set()).add(chat_log.user)
+
+    def finish(self):
+        """Overriden from IngestSink."""
+        self.spam_dao.delete_with_channel_and_stream_id(self.channel_id, self.stream_id)
+        self.spam_dao.insert_spam_stats(self.comments_count, self.comments_user_count, self.channel_id,
+                                        self.stream_id)
+        return self.spam_dao.sort_and_insert_spam(self.comments_count, self.comments_user_count, self.channel_id,
+                                                  self.stream_id)
+
+
+class ViewershipSink(IngestSink):
+    """Stores the viewership metrics of the stream, so that the viewership command reads them instead of the whole
+    chat log."""
+
+    def __init__(self, chat_log_dao):
+        self.chat_log_dao = chat_log_dao
+        self.channel_id = None
+        self.stream_id = None
+        self.chat_times_and_users = []
+
+    def start(self, channel_id, stream_id):
+        """Overriden from IngestSink."""
+        self.channel_id, self.stream_id = channel_id, stream_id
+        self.chat_times_and_users = []
+
+    def consume(self, comment, chat_log):
+        """Overriden from IngestSink."""
+        self.chat_times_and_users.append((parse_chat_time(chat_log.chat_time), chat_log.user))
+
+    def finish(self):
+        """Overriden from IngestSink. Return number of minutes stored."""
+        if not self.chat_times_and_users:
+            return 0
+        # stable sort, so messages of the same second keep the order in which the chat log stores them
+        self.chat_times_and_users.sort(key=lambda chat_time_and_user: chat_time_and_user[0])
+        viewership = per_minute_viewership(self.chat_times_and_users, self.channel_id, self.stream_id)
+        self.chat_log_dao.save_viewership_rollup(self.channel_id, self.stream_id, viewership)
+        return len(viewership[0]["per_minute"])
+
+
+class FullTextSink(IngestSink):
+    """Adds every message to the full text index searched by the match filter of querychatlog."""
+
+    def __init__(self, chat_log_dao):
+        self.chat_log_dao = chat_log_dao
+        self.channel_id = None
+        self.stream_id = None
+        self.count = 0
+
+    def start(self, channel_id, stream_id):
+        """Overriden from IngestSink."""
+        self.channel_id, self.stream_id = channel_id, stream_id
+        self.count = 0
+
+    def consume(self, comment, chat_log):
+        """Overriden from IngestSink."""
+        self.chat_log_dao.insert_full_text(chat_log)
+        self.count += 1
+
+    def finish(self):
+        """Overriden from IngestSink. The match filter searches only the streams indexed whole."""
+        self.chat_log_dao.save_full_text_stream(self.channel_id, self.stream_id)
+        return self.count
+
+
+class EmoteBadgeSink(IngestSink):
+    """Replaces the emotes used in the messages and the badges worn by their senders, as storechatlog does."""
+
+    def __init__(self, chat_log_dao, comment_dao):
+        self.chat_log_dao = chat_log_dao
+        self.comment_dao = comment_dao
+        self.channel_id = None
+        self.stream_id = None
+        self.emotes = []
+        self.badges = []
+        self.message_index = 0
+
+    def start(self, channel_id, stream_id):
+        """Overriden from IngestSink."""
+        self.channel_id, self.stream_id = channel_id, stream_id
+        self.emotes, self.badges, self.message_index = [], [], 0
+        self.chat_log_dao.delete_emotes_and_badges(channel_id, stream_id)
+
+    def consume(self, comment, chat_log):
+        """Overriden from IngestSink."""
+        for emoticon_id, emote in self.comment_dao.get_emotes_from_comment(comment):
+            self.emotes.append((self.channel_id, self.stream_id, self.message_index, chat_log.offset, emoticon_id,
+                                emote))
+        for badge, version in self.comment_dao.get_badges_from_comment(comment):
+            self.badges.append((self.channel_id, self.stream_id, self.message_index, chat_log.user, badge, version))
+        self.message_index += 1
+
+    def finish(self):
+        """Overriden from IngestSink. Return number of emotes and badges stored."""
+        self.chat_log_dao.insert_emotes(self.emotes)
+        self.chat_log_dao.insert_badges(self.badges)
+        return len(self.emotes) + len(self.badges)
+
+
+class IngestPipeline:
+    """Feeds every comment of a comment DAO to all the sinks, in the order in which they are given."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def run(self, comment_dao):
+        """Feed comments of comment_dao to the sinks. Return channel_id, stream_id and the list of numbers of records
+        written by every sink."""
+        with instrumentation.span("ingest.read_comments"):
+            comments = comment_dao.get_all_comments()
+            channel_id, stream_id = comment_dao.get_channel_and_stream_id(0)
+
+        with instrumentation.span("ingest.consume"):
+            for sink in self.sinks:
+                sink.start(channel_id, stream_id)
+            for comment in comments:
+                chat_log = comment_dao.get_chat_log_from_comment(channel_id, stream_id, comment)
+                for sink in self.sinks:
+                    sink.consume(comment, chat_log)
+        instrumentation.count("rows", "ingest.consume", len(comments))
+
+        with instrumentation.span("ingest.finish"):
+            counts = [sink.finish() for sink in self.sinks]
+        return channel_id, stream_id, counts
+
+
+class ParseWritePipeline:
+    """
+    Overlaps producing batches of rows with writing them. The batches are produced on a parser thread and written on
+    the calling thread, which owns the database connection, with at most queue_depth batches waiting in between. The
+    parser thread runs while the writer waits on the database, as sqlite3 releases the GIL during its calls. Time
+    spent is recorded under the stages parse, parser_stall, write and writer_stall of instrumentation_stage.
+    """
+
+    def __init__(self, queue_depth, instrumentation_stage="storechatlog", poll_interval=0.1):
+        self.queue_depth = queue_depth
+        self.instrumentation_stage = instrumentation_stage
+        self.poll_interval = poll_interval
+
+    def run(self, produce, write):
+        """Call write with every batch yielded by the iterable returned by produce. An exception raised by produce is
+        raised again here. Return number of batches together with the seconds spent parsing, writing and by either
+        side waiting for the other."""
+        batches = queue.Queue(self.queue_depth)
+        stop = threading.Event()
+        stats = {"batches": 0, "parse_seconds": 0.0, "parser_stall_seconds": 0.0, "write_seconds": 0.0,
+                 "writer_stall_seconds": 0.0}
+
+        def put(item):
+            started = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=self.poll_interval)
+                    break
+                except queue.Full:
+                    continue
+            stats["parser_stall_seconds"] += time.perf_counter() - started
+
+        def parse():
+            try:
+                iterator = iter(produce())
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    batch = next(iterator, batches)
+                    stats["parse_seconds"] += time.perf_counter() - started
+                    if batch is batches:
+                        put(("end", None))
+                        return
+                    put(("batch", batch))
+            except BaseException as exception:
+                put(("error", exception))
+
+        parser = threading.Thread(target=parse, name="parse-write-pipeline", daemon=True)
+        parser.start()
+        try:
+            while True:
+                started = time.perf_counter()
+                kind, value = batches.get()
+                stats["writer_stall_seconds"] += time.perf_counter() - started
+                if kind == "end":
+                    break
+                if kind == "error":
+                    raise value
+                started = time.perf_counter()
+                write(value)
+                stats["write_seconds"] += time.perf_counter() - started
+                stats["batches"] += 1
+        finally:
+            stop.set()
+            parser.join()
+
+        for stage in ("parse", "parser_stall", "write", "writer_stall"):
+            instrumentation.record(self.instrumentation_stage + "." + stage, stats[stage + "_seconds"])
+        return stats
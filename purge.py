@@ -1,15 +1,12 @@
-import sqlite3
-
-conn = sqlite3.connect('twitch.db')
-c = conn.cursor()
-
-c.execute("drop table if exists chat_log")
-print("dropped chat_log")
-
-c.execute("drop table if exists top_spam")
-print("dropped top_spam")
-
-c.execute("drop table if exists channels")
-print("channels dropped")
-
-conn.close()
\ No newline at end of file
+"""Drops every table of the database. Single streams and streams past their retention are deleted by the purge and
+retention commands of twitch.py."""
+from config import *
+from dao import TABLE_NAMES, DatabaseMaintenanceDaoSqlLiteImplementation
+
+maintenance_dao = DatabaseMaintenanceDaoSqlLiteImplementation(DATABASE_NAME)
+maintenance_dao.start_session()
+for table_name in TABLE_NAMES:
+    maintenance_dao.drop_tables([table_name])
+    print("channels dropped" if table_name == "channels" else "dropped {}".format(table_name))
+maintenance_dao.save_changes()
+maintenance_dao.close_session()
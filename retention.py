@@ -0,0 +1,148 @@
+"""Expires streams older than a retention policy and compacts the database, for the retention and purge commands of
+twitch.py."""
+import datetime
+import logging
+from config import *
+from dao import *
+
+
+class RetentionPolicy:
+    """Streams whose last message is older than max_age_days, of channel_id only if given, are expired. Expired
+    streams are moved to the archive with archive set and deleted otherwise."""
+
+    def __init__(self, max_age_days, archive=False, channel_id=None):
+        self.max_age_days = max_age_days
+        self.archive = archive
+        self.channel_id = channel_id
+
+    def cutoff(self, now):
+        """Return chat time before which streams are expired at UTC datetime now."""
+        return (now - datetime.timedelta(days=self.max_age_days)).strftime("%Y-%m-%dT%H:%M:%S")
+
+    def expired_streams(self, last_chat_times, now):
+        """Return sorted list of (channel_id, stream_id) of last_chat_times, as returned by get_last_chat_times of
+        ChatLogDao, that are expired at now."""
+        cutoff = self.cutoff(now)
+        return sorted(stream for stream, last_chat_time in last_chat_times.items()
+                      if last_chat_time is not None and last_chat_time < cutoff)
+
+
+class RetentionService:
+    """
+    Deletes or archives streams and then compacts the database.
+
+    Every transaction deletes at most batch_size rows or archives one stream, so readers, which see the database
+    through WAL snapshots, and other writers are held up for one batch at most. Free pages are given back to the file
+    system vacuum_pages at a time, and the statistics of the query planner are refreshed at the end.
+    """
+
+    def __init__(self, chat_log_dao, spam_dao, maintenance_dao, batch_size=RETENTION_BATCH_SIZE,
+                 vacuum_pages=RETENTION_VACUUM_PAGES, analysis_limit=RETENTION_ANALYSIS_LIMIT):
+        if batch_size < 1 or vacuum_pages < 1:
+            # a limit of 0 deletes nothing and a negative one deletes the whole stream in one transaction
+            raise ValueError("batch size {} and vacuum pages {} must be positive".format(batch_size, vacuum_pages))
+        self.chat_log_dao = chat_log_dao
+        self.spam_dao = spam_dao
+        self.maintenance_dao = maintenance_dao
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.analysis_limit = analysis_limit
+
+    def find_expired_streams(self, policy, now):
+        """Return list of (channel_id, stream_id) of the streams expired by policy at now."""
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("retention.find"):
+                return policy.expired_streams(self.chat_log_dao.get_last_chat_times(policy.channel_id), now)
+        finally:
+            self.chat_log_dao.close_session()
+
+    def delete_stream(self, channel_id, stream_id):
+        """Delete everything stored for the stream, batch_size rows per transaction. Return number of rows deleted."""
+        deleted_rows = 0
+        self.chat_log_dao.start_session()
+        try:
+            while True:
+                with instrumentation.span("retention.delete_batch"):
+                    deleted = self.chat_log_dao.delete_stream_batch(channel_id, stream_id, self.batch_size)
+                    self.chat_log_dao.save_changes()
+                if not deleted:
+                    break
+                deleted_rows += deleted
+        finally:
+            self.chat_log_dao.close_session()
+
+        self.spam_dao.start_session()
+        try:
+            self.spam_dao.delete_with_channel_and_stream_id(channel_id, stream_id)
+            self.spam_dao.save_changes()
+        finally:
+            self.spam_dao.close_session()
+        logging.info("deleted {} rows of stream {} on channel {}".format(deleted_rows, stream_id, channel_id))
+        return deleted_rows
+
+    def archive_stream(self, channel_id, stream_id):
+        """Move chat log of the stream to the archive in one transaction, unless it is there already. A stream with a
+        segment that is still in the database was being archived when the process stopped, and is archived again.
+        Return number of rows archived."""
+        self.chat_log_dao.start_session()
+        try:
+            with instrumentation.span("retention.archive"):
+                archived = self.chat_log_dao.archive_stream(channel_id, stream_id)
+                self.chat_log_dao.save_changes()
+        finally:
+            self.chat_log_dao.close_session()
+        logging.info("archived stream {} on channel {}".format(stream_id, channel_id))
+        return 0 if archived is None else archived[0]
+
+    def compact(self):
+        """Give free pages back to the file system and refresh the statistics of the query planner. Return number
+        of pages given back and the storage statistics afterwards."""
+        freed_pages = 0
+        self.maintenance_dao.start_session()
+        try:
+            while True:
+                with instrumentation.span("retention.vacuum"):
+                    freed = self.maintenance_dao.vacuum_incrementally(self.vacuum_pages)
+                    self.maintenance_dao.save_changes()
+                if freed <= 0:
+                    break
+                freed_pages += freed
+            with instrumentation.span("retention.analyze"):
+                self.maintenance_dao.analyze(self.analysis_limit)
+                self.maintenance_dao.save_changes()
+            return freed_pages, self.maintenance_dao.get_storage_stats()
+        finally:
+            self.maintenance_dao.close_session()
+
+    def apply(self, policy, now=None, dry_run=False):
+        """Archive or delete the streams expired by policy at UTC datetime now, current time by default, and
+        compact the database. With dry_run set only find them. Return report of what was done."""
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        expired_streams = self.find_expired_streams(policy, now)
+        report = {"cutoff": policy.cutoff(now), "expired_streams": [list(stream) for stream in expired_streams]}
+        if dry_run:
+            return report
+        if policy.archive:
+            report["archived_rows"] = sum(self.archive_stream(*stream) for stream in expired_streams)
+        else:
+            report["deleted_rows"] = sum(self.delete_stream(*stream) for stream in expired_streams)
+        report["freed_pages"], report["storage"] = self.compact()
+        return report
+
+    def purge(self, channel_id, stream_id=None):
+        """Delete the stream, or every stream of the channel without stream_id, and compact the database. Return
+        report of what was done."""
+        if stream_id is None:
+            self.chat_log_dao.start_session(read_only=True)
+            try:
+                streams = sorted(self.chat_log_dao.get_last_chat_times(channel_id))
+            finally:
+                self.chat_log_dao.close_session()
+        else:
+            streams = [(channel_id, stream_id)]
+        report = {"purged_streams": [list(stream) for stream in streams],
+                  "deleted_rows": sum(self.delete_stream(*stream) for stream in streams)}
+        report["freed_pages"], report["storage"] = self.compact()
+        return report
@@ -1,21 +1,79 @@
 """Class for Streaming Platform."""
 
+import atexit
+import itertools
 import logging
+from aggregate import *
+from config import *
 from dao import *
+from export import *
 from models import *
+from pipeline import *
+from retention import *
 
-logging.basicConfig(level=logging.INFO, filename='twitch.log')
+log_listener = None
+logging_configured = False
+
+
+def configure_logging(log_file_name, asynchronous=True):
+    """Send records of the root logger to log_file_name. With asynchronous set, the records are queued and written
+    by a background thread, so that writing large payloads does not delay the command."""
+    global log_listener, logging_configured
+    stop_logging()
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+        handler.close()
+
+    file_handler = logging.FileHandler(log_file_name)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    if asynchronous:
+        from logging.handlers import QueueHandler, QueueListener
+        from queue import Queue
+        log_queue = Queue()
+        log_listener = QueueListener(log_queue, file_handler)
+        log_listener.start()
+        root_logger.addHandler(QueueHandler(log_queue))
+    else:
+        root_logger.addHandler(file_handler)
+    root_logger.setLevel(logging.INFO)
+    logging_configured = True
+
+
+def flush_logging():
+    """Wait until the background thread has written every queued record."""
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener.start()
+
+
+def stop_logging():
+    """Write the queued records and stop the background thread."""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+atexit.register(stop_logging)
 
 
 class StreamingPlatform:
     """A streaming platform."""
 
     def __init__(self, log_file_name):
+        # the log file is only opened once a command actually runs
+        if not logging_configured:
+            configure_logging(log_file_name, asynchronous=False)
+
         # set DAO objects to None
         self.comment_dao = None
         self.channel_dao = None
         self.spam_dao = None
         self.chat_log_dao = None
+        self.maintenance_dao = None
+        self.payload_logging = "full"
+        self.json_decoder = None
 
     def set_comment_dao(self, comment_dao):
         """Set the value of comment DAO used by streaming platform"""
@@ -33,95 +91,381 @@ class StreamingPlatform:
         """Set the value of chat log DAO used by streaming platform"""
         self.chat_log_dao = chat_log_dao
 
+    def set_maintenance_dao(self, maintenance_dao):
+        """Set the value of database maintenance DAO used by streaming platform"""
+        self.maintenance_dao = maintenance_dao
+
+    def set_json_decoder(self, json_decoder):
+        """Set the value of JSON decoder of the comment DAOs created for chat exports, None for the fastest one"""
+        self.json_decoder = json_decoder
+
+    def set_payload_logging(self, payload_logging):
+        """Set how results of queries are logged, one of PAYLOAD_LOGGING_MODES"""
+        if payload_logging not in PAYLOAD_LOGGING_MODES:
+            raise ValueError("unknown payload logging mode {}".format(payload_logging))
+        self.payload_logging = payload_logging
+
+    def __log_payload(self, command, payload, record_count):
+        with instrumentation.span(command + ".log"):
+            if self.payload_logging == "summary":
+                logging.info("returned {} records ({} bytes)".format(record_count, len(payload)))
+            elif self.payload_logging == "truncated" and len(payload) > TRUNCATED_PAYLOAD_LENGTH:
+                logging.info("{}... ({} more bytes)".format(payload[:TRUNCATED_PAYLOAD_LENGTH],
+                                                            len(payload) - TRUNCATED_PAYLOAD_LENGTH))
+            else:
+                logging.info(payload)
+        instrumentation.count("bytes_written", command + ".log", len(payload))
+
     def create_channel(self, id, name):
         """
         Create channel based on the given arguments - id and name.
         """
         self.channel_dao.start_session()
-        channel = Channel(id, name)
-        self.channel_dao.insert(channel)
+        try:
+            channel = Channel(id, name)
+            with instrumentation.span("createchannel.insert"):
+                self.channel_dao.insert(channel)
 
-        channels = self.channel_dao.find_by_id(id)
-        for row in channels:
-            print(row)
+            channels = self.channel_dao.find_by_id(id)
+            for row in channels:
+                print(row)
 
-        logging.info("created channel id: {} name: {}".format(id, name))
-        self.channel_dao.save_changes()
-        self.channel_dao.close_session()
+            logging.info("created channel id: {} name: {}".format(id, name))
+            with instrumentation.span("createchannel.commit"):
+                self.channel_dao.save_changes()
+        finally:
+            self.channel_dao.close_session()
 
-    def parse_top_spam(self):
+    def parse_top_spam(self, partial_file=None):
         """
-        Process messages and store top spam messages.
+        Process messages and store top spam messages, and the spam statistics read by get_top_spam with a threshold.
+        With partial_file set, the messages are counted into a partial aggregate written to partial_file for merge.
         """
-        comments_count, comments_user_count = self.comment_dao.count_comments_and_users()
-        channel_id, stream_id = self.comment_dao.get_channel_and_stream_id(0)
+        if partial_file is None:
+            with instrumentation.span("parsetopspam.count_comments"):
+                comments_count, comments_user_count = self.comment_dao.count_comments_and_users()
+            channel_id, stream_id = self.comment_dao.get_channel_and_stream_id(0)
+        else:
+            with instrumentation.span("parsetopspam.count_comments"):
+                aggregate = self.__build_partial_aggregate()
+                comments_count, comments_user_count = aggregate.comments_count_and_users()
+            channel_id, stream_id = aggregate.channel_id, aggregate.stream_id
+            with instrumentation.span("parsetopspam.write_partial"):
+                aggregate.write(partial_file)
         self.spam_dao.start_session()
-        self.spam_dao.delete_with_channel_and_stream_id(channel_id, stream_id)
+        try:
+            with instrumentation.span("parsetopspam.delete"):
+                self.spam_dao.delete_with_channel_and_stream_id(channel_id, stream_id)
 
-        count = self.spam_dao.sort_and_insert_spam(comments_count, comments_user_count, channel_id, stream_id)
-        self.spam_dao.save_changes()
-        self.spam_dao.close_session()
+            with instrumentation.span("parsetopspam.insert"):
+                count = self.spam_dao.sort_and_insert_spam(comments_count, comments_user_count, channel_id, stream_id)
+                self.spam_dao.insert_spam_stats(comments_count, comments_user_count, channel_id, stream_id)
+            instrumentation.count("rows", "parsetopspam.insert", count)
+            with instrumentation.span("parsetopspam.commit"):
+                self.spam_dao.save_changes()
+        finally:
+            self.spam_dao.close_session()
         print("inserted {} top spam records for stream {} on channel {}".format(count, stream_id, channel_id))
         logging.info("inserted {} top spam records for stream {} on channel {}".format(count, stream_id,
                                                                                        channel_id))
 
-    def get_top_spam(self, channel_id, stream_id):
+    def __build_partial_aggregate(self):
+        aggregate = None
+        for comment in self.comment_dao.iter_comments():
+            if aggregate is None:
+                aggregate = PartialAggregate(comment["channel_id"], comment["content_id"])
+            aggregate.add(self.comment_dao.get_chat_log_from_comment(aggregate.channel_id, aggregate.stream_id,
+                                                                     comment))
+        if aggregate is None:
+            raise IndexError("no comments in {}".format(self.comment_dao.get_source_name()))
+        return aggregate
+
+    def merge_partials(self, file_names, output_file=None):
         """
-        Outputs top spam.
+        Merge the partial aggregates written to file_names by parsetopspam or storechatlog with --partial, on this or
+        other nodes, and store top spam, spam statistics and viewership of every stream in them as a single run over
+        all their comments would. With output_file set, the merged aggregates are also written to it, to be merged
+        again, which requires them to be of one stream.
         """
-        spam_key_value_list = []
+        with instrumentation.span("merge.read"):
+            aggregates = merge_partial_aggregates(PartialAggregate.read(file_name) for file_name in file_names)
+        if output_file is not None:
+            if len(aggregates) != 1:
+                raise ValueError("--output needs partial aggregates of exactly one stream")
+            aggregates[0].write(output_file)
+
         self.spam_dao.start_session()
+        try:
+            with instrumentation.span("merge.top_spam"):
+                counts = []
+                for aggregate in aggregates:
+                    comments_count, comments_user_count = aggregate.comments_count_and_users()
+                    self.spam_dao.delete_with_channel_and_stream_id(aggregate.channel_id, aggregate.stream_id)
+                    counts.append(self.spam_dao.sort_and_insert_spam(comments_count, comments_user_count,
+                                                                     aggregate.channel_id, aggregate.stream_id))
+                    self.spam_dao.insert_spam_stats(comments_count, comments_user_count, aggregate.channel_id,
+                                                    aggregate.stream_id)
+                self.spam_dao.save_changes()
+        finally:
+            self.spam_dao.close_session()
 
-        spam_list = self.spam_dao.get_all_wth_channel_and_stream_id(channel_id, stream_id)
+        self.chat_log_dao.start_session()
+        try:
+            with instrumentation.span("merge.viewership"):
+                for aggregate in aggregates:
+                    self.chat_log_dao.save_viewership_rollup(aggregate.channel_id, aggregate.stream_id,
+                                                             aggregate.viewership())
+                self.chat_log_dao.save_changes()
+        finally:
+            self.chat_log_dao.close_session()
+
+        for aggregate, count in zip(aggregates, counts):
+            print("merged {} comments into {} top spam records for stream {} on channel {}".format(
+                aggregate.comments, count, aggregate.stream_id, aggregate.channel_id))
+            logging.info("merged {} comments of {} partial aggregates into {} top spam records for stream {} on "
+                         "channel {}".format(aggregate.comments, len(file_names), count, aggregate.stream_id,
+                                             aggregate.channel_id))
+
+    def get_top_spam(self, channel_id, stream_id, threshold=None, limit=None):
+        """
+        Outputs top spam. With threshold or limit given, outputs at most limit messages sent more than threshold
+        times, 10 by default, read from the spam statistics instead of the top spam stored by parse_top_spam. Raises
+        ValueError for streams parsed before the statistics were kept.
+        """
+        spam_key_value_list = []
+        self.spam_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("gettopspam.query"):
+                if threshold is None and limit is None:
+                    spam_list = self.spam_dao.get_all_wth_channel_and_stream_id(channel_id, stream_id)
+                else:
+                    threshold = 10 if threshold is None else threshold
+                    spam_list = self.spam_dao.get_top_spam(channel_id, stream_id, threshold, limit)
+                    # top spam without any statistics means the stream was parsed before they were kept
+                    if not spam_list and not self.spam_dao.get_top_spam(
+                            channel_id, stream_id, SPAM_STATS_MIN_OCCURRENCES - 1, 1) and \
+                            self.spam_dao.get_all_wth_channel_and_stream_id(channel_id, stream_id):
+                        raise ValueError("stream {} on channel {} was parsed before spam statistics were kept, run "
+                                         "parsetopspam again".format(stream_id, channel_id))
+        finally:
+            self.spam_dao.close_session()
+        instrumentation.count("rows", "gettopspam.query", len(spam_list))
         for spam in spam_list:
             spam_key_value_list.append({"spam_text": spam.get_text(), "occurrences": spam.get_occurences(),
                                         "user_count": spam.get_user_count()})
 
-        self.spam_dao.close_session()
+        with instrumentation.span("gettopspam.serialize"):
+            payload = json.dumps(spam_key_value_list, sort_keys=True)
+        self.__log_payload("gettopspam", payload, len(spam_key_value_list))
+        print(payload)
+
+    def store_chat_log(self, resume=False, chunk_size=CHAT_LOG_CHUNK_SIZE, queue_depth=0, partial_file=None):
+        """
+        Generate and store chat log for comments. Rows are committed every chunk_size comments together with a
+        checkpoint, so with resume set an interrupted run continues after the last committed chunk instead of
+        reloading the whole stream. With queue_depth set, the export is streamed and its rows built on a parser
+        thread that runs ahead of the writes by at most queue_depth chunks. With partial_file set, the stored chat
+        logs are also counted into a partial aggregate written to partial_file for merge.
+        """
+        if resume and partial_file is not None:
+            raise ValueError("a partial aggregate needs every comment, so it cannot be written with resume")
+        if chunk_size < 1:
+            raise ValueError("chunk size must be positive, not {}".format(chunk_size))
+        self.chat_log_dao.start_session()
+        try:
+            with instrumentation.span("storechatlog.read_comments"):
+                if queue_depth:
+                    comments = self.comment_dao.iter_comments()
+                    first_comment = next(comments, None)
+                    if first_comment is None:
+                        raise IndexError("no comments in {}".format(self.comment_dao.get_source_name()))
+                    comments = itertools.chain([first_comment], comments)
+                    channel_id, stream_id = first_comment["channel_id"], first_comment["content_id"]
+                else:
+                    comments = self.comment_dao.get_all_comments()
+                    channel_id, stream_id = self.comment_dao.get_channel_and_stream_id(0)
+            source_name = self.comment_dao.get_source_name()
+
+            start_index = None
+            if resume:
+                start_index = self.chat_log_dao.get_checkpoint(source_name, channel_id, stream_id)
+            if start_index is None:
+                start_index = 0
+                with instrumentation.span("storechatlog.delete"):
+                    self.chat_log_dao.delete_with_channel_id_stream_id(channel_id, stream_id)
+                    self.chat_log_dao.delete_emotes_and_badges(channel_id, stream_id)
+                    self.chat_log_dao.save_checkpoint(source_name, channel_id, stream_id, 0)
+                    self.chat_log_dao.save_changes()
+
+            inserted = 0
+            aggregate = None if partial_file is None else PartialAggregate(channel_id, stream_id)
+
+            def write(rows):
+                nonlocal inserted
+                chunk_end, chat_logs, emotes, badges = rows
+                with instrumentation.span("storechatlog.insert"):
+                    for chat_log in chat_logs:
+                        self.chat_log_dao.insert(chat_log)
+                    self.chat_log_dao.insert_emotes(emotes)
+                    self.chat_log_dao.insert_badges(badges)
+                instrumentation.count("rows", "storechatlog.insert", len(chat_logs))
+                with instrumentation.span("storechatlog.commit"):
+                    self.chat_log_dao.save_checkpoint(source_name, channel_id, stream_id, chunk_end)
+                    self.chat_log_dao.save_changes()
+                inserted += len(chat_logs)
+                if aggregate is not None:
+                    with instrumentation.span("storechatlog.aggregate"):
+                        for chat_log in chat_logs:
+                            aggregate.add(chat_log)
+
+            chunks = self.__build_chat_log_rows(comments, channel_id, stream_id, start_index, chunk_size)
+            if queue_depth:
+                stats = ParseWritePipeline(queue_depth).run(lambda: chunks, write)
+                logging.info("storechatlog pipeline: {}".format(json.dumps(stats, sort_keys=True)))
+            else:
+                for rows in chunks:
+                    write(rows)
+            with instrumentation.span("storechatlog.user_activity"):
+                self.chat_log_dao.refresh_user_activity(channel_id, stream_id)
+                self.chat_log_dao.save_changes()
+        finally:
+            self.chat_log_dao.close_session()
+        if aggregate is not None:
+            with instrumentation.span("storechatlog.write_partial"):
+                aggregate.write(partial_file)
+
+        print("inserted {} records to chat log for stream {} on channel {}".format(inserted, stream_id, channel_id))
+        logging.info("inserted {} records to chat log for stream {} on channel {}".format(inserted, stream_id,
+                                                                                          channel_id))
+
+    def __build_chat_log_rows(self, comments, channel_id, stream_id, start_index, chunk_size):
+        """Yield (index after the chunk, chat logs, emotes, badges) of every chunk of chunk_size comments after the
+        first start_index comments."""
+        comments = iter(comments)
+        for _ in itertools.islice(comments, start_index):
+            pass
+        chunk_start = start_index
+        while True:
+            chunk = list(itertools.islice(comments, chunk_size))
+            if not chunk:
+                return
+            with instrumentation.span("storechatlog.build_rows"):
+                chat_logs, emotes, badges = [], [], []
+                for message_index, comment in enumerate(chunk, chunk_start):
+                    chat_log = self.comment_dao.get_chat_log_from_comment(channel_id, stream_id, comment)
+                    chat_logs.append(chat_log)
+                    emotes.extend((channel_id, stream_id, message_index, chat_log.offset, emoticon_id, emote)
+                                  for emoticon_id, emote in self.comment_dao.get_emotes_from_comment(comment))
+                    badges.extend((channel_id, stream_id, message_index, chat_log.user, badge, version)
+                                  for badge, version in self.comment_dao.get_badges_from_comment(comment))
+            chunk_start += len(chunk)
+            yield chunk_start, chat_logs, emotes, badges
+
+    def ingest(self, viewership=True, full_text=False):
+        """
+        Store chat log, top spam, emotes and badges of the comments, and with viewership and full_text set also their
+        viewership metrics and full text index, in one pass over the comments and one transaction. The chat log and
+        spam DAOs must share their connection, as they do when created with PooledSqliteConnectionFactory.
+        """
+        sinks = [ChatLogSink(self.chat_log_dao, self.comment_dao.get_source_name()), TopSpamSink(self.spam_dao),
+                 EmoteBadgeSink(self.chat_log_dao, self.comment_dao)]
+        if viewership:
+            sinks.append(ViewershipSink(self.chat_log_dao))
+        if full_text:
+            sinks.append(FullTextSink(self.chat_log_dao))
+
+        self.chat_log_dao.start_session()
+        self.spam_dao.start_session()
+        try:
+            channel_id, stream_id, counts = IngestPipeline(sinks).run(self.comment_dao)
+            with instrumentation.span("ingest.commit"):
+                self.chat_log_dao.save_changes()
+                self.spam_dao.save_changes()
+        finally:
+            self.spam_dao.close_session()
+            self.chat_log_dao.close_session()
+
+        print("inserted {} records to chat log for stream {} on channel {}".format(counts[0], stream_id, channel_id))
+        print("inserted {} top spam records for stream {} on channel {}".format(counts[1], stream_id, channel_id))
+        logging.info("ingested {} records to chat log and {} top spam records for stream {} on channel {}".format(
+            counts[0], counts[1], stream_id, channel_id))
+
+    def archive_stream(self, channel_id, stream_id):
+        """
+        Move chat log of the stream from the database to a columnar segment file read by the chat log queries.
+        """
+        self.chat_log_dao.start_session()
+        try:
+            with instrumentation.span("archive.write"):
+                archived = self.chat_log_dao.archive_stream(channel_id, stream_id)
+            with instrumentation.span("archive.commit"):
+                self.chat_log_dao.save_changes()
+        finally:
+            self.chat_log_dao.close_session()
 
-        logging.info((json.dumps(spam_key_value_list, sort_keys=True)))
-        print(json.dumps(spam_key_value_list, sort_keys=True))
+        if archived is None:
+            message = "no chat log to archive for stream {} on channel {}".format(stream_id, channel_id)
+        else:
+            message = "archived {} records of stream {} on channel {} to {} ({} bytes)".format(
+                archived[0], stream_id, channel_id, self.chat_log_dao.segment_name(channel_id, stream_id), archived[1])
+        print(message)
+        logging.info(message)
 
-    def store_chat_log(self):
+    def restore_stream(self, channel_id, stream_id):
         """
-        Generate and store chat log for comments.
+        Move chat log of an archived stream back from its segment file to the database.
         """
         self.chat_log_dao.start_session()
-        chatlog_comments = self.comment_dao.get_all_comments()
-        channel_id, stream_id = self.comment_dao.get_channel_and_stream_id(0)
-        self.chat_log_dao.delete_with_channel_id_stream_id(channel_id, stream_id)
-
-        for comment in chatlog_comments:
-            self.chat_log_dao.insert(self.comment_dao.get_chat_log_from_comment(channel_id, stream_id, comment))
-        self.chat_log_dao.save_changes()
-        self.chat_log_dao.close_session()
-        print("inserted {} records to chat log for stream {} on channel {}".format(len(chatlog_comments), stream_id,
-                                                                                   channel_id))
-        logging.info(
-            "inserted {} records to chat log for stream {} on channel {}".format(len(chatlog_comments), stream_id,
-                                                                                 channel_id))
+        try:
+            with instrumentation.span("restore.insert"):
+                restored = self.chat_log_dao.restore_stream(channel_id, stream_id)
+            with instrumentation.span("restore.commit"):
+                self.chat_log_dao.save_changes()
+        finally:
+            self.chat_log_dao.close_session()
+        self.chat_log_dao.remove_segment(channel_id, stream_id)
+
+        if restored is None:
+            message = "stream {} on channel {} is not archived".format(stream_id, channel_id)
+        else:
+            message = "restored {} records of stream {} on channel {}".format(restored, stream_id, channel_id)
+        print(message)
+        logging.info(message)
 
     def query_chat_log(self, filters):
         """
         Outputs chat logs that satisfy given arguments.
         """
-        self.chat_log_dao.start_session()
-        chat_logs = self.chat_log_dao.select_where_filter_conditions_are_satisfied(filters)
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("querychatlog.query"):
+                chat_logs = self.chat_log_dao.select_where_filter_conditions_are_satisfied(filters)
+        finally:
+            self.chat_log_dao.close_session()
+        instrumentation.count("rows", "querychatlog.query", len(chat_logs))
         list_of_chat_log_dict = []
         for chat_log in chat_logs:
             chat_log_dict = chat_log.convert_to_dict()
             list_of_chat_log_dict.append(chat_log_dict)
+        with instrumentation.span("querychatlog.serialize"):
+            payload = json.dumps(list_of_chat_log_dict, sort_keys=True)
+        self.__log_payload("querychatlog", payload, len(list_of_chat_log_dict))
+        print(payload)
 
-        self.chat_log_dao.close_session()
-        logging.info((json.dumps(list_of_chat_log_dict, sort_keys=True)))
-        print(json.dumps(list_of_chat_log_dict, sort_keys=True))
-
-    def get_top_spam2(self, channel_id, stream_id):
+    def get_top_spam2(self, channel_id, stream_id, normalized=False):
         """Takes channel_id and stream_id and produces the same output as get_top_spam, provided the data for the
         channel and stream has already been loaded. If no data has been loaded, empty list will appear in the output.
+        With normalized set, messages of the same normalized key are counted as one message with the key as text.
         """
-        self.chat_log_dao.start_session()
-        spam_list = self.chat_log_dao.get_spam_list(channel_id, stream_id, 10)
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("gettopspam2.query"):
+                if normalized:
+                    spam_list = self.chat_log_dao.get_normalized_spam_list(channel_id, stream_id, 10)
+                else:
+                    spam_list = self.chat_log_dao.get_spam_list(channel_id, stream_id, 10)
+        finally:
+            self.chat_log_dao.close_session()
 
         spam_key_value_list = []
         for spam in spam_list:
@@ -129,18 +473,224 @@ class StreamingPlatform:
                                         "spam_text": spam.get_text(),
                                         "user_count": spam.get_user_count()})
 
-        self.chat_log_dao.close_session()
+        with instrumentation.span("gettopspam2.serialize"):
+            payload = json.dumps(spam_key_value_list)
+        self.__log_payload("gettopspam2", str(spam_key_value_list), len(spam_key_value_list))
+        print(payload)
+
+    def apply_retention(self, policy, batch_size=RETENTION_BATCH_SIZE, vacuum_pages=RETENTION_VACUUM_PAGES,
+                        dry_run=False, now=None):
+        """
+        Archive or delete the streams expired by the retention policy, then give free pages back to the file system
+        and refresh the statistics of the query planner. Outputs what was done.
+        """
+        service = RetentionService(self.chat_log_dao, self.spam_dao, self.maintenance_dao, batch_size, vacuum_pages)
+        report = service.apply(policy, now, dry_run)
+        payload = json.dumps(report, sort_keys=True)
+        self.__log_payload("retention", payload, len(report["expired_streams"]))
+        print(payload)
+
+    def purge_streams(self, channel_id, stream_id=None, batch_size=RETENTION_BATCH_SIZE,
+                      vacuum_pages=RETENTION_VACUUM_PAGES):
+        """
+        Delete everything stored for the stream, or for every stream of the channel without stream_id, and compact
+        the database. Outputs what was done.
+        """
+        service = RetentionService(self.chat_log_dao, self.spam_dao, self.maintenance_dao, batch_size, vacuum_pages)
+        report = service.purge(channel_id, stream_id)
+        payload = json.dumps(report, sort_keys=True)
+        self.__log_payload("purge", payload, len(report["purged_streams"]))
+        print(payload)
+
+    def export_streams(self, channel_id, stream_ids=None, table_names=EXPORT_TABLES, directory=EXPORT_DIRECTORY,
+                       export_format="csv", compression="none", rows_per_file=EXPORT_ROWS_PER_FILE,
+                       workers=EXPORT_WORKERS):
+        """
+        Write table_names of the streams of the channel, every stream with chat log without stream_ids, to CSV or
+        NDJSON files in directory, streamed from the database and exported workers streams at once. Outputs the
+        files written and the number of rows of every table.
+        """
+        if not stream_ids:
+            self.chat_log_dao.start_session(read_only=True)
+            try:
+                stream_ids = sorted(self.chat_log_dao.get_stream_ids(channel_id))
+            finally:
+                self.chat_log_dao.close_session()
+        service = ExportService(self.chat_log_dao, self.spam_dao,
+                                TableExporter(directory, export_format, compression, rows_per_file), workers)
+        report = service.export_streams([(channel_id, stream_id) for stream_id in stream_ids], table_names)
+        payload = json.dumps(report, sort_keys=True)
+        self.__log_payload("export", payload, len(report["files"]))
+        print(payload)
+
+    def top_chatters(self, channel_id, stream_id, limit):
+        """
+        Outputs the limit users who sent most messages in the stream, with their number of messages and first and
+        last chat time.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("topchatters.query"):
+                top_chatters = self.chat_log_dao.get_top_chatters(channel_id, stream_id, limit)
+        finally:
+            self.chat_log_dao.close_session()
 
-        logging.info(eval((json.dumps(spam_key_value_list))))
-        print(eval(json.dumps(json.dumps(spam_key_value_list))))
+        with instrumentation.span("topchatters.serialize"):
+            payload = json.dumps(top_chatters, sort_keys=True)
+        self.__log_payload("topchatters", payload, len(top_chatters))
+        print(payload)
+
+    def top_emotes(self, channel_id, stream_id, limit):
+        """
+        Outputs the limit most used emotes of every minute of the stream, with the number of times they were used.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("topemotes.query"):
+                top_emotes = self.chat_log_dao.get_top_emotes_per_minute(channel_id, stream_id, limit)
+        finally:
+            self.chat_log_dao.close_session()
+
+        with instrumentation.span("topemotes.serialize"):
+            payload = json.dumps(top_emotes, sort_keys=True)
+        self.__log_payload("topemotes", payload, len(top_emotes))
+        print(payload)
+
+    def badge_share(self, channel_id, stream_id, badge):
+        """
+        Outputs share of the messages and chatters of the stream that wore badge, subscriber by default.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("badgeshare.query"):
+                share = self.chat_log_dao.get_badge_share(channel_id, stream_id, badge)
+        finally:
+            self.chat_log_dao.close_session()
+
+        with instrumentation.span("badgeshare.serialize"):
+            payload = json.dumps(share, sort_keys=True)
+        self.__log_payload("badgeshare", payload, 1)
+        print(payload)
+
+    def user_history(self, user, message_limit):
+        """
+        Outputs number of messages, streams and first and last chat time of the user over all streams, the activity
+        in every stream and the last message_limit messages of the user.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("userhistory.query"):
+                streams = self.chat_log_dao.get_user_activity(user)
+                chat_logs = self.chat_log_dao.get_recent_messages(user, message_limit)
+        finally:
+            self.chat_log_dao.close_session()
+
+        history = {"user": user, "messages": sum(stream["messages"] for stream in streams), "streams": len(streams),
+                   "first_seen": min((stream["first_seen"] for stream in streams), default=None),
+                   "last_seen": max((stream["last_seen"] for stream in streams), default=None),
+                   "per_stream": streams,
+                   "recent_messages": [chat_log.convert_to_dict() for chat_log in chat_logs]}
+        with instrumentation.span("userhistory.serialize"):
+            payload = json.dumps(history, sort_keys=True)
+        self.__log_payload("userhistory", payload, len(chat_logs))
+        print(payload)
+
+    def channel_top_spam(self, channel_id, stream_count, limit, threshold=10):
+        """
+        Outputs at most limit messages sent more than threshold times in the last stream_count streams of the
+        channel together, ranked like get_top_spam2, with the number of streams they were sent in.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("channeltopspam.query"):
+                stream_ids = self.chat_log_dao.get_stream_ids(channel_id, stream_count)
+                stream_counts = self.chat_log_dao.count_messages_by_user(channel_id, stream_ids)
+        finally:
+            self.chat_log_dao.close_session()
+
+        with instrumentation.span("channeltopspam.merge"):
+            occurrences = {}
+            users = {}
+            streams = {}
+            for stream_count_by_user in stream_counts:
+                for (text, user), count in stream_count_by_user.items():
+                    occurrences[text] = occurrences.get(text, 0) + count
+                    users.setdefault(text, set()).add(user)
+                for text in set(text for text, user in stream_count_by_user):
+                    streams[text] = streams.get(text, 0) + 1
+            spam_list = rank_spam(channel_id, None, occurrences, {text: len(users[text]) for text in users}, threshold,
+                                  limit)
+        spam_key_value_list = [{"occurrences": spam.get_occurences(), "spam_text": spam.get_text(),
+                                "user_count": spam.get_user_count(), "stream_count": streams[spam.get_text()]}
+                               for spam in spam_list]
+
+        with instrumentation.span("channeltopspam.serialize"):
+            payload = json.dumps(spam_key_value_list, sort_keys=True)
+        self.__log_payload("channeltopspam", payload, len(spam_key_value_list))
+        print(payload)
+
+    def spam_timeline(self, channel_id, stream_id, window_seconds, threshold=10, limit=10):
+        """
+        Outputs at most limit messages sent more than threshold times in each window of window_seconds seconds of
+        the stream, ranked like get_top_spam2, with the number of messages of the window. Windows without messages
+        are left out.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("spamtimeline.query"):
+                timeline = self.chat_log_dao.get_spam_timeline(channel_id, stream_id, window_seconds, threshold, limit)
+        finally:
+            self.chat_log_dao.close_session()
+
+        key_value_list = [{"window": window, "start_offset": window * window_seconds,
+                           "end_offset": (window + 1) * window_seconds, "messages": messages,
+                           "spam": [{"occurrences": spam.get_occurences(), "spam_text": spam.get_text(),
+                                     "user_count": spam.get_user_count()} for spam in spam_list]}
+                          for window, messages, spam_list in timeline]
+        with instrumentation.span("spamtimeline.serialize"):
+            payload = json.dumps(key_value_list, sort_keys=True)
+        self.__log_payload("spamtimeline", payload, len(key_value_list))
+        print(payload)
+
+    def channel_viewership(self, channel_id, stream_count):
+        """
+        Outputs viewership of each of the last stream_count streams of the channel, oldest first: number of minutes
+        and messages, and the peak and average number of viewers per minute.
+        """
+        self.chat_log_dao.start_session(read_only=True)
+        try:
+            with instrumentation.span("channelviewership.query"):
+                stream_ids = sorted(self.chat_log_dao.get_stream_ids(channel_id, stream_count))
+                stream_metrics = self.chat_log_dao.get_viewership_by_stream(channel_id, stream_ids)
+        finally:
+            self.chat_log_dao.close_session()
+
+        key_value_list = []
+        for stream_id, metrics in zip(stream_ids, stream_metrics):
+            per_minute = metrics[0]["per_minute"]
+            viewers = [minute["viewers"] for minute in per_minute]
+            key_value_list.append({"stream_id": stream_id, "starttime": metrics[0]["starttime"],
+                                   "minutes": len(per_minute),
+                                   "messages": sum(minute["messages"] for minute in per_minute),
+                                   "peak_viewers": max(viewers), "average_viewers": round(sum(viewers) / len(viewers),
+                                                                                          2)})
+
+        with instrumentation.span("channelviewership.serialize"):
+            payload = json.dumps(key_value_list, sort_keys=True)
+        self.__log_payload("channelviewership", payload, len(key_value_list))
+        print(payload)
 
     def viewership_metrics(self, channel_id, stream_id):  # pragma: no cover
         """Outputs per minute message and viewer counts for the specified stream and channel that
         has been persisted via the storechatlog command. If no such data has been persisted, outputs empty list.
         """
-        self.chat_log_dao.start_session()  # pragma: no cover
-        key_value_list = self.chat_log_dao.get_viewership_metrics(channel_id, stream_id)  # pragma: no cover
-
-        self.chat_log_dao.close_session()  # pragma: no cover
-        logging.info(json.dumps(key_value_list))  # pragma: no cover
-        print(json.dumps(key_value_list))  # pragma: no cover
+        self.chat_log_dao.start_session(read_only=True)  # pragma: no cover
+        try:  # pragma: no cover
+            with instrumentation.span("viewership.query"):  # pragma: no cover
+                key_value_list = self.chat_log_dao.get_viewership_metrics(channel_id, stream_id)  # pragma: no cover
+        finally:  # pragma: no cover
+            self.chat_log_dao.close_session()  # pragma: no cover
+        with instrumentation.span("viewership.serialize"):  # pragma: no cover
+            payload = json.dumps(key_value_list)  # pragma: no cover
+        self.__log_payload("viewership", payload, len(key_value_list))  # pragma: no cover
+        print(payload)  # pragma: no cover
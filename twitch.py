@@ -1,42 +1,358 @@
 """
 Accepts command line arguments and manipulates data for Twitch Streaming platform based on those arguments.
 """
+import sys
 from argparse import *
-from streaming_platform import *
+from config import *
+
+# the streaming platform, DAOs and logging are imported by the functions that need them, so that --help and
+# argument errors do not pay for loading them
+
+# line written after the output of every command of a batch, followed by a JSON object with its index, command
+# and exit status
+BATCH_DELIMITER = "#END "
+
+# DAOs used by each command, commands not listed here get all of them
+COMMAND_DAOS = {"createchannel": ("channel",), "parsetopspam": ("spam",), "gettopspam": ("spam",),
+                "storechatlog": ("chat_log",), "querychatlog": ("chat_log",), "gettopspam2": ("chat_log",),
+                "viewership": ("chat_log",), "watch": ("spam", "chat_log"), "ingest": ("spam", "chat_log"),
+                "archive": ("chat_log",), "restore": ("chat_log",), "channeltopspam": ("chat_log",),
+                "channelviewership": ("chat_log",), "topchatters": ("chat_log",), "userhistory": ("chat_log",),
+                "topemotes": ("chat_log",), "badgeshare": ("chat_log",),
+                "retention": ("spam", "chat_log", "maintenance"), "purge": ("spam", "chat_log", "maintenance"),
+                "export": ("spam", "chat_log"), "spamtimeline": ("chat_log",), "merge": ("spam", "chat_log")}
+
+
+def archive_directory(arguments, database_name):
+    """Return directory of the segment files of archived streams: arguments.archive_dir if given, otherwise one that
+    belongs to the database selected by the global arguments, so that no database reads the segments of another."""
+    import os
+
+    if arguments.archive_dir:
+        return arguments.archive_dir
+    if arguments.backend == "memory":
+        # streams archived from the memory go away with it
+        import atexit
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp(prefix=ARCHIVE_DIRECTORY + "_")
+        atexit.register(shutil.rmtree, directory, True)
+        return directory
+    if arguments.shard_dir:
+        return os.path.join(arguments.shard_dir, ARCHIVE_DIRECTORY)
+    return database_name + ARCHIVE_DIRECTORY_SUFFIX
+
+
+def create_streaming_platform(arguments, database_name, logging_file_name, connection_factory=None):
+    """Return streaming platform with the DAOs needed by arguments.command, selected by the global arguments."""
+    from streaming_platform import StreamingPlatform
+    import dao
+
+    if connection_factory is None:
+        connection_factory = dao.default_connection_factory
+    if arguments.backend == "memory":
+        # one memory database per streaming platform, so the commands of a batch see each other's rows
+        memory_database = dao.MemoryDatabase()
+        dao_factories = {"channel": lambda: dao.ChannelDaoMemoryImplementation(memory_database),
+                         "spam": lambda: dao.SpamDaoMemoryImplementation(memory_database),
+                         "chat_log": lambda: dao.ChatLogDaoMemoryImplementation(memory_database),
+                         "maintenance": lambda: dao.DatabaseMaintenanceDaoMemoryImplementation(memory_database)}
+    elif arguments.shard_dir:
+        shard_router = dao.ShardRouter(arguments.shard_dir)
+        dao_factories = {"channel": lambda: dao.ChannelDaoShardedImplementation(shard_router, connection_factory),
+                         "spam": lambda: dao.SpamDaoShardedImplementation(shard_router, connection_factory),
+                         "chat_log": lambda: dao.ChatLogDaoShardedImplementation(shard_router, connection_factory),
+                         "maintenance": lambda: dao.DatabaseMaintenanceDaoShardedImplementation(shard_router,
+                                                                                                connection_factory)}
+    else:
+        dao_factories = {"channel": lambda: dao.ChannelDaoSqlLiteImplementation(database_name, connection_factory),
+                         "spam": lambda: dao.SpamDaoSqlLiteImplementation(database_name, connection_factory),
+                         "chat_log": lambda: dao.ChatLogDaoSqlLiteImplementation(database_name, connection_factory),
+                         "maintenance": lambda: dao.DatabaseMaintenanceDaoSqlLiteImplementation(database_name,
+                                                                                                connection_factory)}
+    needed_daos = COMMAND_DAOS.get(arguments.command, ("channel", "spam", "chat_log", "maintenance"))
+
+    twitch = StreamingPlatform(logging_file_name)
+    twitch.set_payload_logging(arguments.log_payload)
+    twitch.set_json_decoder(dao.create_json_decoder(arguments.json_decoder))
+    dao.set_spam_normalization(arguments.spam_normalization)
+    if "channel" in needed_daos:
+        twitch.set_channel_dao(dao_factories["channel"]())
+    if "spam" in needed_daos:
+        twitch.set_spam_dao(dao_factories["spam"]())
+    if "chat_log" in needed_daos:
+        twitch.set_chat_log_dao(dao.ChatLogDaoArchiveImplementation(dao_factories["chat_log"](),
+                                                                    archive_directory(arguments, database_name)))
+    if "maintenance" in needed_daos:
+        twitch.set_maintenance_dao(dao_factories["maintenance"]())
+    return twitch
 
 
 def process_arguments(arguments, database_name, logging_file_name):
     """Process arguments and call appropriate function based on their type."""
-    twitch = StreamingPlatform(logging_file_name)
-    channel_dao = ChannelDaoSqlLiteImplementation(database_name)
-    spam_dao = SpamDaoSqlLiteImplementation("twitch.db")
-    chat_log_dao = ChatLogDaoSqlLiteImplementation("twitch.db")
-    twitch.set_channel_dao(channel_dao)
-    twitch.set_spam_dao(spam_dao)
-    twitch.set_chat_log_dao(chat_log_dao)
+    if arguments.command == "batch" and arguments.jobs > 1:
+        return run_batch_jobs(arguments, database_name, logging_file_name)
+
+    if arguments.command in ("batch", "ingest"):
+        # ingest commits the chat log and top spam in one transaction of the shared connection
+        from dao import PooledSqliteConnectionFactory
+        connection_factory = PooledSqliteConnectionFactory()
+        twitch = create_streaming_platform(arguments, database_name, logging_file_name, connection_factory)
+        try:
+            if arguments.command == "batch":
+                return run_batch(twitch, arguments, connection_factory)
+            return run_command(twitch, arguments)
+        finally:
+            connection_factory.close_all()
+
+    if arguments.command == "watch":
+        return run_watch(arguments, database_name, logging_file_name)
+
+    twitch = create_streaming_platform(arguments, database_name, logging_file_name)
+    return run_command(twitch, arguments)
+
+
+def run_watch(arguments, database_name, logging_file_name):
+    """Ingest chat exports written to arguments.directory, queueing them in database_name."""
+    from dao import IngestQueueDaoSqlLiteImplementation
+    from watcher import WatchService
+
+    service = WatchService(arguments.directory, lambda: IngestQueueDaoSqlLiteImplementation(database_name),
+                           lambda: create_streaming_platform(arguments, database_name, logging_file_name),
+                           arguments.workers, arguments.settle, arguments.poll_interval, arguments.pattern,
+                           arguments.polling)
+    try:
+        return service.run(arguments.once)
+    except KeyboardInterrupt:  # pragma: no cover
+        return 0  # pragma: no cover
+
+
+def read_batch_commands(lines):
+    """Return argument lists of the commands in lines. Every line is either a JSON array of arguments, a JSON object
+    with "command" and optional "args", or a shell-quoted command line. Blank lines and # comments are skipped."""
+    import json
+    import shlex
+
+    commands = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("["):
+            commands.append([str(argument) for argument in json.loads(line)])
+        elif line.startswith("{"):
+            command = json.loads(line)
+            commands.append([command["command"]] + [str(argument) for argument in command.get("args", [])])
+        else:
+            commands.append(shlex.split(line))
+    return commands
+
+
+def read_batch_file(file_name):
+    """Return argument lists of the commands listed in file_name, "-" for standard input."""
+    if file_name == "-":
+        return read_batch_commands(sys.stdin)
+    with open(file_name) as file:
+        return read_batch_commands(file)
+
+
+def parse_batch_command(argument_parser, index, command_arguments, batch_arguments):
+    """Return arguments of the command at index of a batch, its query budget defaulting to the one of the batch, or
+    the exit status of the command if it cannot be run."""
+    import logging
+
+    try:
+        arguments = argument_parser.parse_args(command_arguments)
+        if arguments.command in (None, "batch"):
+            raise ValueError("not a batch command: {}".format(" ".join(command_arguments)))
+    except SystemExit:
+        # argparse already reported the error
+        return 2
+    except Exception as error:
+        print("error in command {}: {}".format(index, error), file=sys.stderr)
+        logging.exception("error in batch command {}".format(index))
+        return -1
+    if arguments.max_seconds is None:
+        arguments.max_seconds = batch_arguments.max_seconds
+    if arguments.max_rows is None:
+        arguments.max_rows = batch_arguments.max_rows
+    return arguments
+
+
+def run_batch_command(twitch, index, arguments, connection_factory):
+    """Run the command at index of a batch with the DAOs of twitch and return its exit status. What a failed command
+    did not commit is rolled back on the pooled connections of connection_factory, so later commands are not locked
+    out."""
+    import logging
+
+    try:
+        return run_command(twitch, arguments)
+    except Exception as error:
+        connection_factory.rollback_all()
+        print("error in command {}: {}".format(index, error), file=sys.stderr)
+        logging.exception("error in batch command {}".format(index))
+        return -1
+
+
+def print_batch_delimiter(index, command_arguments, status):
+    """Write the BATCH_DELIMITER line following the output of the command at index of a batch."""
+    import json
+
+    print(BATCH_DELIMITER + json.dumps({"index": index, "command": command_arguments[0] if command_arguments
+                                        else None, "status": status}, sort_keys=True))
+    sys.stdout.flush()
+
+
+def run_batch(twitch, batch_arguments, connection_factory):
+    """Run every command listed in batch_arguments.file ("-" for standard input) with the DAOs of twitch, whose
+    connections come from the PooledSqliteConnectionFactory connection_factory, and write a BATCH_DELIMITER line after
+    the output of each. Return 0 if every command succeeded, -1 otherwise."""
+    commands = read_batch_file(batch_arguments.file)
+    argument_parser = setup_argument_parser()
+    batch_status = 0
+    for index, command_arguments in enumerate(commands):
+        arguments = parse_batch_command(argument_parser, index, command_arguments, batch_arguments)
+        if isinstance(arguments, int):
+            status = arguments
+        else:
+            status = run_batch_command(twitch, index, arguments, connection_factory)
+        if status != 0:
+            batch_status = -1
+        print_batch_delimiter(index, command_arguments, status)
+    return batch_status
+
+
+def run_batch_jobs(batch_arguments, database_name, logging_file_name):
+    """Run the commands of batch_arguments.file like run_batch, batch_arguments.jobs of them at once, each thread
+    with DAOs and connections of its own. batch_arguments.reserved_slots of the slots are kept for CHEAP_COMMANDS, so
+    that lookups are not held up by heavy analytics. Outputs are written in the order of the file as the commands
+    finish, which is why the commands must not depend on each other."""
+    import io
+    import threading
+    from dao import PooledSqliteConnectionFactory
+    from governor import AdmissionController, ThreadOutput, cancel_query_budgets
+
+    if batch_arguments.backend == "memory":
+        raise ValueError("every job would get a memory database of its own, so --jobs needs the sqlite backend")
+    reserved_slots = batch_arguments.reserved_slots
+    if reserved_slots is None:
+        reserved_slots = min(BATCH_RESERVED_SLOTS, batch_arguments.jobs - 1)
+    admission_controller = AdmissionController(batch_arguments.jobs, reserved_slots)
+
+    commands = read_batch_file(batch_arguments.file)
+    argument_parser = setup_argument_parser()
+    results = {}
+    jobs = []
+    for index, command_arguments in enumerate(commands):
+        arguments = parse_batch_command(argument_parser, index, command_arguments, batch_arguments)
+        if isinstance(arguments, int):
+            results[index] = ("", arguments)
+        else:
+            jobs.append((index, arguments))
+
+    def is_cheap(job):
+        return job[1].command in CHEAP_COMMANDS
+
+    output = ThreadOutput(sys.stdout)
+
+    def run_jobs():
+        connection_factory = PooledSqliteConnectionFactory()
+        twitch = create_streaming_platform(batch_arguments, database_name, logging_file_name, connection_factory)
+        try:
+            while True:
+                job = admission_controller.admit(jobs, is_cheap)
+                if job is None:
+                    return
+                index, arguments = job
+                with output.capture(io.StringIO()) as buffer:
+                    status = run_batch_command(twitch, index, arguments, connection_factory)
+                admission_controller.release(is_cheap(job))
+                with admission_controller.condition:
+                    results[index] = (buffer.getvalue(), status)
+                    admission_controller.condition.notify_all()
+        finally:
+            connection_factory.close_all()
+
+    threads = [threading.Thread(target=run_jobs) for _ in range(batch_arguments.jobs)]
+    standard_output = sys.stdout
+    sys.stdout = output
+    try:
+        for thread in threads:
+            thread.start()
+        batch_status = 0
+        for index, command_arguments in enumerate(commands):
+            with admission_controller.condition:
+                while index not in results:
+                    admission_controller.condition.wait()
+                command_output, status = results.pop(index)
+            if status != 0:
+                batch_status = -1
+            standard_output.write(command_output)
+            print_batch_delimiter(index, command_arguments, status)
+        return batch_status
+    except KeyboardInterrupt:
+        admission_controller.clear(jobs)
+        cancel_query_budgets()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        sys.stdout = standard_output
+
+
+def run_command(twitch, arguments):
+    """Call function of twitch that handles arguments.command, within the query budget given by arguments. Return -1
+    if the queries of the command ran out of their budget or were cancelled."""
+    import logging
+    from governor import QueryBudget, QueryBudgetExceeded, query_budget
+
+    try:
+        with query_budget(QueryBudget(arguments.max_seconds, arguments.max_rows)):
+            return dispatch_command(twitch, arguments)
+    except QueryBudgetExceeded as error:
+        print("{} stopped: {}".format(arguments.command, error), file=sys.stderr)
+        logging.warning("{} stopped: {}".format(arguments.command, error))
+        return -1
+
+
+def dispatch_command(twitch, arguments):
+    """Call function of twitch that handles arguments.command."""
+    from dao import CommentDaoJSONImpl
 
     if arguments.command == "createchannel":
         twitch.create_channel(arguments.id, arguments.name)
 
     elif arguments.command == "parsetopspam":
         try:
-            comment_dao = CommentDaoJSONImpl(arguments.file)
+            comment_dao = CommentDaoJSONImpl(arguments.file, twitch.json_decoder)
             twitch.set_comment_dao(comment_dao)
-            twitch.parse_top_spam()
+            twitch.parse_top_spam(arguments.partial)
         except IndexError:
             return -1
 
     elif arguments.command == "gettopspam":
         try:
-            twitch.get_top_spam(arguments.channel_id, arguments.stream_id)
+            twitch.get_top_spam(arguments.channel_id, arguments.stream_id, arguments.threshold, arguments.limit)
         except AttributeError:
             return -1
+        except ValueError as error:
+            # the spam statistics of the stream are missing
+            print(error, file=sys.stderr)
+            return -1
 
     elif arguments.command == "storechatlog":
         try:
-            comment_dao = CommentDaoJSONImpl(arguments.file)
+            comment_dao = CommentDaoJSONImpl(arguments.file, twitch.json_decoder)
             twitch.set_comment_dao(comment_dao)
-            twitch.store_chat_log()
+            twitch.store_chat_log(arguments.resume, arguments.chunk_size, arguments.queue_depth, arguments.partial)
+        except IndexError:
+            return -1
+
+    elif arguments.command == "ingest":
+        try:
+            comment_dao = CommentDaoJSONImpl(arguments.file, twitch.json_decoder)
+            twitch.set_comment_dao(comment_dao)
+            twitch.ingest(not arguments.no_viewership, arguments.full_text)
         except IndexError:
             return -1
 
@@ -45,10 +361,58 @@ def process_arguments(arguments, database_name, logging_file_name):
             twitch.query_chat_log(arguments.filters)
         except AttributeError:
             return -1
+        except ValueError as error:
+            # a match filter covers streams missing from the full text index
+            print(error, file=sys.stderr)
+            return -1
+
+    elif arguments.command == "archive":
+        twitch.archive_stream(arguments.channel_id, arguments.stream_id)
+
+    elif arguments.command == "restore":
+        twitch.restore_stream(arguments.channel_id, arguments.stream_id)
+
+    elif arguments.command == "topchatters":
+        twitch.top_chatters(arguments.channel_id, arguments.stream_id, arguments.limit)
+
+    elif arguments.command == "userhistory":
+        twitch.user_history(arguments.user, arguments.messages)
+
+    elif arguments.command == "topemotes":
+        twitch.top_emotes(arguments.channel_id, arguments.stream_id, arguments.limit)
+
+    elif arguments.command == "badgeshare":
+        twitch.badge_share(arguments.channel_id, arguments.stream_id, arguments.badge)
+
+    elif arguments.command == "retention":
+        from retention import RetentionPolicy
+        policy = RetentionPolicy(arguments.days, arguments.archive, arguments.channel_id)
+        twitch.apply_retention(policy, arguments.batch_size, arguments.vacuum_pages, arguments.dry_run)
+
+    elif arguments.command == "purge":
+        twitch.purge_streams(arguments.channel_id, arguments.stream_id, arguments.batch_size, arguments.vacuum_pages)
+
+    elif arguments.command == "export":
+        twitch.export_streams(arguments.channel_id, arguments.stream_ids, arguments.tables.split(","),
+                              arguments.output_dir, arguments.format, arguments.compression, arguments.rows_per_file,
+                              arguments.workers)
+
+    elif arguments.command == "channeltopspam":
+        twitch.channel_top_spam(arguments.channel_id, arguments.streams, arguments.limit, arguments.threshold)
+
+    elif arguments.command == "merge":
+        twitch.merge_partials(arguments.files, arguments.output)
+
+    elif arguments.command == "spamtimeline":
+        twitch.spam_timeline(arguments.channel_id, arguments.stream_id, arguments.window, arguments.threshold,
+                             arguments.limit)
+
+    elif arguments.command == "channelviewership":
+        twitch.channel_viewership(arguments.channel_id, arguments.streams)
 
     # added for enhancement
     elif arguments.command == "gettopspam2":  # pragma: no cover
-        twitch.get_top_spam2(arguments.channel_id, arguments.stream_id)  # pragma: no cover
+        twitch.get_top_spam2(arguments.channel_id, arguments.stream_id, arguments.normalized)  # pragma: no cover
 
     elif arguments.command == "viewership":  # pragma: no cover
         twitch.viewership_metrics(arguments.channel_id, arguments.stream_id)  # pragma: no cover
@@ -56,6 +420,42 @@ def process_arguments(arguments, database_name, logging_file_name):
     return 0
 
 
+def spam_threshold(value):
+    """Type of gettopspam --threshold: spam statistics only keep messages sent SPAM_STATS_MIN_OCCURRENCES times."""
+    threshold = int(value)
+    if threshold < SPAM_STATS_MIN_OCCURRENCES - 1:
+        raise ArgumentTypeError("threshold must be at least {}".format(SPAM_STATS_MIN_OCCURRENCES - 1))
+    return threshold
+
+
+def positive_int(value):
+    """Type of the options counting rows or chunks, which cannot be zero or negative."""
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+
+def non_negative_int(value):
+    """Type of the options where 0 turns a limit off, which cannot be negative."""
+    number = int(value)
+    if number < 0:
+        raise ArgumentTypeError("{} is a negative number".format(value))
+    return number
+
+
+def spam_normalization(value):
+    """Type of --spam-normalization: comma separated steps of SpamNormalizer, or none."""
+    from models import SpamNormalizer
+
+    steps = () if value == "none" else tuple(value.split(","))
+    try:
+        SpamNormalizer(steps)
+    except ValueError as error:
+        raise ArgumentTypeError(str(error))
+    return steps
+
+
 def setup_parsers(sub_parsers):
     """Add parsers to sub_parsers to handle different arguments."""
     create_channel = sub_parsers.add_parser("createchannel")
@@ -64,13 +464,33 @@ def setup_parsers(sub_parsers):
 
     parse_top_spam = sub_parsers.add_parser("parsetopspam")
     parse_top_spam.add_argument("file")
+    parse_top_spam.add_argument("--partial", metavar="FILE",
+                                help="also write the counts of the comments to FILE, to be combined by merge")
 
     get_top_spam = sub_parsers.add_parser("gettopspam")
     get_top_spam.add_argument("channel_id", type=int)
     get_top_spam.add_argument("stream_id", type=int)
+    get_top_spam.add_argument("--threshold", type=spam_threshold,
+                              help="only messages sent more often than this, at least 1, 10 with only --limit")
+    get_top_spam.add_argument("--limit", type=int, help="number of messages returned")
 
     store_chat_log = sub_parsers.add_parser("storechatlog")
     store_chat_log.add_argument("file")
+    store_chat_log.add_argument("--resume", action="store_true",
+                                help="continue from the last committed chunk of a previous run")
+    store_chat_log.add_argument("--chunk-size", type=positive_int, default=CHAT_LOG_CHUNK_SIZE,
+                                help="number of comments committed at once")
+    store_chat_log.add_argument("--queue-depth", type=int, default=0,
+                                help="parse on a separate thread, at most this many chunks ahead of the writes, "
+                                     "e.g. {}; 0 parses on the writing thread".format(CHAT_LOG_QUEUE_DEPTH))
+    store_chat_log.add_argument("--partial", metavar="FILE",
+                                help="also write the counts of the comments to FILE, to be combined by merge")
+
+    ingest = sub_parsers.add_parser("ingest", help="storechatlog and parsetopspam in one pass and one transaction")
+    ingest.add_argument("file")
+    ingest.add_argument("--no-viewership", action="store_true", help="do not store viewership metrics")
+    ingest.add_argument("--full-text", action="store_true",
+                        help="index messages for the match filter of querychatlog, e.g. 'text match drop'")
 
     query_char_log = sub_parsers.add_parser("querychatlog")
     query_char_log.add_argument("filters", nargs="+")
@@ -78,21 +498,177 @@ def setup_parsers(sub_parsers):
     get_top_spam = sub_parsers.add_parser("gettopspam2")
     get_top_spam.add_argument("channel_id", type=int)
     get_top_spam.add_argument("stream_id", type=int)
+    get_top_spam.add_argument("--normalized", action="store_true",
+                              help="count messages of the same normalized key, see --spam-normalization, as one")
 
     get_top_spam = sub_parsers.add_parser("viewership")
     get_top_spam.add_argument("channel_id", type=int)
     get_top_spam.add_argument("stream_id", type=int)
 
+    top_chatters = sub_parsers.add_parser("topchatters", help="users who sent most messages in a stream")
+    top_chatters.add_argument("channel_id", type=int)
+    top_chatters.add_argument("stream_id", type=int)
+    top_chatters.add_argument("--limit", type=positive_int, default=10, help="number of users returned")
+
+    user_history = sub_parsers.add_parser("userhistory", help="activity and messages of a user in all streams")
+    user_history.add_argument("user")
+    user_history.add_argument("--messages", type=positive_int, default=100,
+                              help="number of most recent messages returned")
+
+    top_emotes = sub_parsers.add_parser("topemotes", help="most used emotes of every minute of a stream")
+    top_emotes.add_argument("channel_id", type=int)
+    top_emotes.add_argument("stream_id", type=int)
+    top_emotes.add_argument("--limit", type=int, default=5, help="number of emotes returned per minute")
+
+    badge_share = sub_parsers.add_parser("badgeshare", help="share of messages and chatters of a stream with a badge")
+    badge_share.add_argument("channel_id", type=int)
+    badge_share.add_argument("stream_id", type=int)
+    badge_share.add_argument("--badge", default="subscriber", help="badge id, e.g. subscriber, premium or bits")
+
+    channel_top_spam = sub_parsers.add_parser("channeltopspam", help="top spam of the last streams of a channel")
+    channel_top_spam.add_argument("channel_id", type=int)
+    channel_top_spam.add_argument("--streams", type=int, default=CHANNEL_STREAM_COUNT,
+                                  help="number of most recent streams")
+    channel_top_spam.add_argument("--limit", type=int, default=10, help="number of messages returned")
+    channel_top_spam.add_argument("--threshold", type=int, default=10,
+                                  help="only messages sent more often than this")
+
+    merge = sub_parsers.add_parser("merge", help="store top spam and viewership of partial aggregates written with "
+                                                 "--partial by parsetopspam or storechatlog")
+    merge.add_argument("files", nargs="+", help="partial aggregate files, possibly compressed")
+    merge.add_argument("--output", metavar="FILE", help="also write the merged partial aggregate of one stream to FILE")
+
+    spam_timeline = sub_parsers.add_parser("spamtimeline", help="top spam of each window of a stream")
+    spam_timeline.add_argument("channel_id", type=int)
+    spam_timeline.add_argument("stream_id", type=int)
+    spam_timeline.add_argument("--window", type=positive_int, default=SPAM_TIMELINE_WINDOW_SECONDS,
+                               help="length of the windows in seconds of offset")
+    spam_timeline.add_argument("--limit", type=positive_int, default=10, help="number of messages returned per window")
+    spam_timeline.add_argument("--threshold", type=int, default=10,
+                               help="only messages sent more often than this in the window")
+
+    channel_viewership = sub_parsers.add_parser("channelviewership",
+                                                help="viewership of each of the last streams of a channel")
+    channel_viewership.add_argument("channel_id", type=int)
+    channel_viewership.add_argument("--streams", type=int, default=CHANNEL_STREAM_COUNT,
+                                    help="number of most recent streams")
+
+    archive = sub_parsers.add_parser("archive", help="move chat log of a stream to a compressed segment file")
+    archive.add_argument("channel_id", type=int)
+    archive.add_argument("stream_id", type=int)
+
+    restore = sub_parsers.add_parser("restore", help="move chat log of an archived stream back to the database")
+    restore.add_argument("channel_id", type=int)
+    restore.add_argument("stream_id", type=int)
+
+    retention = sub_parsers.add_parser("retention", help="delete or archive streams older than a number of days")
+    retention.add_argument("--days", type=float, required=True, help="age of the last message of expired streams")
+    retention.add_argument("--archive", action="store_true", help="archive expired streams instead of deleting them")
+    retention.add_argument("--channel-id", type=int, help="only expire streams of this channel")
+    retention.add_argument("--dry-run", action="store_true", help="only list the expired streams")
+
+    purge = sub_parsers.add_parser("purge", help="delete a stream or every stream of a channel")
+    purge.add_argument("channel_id", type=int)
+    purge.add_argument("stream_id", type=int, nargs="?")
+
+    for parser in (retention, purge):
+        parser.add_argument("--batch-size", type=positive_int, default=RETENTION_BATCH_SIZE,
+                            help="number of rows deleted per transaction")
+        parser.add_argument("--vacuum-pages", type=positive_int, default=RETENTION_VACUUM_PAGES,
+                            help="number of free pages given back to the file system per transaction")
+
+    export = sub_parsers.add_parser("export", help="write tables of streams to CSV or NDJSON files")
+    export.add_argument("channel_id", type=int)
+    export.add_argument("stream_ids", type=int, nargs="*",
+                        help="streams to export, every stream of the channel if none are given")
+    export.add_argument("--tables", default=",".join(EXPORT_TABLES),
+                        help="comma separated tables: chat_log, top_spam, viewership_rollup and user_activity")
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export.add_argument("--compression", choices=EXPORT_COMPRESSIONS, default="none")
+    export.add_argument("--rows-per-file", type=non_negative_int, default=EXPORT_ROWS_PER_FILE,
+                        help="start a new file after this many rows, 0 for one file per table and stream")
+    export.add_argument("--workers", type=positive_int, default=EXPORT_WORKERS,
+                        help="number of tables exported at once")
+    export.add_argument("--output-dir", default=EXPORT_DIRECTORY, help="directory the files are written to")
+
+    batch = sub_parsers.add_parser("batch", help="run many commands in one process")
+    batch.add_argument("file", help="script or NDJSON file with one command per line, - for standard input")
+    batch.add_argument("--jobs", type=int, default=1,
+                       help="number of commands run at once; above 1 the commands must not depend on each other")
+    batch.add_argument("--reserved-slots", type=int,
+                       help="slots of --jobs kept for {} (default {})".format(", ".join(CHEAP_COMMANDS),
+                                                                          BATCH_RESERVED_SLOTS))
+
+    watch = sub_parsers.add_parser("watch", help="store chat log and top spam of every export written to a directory")
+    watch.add_argument("directory")
+    watch.add_argument("--workers", type=int, default=WATCH_WORKERS, help="number of files ingested at once")
+    watch.add_argument("--settle", type=float, default=WATCH_SETTLE_SECONDS,
+                       help="seconds a file must stay unchanged before it is ingested")
+    watch.add_argument("--poll-interval", type=float, default=WATCH_POLL_INTERVAL,
+                       help="seconds between checks of the directory")
+    watch.add_argument("--pattern", default=WATCH_PATTERN, help="names of the files to ingest")
+    watch.add_argument("--polling", action="store_true", help="list the directory instead of using inotify")
+    watch.add_argument("--once", action="store_true", help="exit after ingesting the files already in the directory")
+
+
+def setup_argument_parser():
+    """Return parser of all the command line arguments."""
+    argument_parser = ArgumentParser(description="Parse Twitch chatlogs")
+    argument_parser.add_argument("--shard-dir", help="store every channel in its own database inside this directory")
+    argument_parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite",
+                                 help="where the DAOs keep their rows; memory keeps them until the process exits, "
+                                      "so it suits batch and one-off parse and report jobs")
+    argument_parser.add_argument("--json-decoder", choices=JSON_DECODERS, default="auto",
+                                 help="decoder of chat exports; auto uses orjson when it is installed")
+    argument_parser.add_argument("--spam-normalization", type=spam_normalization, default=SPAM_NORMALIZATION_STEPS,
+                                 help="comma separated steps among {}, or none, normalizing the text of stored chat "
+                                      "logs for gettopspam2 --normalized".format(",".join(SPAM_NORMALIZATION_STEPS)))
+    argument_parser.add_argument("--archive-dir",
+                                 help="directory of the segment files of archived streams; defaults to the database "
+                                      "name followed by {}, or {} inside --shard-dir".format(ARCHIVE_DIRECTORY_SUFFIX,
+                                                                                             ARCHIVE_DIRECTORY))
+    argument_parser.add_argument("--log-payload", choices=PAYLOAD_LOGGING_MODES, default="full",
+                                 help="how much of query results is written to the log")
+    argument_parser.add_argument("--max-seconds", type=float,
+                                 help="stop the queries of the command once it ran for this many seconds")
+    argument_parser.add_argument("--max-rows", type=int,
+                                 help="stop the queries of the command once they returned this many rows")
+    argument_parser.add_argument("--sync-log", action="store_true", help="write the log on the command thread")
+    argument_parser.add_argument("--profile", metavar="FILE", help="write cProfile statistics of the command to FILE")
+    argument_parser.add_argument("--metrics", metavar="FILE",
+                                 help="write stage latencies in Prometheus text format to FILE")
+    sub_parsers = argument_parser.add_subparsers(dest="command")
+    setup_parsers(sub_parsers)
+    return argument_parser
+
 
 def main():  # pragma: no cover
     """
     starting point of the application
     """
-    argument_parser = ArgumentParser(description="Parse Twitch chatlogs")  # pragma: no cover
-    sub_parsers = argument_parser.add_subparsers(dest="command")  # pragma: no cover
-    setup_parsers(sub_parsers)  # pragma: no cover
+    arguments = setup_argument_parser().parse_args()  # pragma: no cover
+    if arguments.command is None:  # pragma: no cover
+        setup_argument_parser().print_usage()  # pragma: no cover
+        return  # pragma: no cover
+
+    from instrumentation import instrumentation  # pragma: no cover
+    from streaming_platform import configure_logging  # pragma: no cover
+    configure_logging(LOG_FILE_NAME, not arguments.sync_log)  # pragma: no cover
+    instrumentation.sql_timing_enabled = bool(arguments.profile or arguments.metrics)  # pragma: no cover
 
-    process_arguments(argument_parser.parse_args(), "twitch.db", "twitch.log")  # pragma: no cover
+    if arguments.profile:  # pragma: no cover
+        import cProfile  # pragma: no cover
+        profiler = cProfile.Profile()  # pragma: no cover
+        profiler.enable()  # pragma: no cover
+    status = process_arguments(arguments, DATABASE_NAME, LOG_FILE_NAME)  # pragma: no cover
+    if arguments.profile:  # pragma: no cover
+        profiler.disable()  # pragma: no cover
+        profiler.dump_stats(arguments.profile)  # pragma: no cover
+    if arguments.metrics:  # pragma: no cover
+        instrumentation.write_prometheus(arguments.metrics)  # pragma: no cover
+    # batch and watch run unattended, so their failures must show in the exit status
+    if arguments.command in ("batch", "watch") and status:  # pragma: no cover
+        sys.exit(status)  # pragma: no cover
 
 
 if __name__ == "__main__":  # pragma: no cover
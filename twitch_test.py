@@ -1,6 +1,23 @@
 """Tests for twitch.py"""
+import bz2
+import contextlib
+import csv
+import gzip
+import io
+import lzma
+import mmap
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from streaming_platform import *
 from twitch import *
+from watcher import *
+import benchmark
 import sqlite3
 
 
@@ -12,8 +29,16 @@ def clean_up():
     print("dropped chat_log")
     c.execute("drop table if exists top_spam")
     print("dropped top_spam")
+    c.execute("drop table if exists spam_stats")
     c.execute("drop table if exists channels")
     print("channels dropped")
+    c.execute("drop table if exists ingest_progress")
+    c.execute("drop table if exists viewership_rollup")
+    c.execute("drop table if exists chat_log_fts")
+    c.execute("drop table if exists chat_log_fts_streams")
+    c.execute("drop table if exists user_activity")
+    c.execute("drop table if exists chat_emote")
+    c.execute("drop table if exists chat_badge")
     conn.close()
 
 
@@ -43,6 +68,14 @@ def setup_twitch(database_name, log_file_name, json_file_name=None):
     return twitch
 
 
+def json_output(function, *arguments, **keyword_arguments):
+    """Helper function. Only used for testing. Call function and return the JSON it prints."""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        function(*arguments, **keyword_arguments)
+    return json.loads(output.getvalue())
+
+
 class TestCreateChannel(unittest.TestCase):
     """Test functionality of create channel."""
     def setUp(self):
@@ -171,6 +204,60 @@ class TestGetTopSpam(unittest.TestCase):
             content = file.readlines()
             self.assertEqual(content, ['INFO:root:[]\n'])
 
+    def run_get_top_spam(self, twitch, threshold=None, limit=None):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            twitch.get_top_spam(36029255, 497295395, threshold, limit)
+        return json.loads(output.getvalue())
+
+    def test_any_threshold_and_limit(self):
+        comments = CommentDaoJSONImpl("test_league2.json").get_all_comments()
+        occurrences, users = {}, {}
+        for comment in comments:
+            text = comment["message"]["body"]
+            occurrences[text] = occurrences.get(text, 0) + 1
+            users.setdefault(text, set()).add(comment["commenter"]["display_name"])
+        for threshold, limit in ((1, None), (1, 3), (2, 2), (10, None), (100, 5)):
+            ranked = sorted((text for text in occurrences if occurrences[text] > threshold),
+                            key=lambda text: (-occurrences[text], -len(users[text]), text))[:limit]
+            self.assertEqual(self.run_get_top_spam(self.twitch, threshold, limit),
+                             [{"occurrences": occurrences[text], "spam_text": text, "user_count": len(users[text])}
+                              for text in ranked])
+        # the default threshold gives the top spam stored by parsetopspam
+        self.assertEqual(self.run_get_top_spam(self.twitch, limit=10), self.run_get_top_spam(self.twitch))
+        self.assertEqual(self.cursor.execute("select min(spam_occurrences) from spam_stats").fetchone()[0], 2)
+
+    def test_range_scan_of_index(self):
+        plan = str(self.cursor.execute("""explain query plan select * from spam_stats where channel_id = 1 and
+        stream_id = 2 and spam_occurrences > 3 order by spam_occurrences desc, spam_user_count desc, spam_text
+        limit 5""").fetchall())
+        self.assertIn("spam_stats_rank", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_threshold_of_stream_parsed_before_statistics(self):
+        expected = self.run_get_top_spam(self.twitch, 3)
+        self.cursor.execute("delete from spam_stats")
+        self.database_connection.commit()
+        with self.assertRaises(ValueError):
+            self.twitch.get_top_spam(36029255, 497295395, 3)
+        # the top spam stored by parsetopspam is still there, and parsing again brings the statistics back
+        self.assertEqual(len(self.run_get_top_spam(self.twitch)), 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.parse_top_spam()
+        self.assertEqual(self.run_get_top_spam(self.twitch, 3), expected)
+
+    def test_memory_backend_and_threshold_argument(self):
+        memory_twitch = StreamingPlatform("twitch.log")
+        memory_twitch.set_spam_dao(SpamDaoMemoryImplementation(MemoryDatabase()))
+        memory_twitch.set_comment_dao(CommentDaoJSONImpl("test_league2.json"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            memory_twitch.parse_top_spam()
+        for threshold, limit in ((1, None), (1, 4), (3, 2)):
+            self.assertEqual(self.run_get_top_spam(memory_twitch, threshold, limit),
+                             self.run_get_top_spam(self.twitch, threshold, limit))
+        self.assertEqual(spam_threshold("1"), 1)
+        self.assertRaises(ArgumentTypeError, spam_threshold, "0")
+
     def tearDown(self):
         """Close current database connection."""
         self.database_connection.close()
@@ -198,11 +285,199 @@ class TestStoreChatLog(unittest.TestCase):
 
         self.assertEqual(count, 133)
 
+    def test_resume_after_interrupted_run(self):
+        clean_up()
+        twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        insert = twitch.chat_log_dao.insert
+        inserted = []
+
+        def failing_insert(chat_log):
+            if len(inserted) == 50:
+                raise RuntimeError("interrupted")
+            inserted.append(chat_log)
+            insert(chat_log)
+
+        twitch.chat_log_dao.insert = failing_insert
+        self.assertRaises(RuntimeError, twitch.store_chat_log, False, 20)
+        # the interrupted process would have lost its connection and the uncommitted chunk with it
+        twitch.chat_log_dao.close_session()
+
+        # only the first two chunks were committed
+        self.assertEqual(self.cursor.execute("select count(*) from chat_log").fetchone()[0], 40)
+
+        twitch.chat_log_dao.insert = insert
+        twitch.store_chat_log(resume=True, chunk_size=20)
+        self.assertEqual(self.cursor.execute("select count(*) from chat_log").fetchone()[0], 133)
+
+    def test_resume_after_completed_run(self):
+        self.twitch.store_chat_log(resume=True)
+        self.assertEqual(self.cursor.execute("select count(*) from chat_log").fetchone()[0], 133)
+
+    def test_pipelined_run_matches_sequential_run(self):
+        query = "select * from chat_log order by chat_time, offset, user"
+        sequential_rows = self.cursor.execute(query).fetchall()
+        emotes = self.cursor.execute("select * from chat_emote order by message_index, offset").fetchall()
+        self.twitch.store_chat_log(chunk_size=10, queue_depth=2)
+        self.assertEqual(self.cursor.execute(query).fetchall(), sequential_rows)
+        self.assertEqual(self.cursor.execute("select * from chat_emote order by message_index, offset").fetchall(),
+                         emotes)
+
+    def test_pipelined_resume_after_interrupted_run(self):
+        clean_up()
+        twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        insert = twitch.chat_log_dao.insert
+        inserted = []
+
+        def failing_insert(chat_log):
+            if len(inserted) == 50:
+                raise RuntimeError("interrupted")
+            inserted.append(chat_log)
+            insert(chat_log)
+
+        twitch.chat_log_dao.insert = failing_insert
+        self.assertRaises(RuntimeError, twitch.store_chat_log, False, 20, 1)
+        self.assertEqual(self.cursor.execute("select count(*) from chat_log").fetchone()[0], 40)
+
+        twitch.chat_log_dao.insert = insert
+        twitch.store_chat_log(resume=True, chunk_size=20, queue_depth=1)
+        self.assertEqual(self.cursor.execute("select count(*) from chat_log").fetchone()[0], 133)
+
+    def test_chunk_size_must_be_positive(self):
+        for chunk_size in (0, -1):
+            self.assertRaises(ValueError, self.twitch.store_chat_log, False, chunk_size)
+            with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                setup_argument_parser().parse_args(["storechatlog", "--chunk-size", str(chunk_size), "file.json"])
+        # nothing was deleted
+        self.assertEqual(self.cursor.execute("select count(*) from chat_log").fetchone()[0], 133)
+
+    def test_queue_depth_option_before_file(self):
+        arguments = setup_argument_parser().parse_args(["storechatlog", "--queue-depth", "2", "file.json"])
+        self.assertEqual((arguments.queue_depth, arguments.file), (2, "file.json"))
+        self.assertEqual(setup_argument_parser().parse_args(["storechatlog", "file.json"]).queue_depth, 0)
+
+    def test_pipelined_run_without_comments(self):
+        twitch = setup_twitch("twitch.db", "twitch.log", "unexisting file")
+        self.assertRaises(IndexError, twitch.store_chat_log, False, 20, 2)
+
     def tearDown(self):
         """Close the current database sesssion"""
         self.database_connection.close()
 
 
+class TestParseWritePipeline(unittest.TestCase):
+    """Test functionality of ParseWritePipeline and the streaming JSON reader feeding it."""
+
+    def test_batches_written_in_order(self):
+        written = []
+        stats = ParseWritePipeline(2).run(lambda: iter(range(10)), written.append)
+        self.assertEqual(written, list(range(10)))
+        self.assertEqual(stats["batches"], 10)
+        for key in ("parse_seconds", "parser_stall_seconds", "write_seconds", "writer_stall_seconds"):
+            self.assertGreaterEqual(stats[key], 0.0)
+
+    def test_parser_error_raised_by_writer(self):
+        def produce():
+            yield 1
+            raise ValueError("malformed export")
+
+        written = []
+        self.assertRaises(ValueError, ParseWritePipeline(1).run, produce, written.append)
+        self.assertEqual(written, [1])
+
+    def test_writer_error_stops_parser(self):
+        def write(batch):
+            raise RuntimeError("disk full")
+
+        self.assertRaises(RuntimeError, ParseWritePipeline(1, poll_interval=0.01).run, lambda: iter(range(1000)),
+                          write)
+
+    def test_stream_json_array_matches_json_load(self):
+        with open("test_league2.json", encoding="utf-8") as file:
+            expected = json.load(file)["comments"]
+        for read_size in (1, 7, 4096):
+            with open("test_league2.json", encoding="utf-8") as file:
+                self.assertEqual(list(stream_json_array(file, "comments", read_size)), expected)
+
+    def test_stream_json_array_edge_cases(self):
+        self.assertEqual(list(stream_json_array(io.StringIO('{"comments": []}'), "comments")), [])
+        self.assertEqual(list(stream_json_array(io.StringIO('{"video": {"id": 1}, "comments": [{"a": "]"}, 2]}'),
+                                                "comments", 3)), [{"a": "]"}, 2])
+        self.assertEqual(list(stream_json_array(io.StringIO('{"video": {}}'), "comments")), [])
+        self.assertRaises(json.JSONDecodeError, list, stream_json_array(io.StringIO('{"comments": [1 2]}'),
+                                                                        "comments"))
+
+
+class TestCompressedExports(unittest.TestCase):
+    """Test that compressed chat exports are read like plain ones."""
+
+    def setUp(self):
+        """Write test_league2.json compressed with every supported format."""
+        clean_up()
+        self.directory = tempfile.mkdtemp()
+        with open("test_league2.json", "rb") as file:
+            data = file.read()
+        with open("test_league2.json") as file:
+            self.comments = [project_comment(comment) for comment in json.load(file)["comments"]]
+        self.file_names = {}
+        for compression, compress in (("gzip", gzip.compress), ("bz2", bz2.compress), ("xz", lzma.compress)):
+            # no extension, so that the format can only be told from the content
+            self.file_names[compression] = os.path.join(self.directory, compression)
+            with open(self.file_names[compression], "wb") as file:
+                file.write(compress(data))
+
+    def test_compression_detected(self):
+        for compression, file_name in self.file_names.items():
+            self.assertEqual(detect_compression(file_name), compression)
+        self.assertIsNone(detect_compression("test_league2.json"))
+
+    def test_comments_of_compressed_exports(self):
+        for file_name in self.file_names.values():
+            self.assertEqual(CommentDaoJSONImpl(file_name).get_all_comments(), self.comments)
+            self.assertEqual(list(CommentDaoJSONImpl(file_name).iter_comments()), self.comments)
+
+    def test_store_chat_log_of_compressed_export(self):
+        twitch = setup_twitch("twitch.db", "twitch.log", self.file_names["xz"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            twitch.store_chat_log(queue_depth=2)
+        with contextlib.closing(sqlite3.connect("twitch.db")) as connection:
+            self.assertEqual(connection.execute("select count(*) from chat_log").fetchone()[0], 133)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestJsonDecoders(unittest.TestCase):
+    """Test the JSON decoders of chat exports and the projection of their comments."""
+
+    def setUp(self):
+        with open("test_league2.json") as file:
+            self.comments = json.load(file)["comments"]
+
+    def test_decoders_give_same_comments(self):
+        for name in available_json_decoders():
+            comment_dao = CommentDaoJSONImpl("test_league2.json", create_json_decoder(name))
+            self.assertEqual(comment_dao.get_all_comments(), [project_comment(comment) for comment in self.comments])
+
+    def test_unavailable_decoder(self):
+        self.assertRaises(ValueError, create_json_decoder, "simdjson")
+        if orjson is None:
+            self.assertRaises(ValueError, create_json_decoder, "orjson")
+            self.assertEqual(create_json_decoder().name, "json")
+
+    def test_projection_keeps_what_is_read(self):
+        comment_dao = CommentDaoJSONImpl("test_league2.json")
+        for comment, projected in zip(self.comments, comment_dao.get_all_comments()):
+            self.assertEqual(set(projected), {"channel_id", "content_id", "created_at", "content_offset_seconds",
+                                              "commenter", "message"})
+            self.assertEqual(comment_dao.get_chat_log_from_comment(1, 2, projected).__dict__,
+                             comment_dao.get_chat_log_from_comment(1, 2, comment).__dict__)
+            self.assertEqual(comment_dao.get_emotes_from_comment(projected),
+                             comment_dao.get_emotes_from_comment(comment))
+            self.assertEqual(comment_dao.get_badges_from_comment(projected),
+                             comment_dao.get_badges_from_comment(comment))
+            self.assertEqual(projected["commenter"], {"display_name": comment["commenter"]["display_name"]})
+
+
 class TestQueryChatLog(unittest.TestCase):
     """Test functionality of query chat log"""
     def setUp(self):
@@ -250,6 +525,18 @@ class MockArgument:
         self.id = id
         self.name = name
         self.file = "unexisting file"
+        self.resume = False
+        self.chunk_size = CHAT_LOG_CHUNK_SIZE
+        self.queue_depth = 0
+        self.partial = None
+        self.shard_dir = None
+        self.backend = "sqlite"
+        self.json_decoder = "auto"
+        self.spam_normalization = SPAM_NORMALIZATION_STEPS
+        self.archive_dir = None
+        self.log_payload = "full"
+        self.max_seconds = None
+        self.max_rows = None
 
 
 class TestSetupParsers(unittest.TestCase):
@@ -338,6 +625,1455 @@ class TestGetTopSpam2(unittest.TestCase):
                          content_spam2)
 
 
+class TestSpamNormalization(unittest.TestCase):
+    """Test functionality of the normalized spam keys."""
+
+    def setUp(self):
+        """Clean up the database and create streaming platform for the second test export."""
+        clean_up()
+        self.directory = tempfile.mkdtemp()
+        self.twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+
+    def run_get_top_spam2(self, twitch, normalized=True):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            twitch.get_top_spam2(36029255, 497295395, normalized)
+        return json.loads(output.getvalue())
+
+    def test_keys(self):
+        normalizer = SpamNormalizer()
+        self.assertEqual(set(normalizer.key(text) for text in ("KEKW", "kekw ", " KEKW  KEKW", "ＫＥＫＷ")),
+                         {"kekw"})
+        self.assertEqual(normalizer.key("Pog pog POG champ Pog"), "pog champ pog")
+        self.assertEqual(SpamNormalizer(("casefold",)).key("KEKW  KEKW"), "kekw  kekw")
+        self.assertEqual(SpamNormalizer(("whitespace",)).key(" KEKW  KEKW "), "KEKW KEKW")
+        self.assertEqual(SpamNormalizer(()).key(12), "12")
+        self.assertRaises(ValueError, SpamNormalizer, ("stem",))
+        spam_hash = SpamNormalizer.hash("kekw")
+        self.assertEqual(spam_hash, SpamNormalizer.hash("kekw"))
+        self.assertTrue(-2 ** 63 <= spam_hash < 2 ** 63)
+        self.assertEqual(spam_normalization("none"), ())
+        self.assertRaises(ArgumentTypeError, spam_normalization, "casefold,stem")
+
+    def test_normalized_top_spam(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+        # "!DROP" is counted with "!drop", whose senders include its only sender, and repeated "PogChamp" with
+        # "PogChamp"
+        self.assertEqual(self.run_get_top_spam2(self.twitch),
+                         [{"occurrences": 19, "spam_text": "!drop", "user_count": 15},
+                          {"occurrences": 15, "spam_text": "pogchamp", "user_count": 15}])
+        self.assertEqual(self.run_get_top_spam2(self.twitch, False), [{"occurrences": 18, "spam_text": "!drop",
+                                                                       "user_count": 15}])
+        database_connection = sqlite3.connect("twitch.db")
+        plan = str(database_connection.execute("""explain query plan select min(spam_key), count(*) from chat_log
+        where channel_id = 1 and stream_id = 2 group by spam_hash""").fetchall())
+        database_connection.close()
+        self.assertIn("chat_log_channel_stream", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_same_spam_archived_and_in_memory(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+        expected = self.run_get_top_spam2(self.twitch)
+        self.twitch.set_chat_log_dao(ChatLogDaoArchiveImplementation(self.twitch.chat_log_dao, self.directory))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(36029255, 497295395)
+        self.assertEqual(self.run_get_top_spam2(self.twitch), expected)
+
+        memory_twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        memory_twitch.set_chat_log_dao(ChatLogDaoMemoryImplementation(MemoryDatabase()))
+        with contextlib.redirect_stdout(io.StringIO()):
+            memory_twitch.store_chat_log()
+        self.assertEqual(self.run_get_top_spam2(memory_twitch), expected)
+
+    def test_keys_added_to_existing_chat_log(self):
+        database_connection = sqlite3.connect("twitch.db")
+        database_connection.execute("""create table chat_log (channel_id integer NOT NULL, stream_id integer NOT NULL,
+        text string, user string, chat_time datetime, offset int)""")
+        database_connection.execute("create index chat_log_channel_stream on chat_log (channel_id, stream_id)")
+        database_connection.executemany("insert into chat_log values (?,?,?,?,?,?)",
+                                        [(1, 10, text, "user{}".format(index), "2019-10-23T11:51:19Z", index)
+                                         for index, text in enumerate(["KEKW"] * 6 + ["kekw  kekw"] * 6)])
+        database_connection.commit()
+        database_connection.close()
+
+        chat_log_dao = ChatLogDaoSqlLiteImplementation("twitch.db")
+        chat_log_dao.start_session(read_only=True)
+        # read only sessions count the table as it is
+        self.assertEqual([spam.convert_to_dict() for spam in chat_log_dao.get_normalized_spam_list(1, 10, 10)],
+                         [{"channel_id": 1, "stream_id": 10, "spam_text": "kekw", "spam_occurences": 12,
+                           "spam_user_count": 12}])
+        chat_log_dao.close_session()
+
+        chat_log_dao.start_session()
+        chat_log_dao.insert(ChatLog(1, 10, "Kekw", "user12", "2019-10-23T11:51:20Z", 12))
+        chat_log_dao.save_changes()
+        self.assertEqual([(spam.spam_text, spam.spam_occurences) for spam in
+                          chat_log_dao.get_normalized_spam_list(1, 10, 10)], [("kekw", 13)])
+        self.assertEqual(len(chat_log_dao.get_all_with_channel_and_stream_id(1, 10)), 13)
+        chat_log_dao.close_session()
+
+        database_connection = sqlite3.connect("twitch.db")
+        self.assertEqual(database_connection.execute("select count(distinct spam_hash), count(spam_key) from "
+                                                     "chat_log").fetchone(), (1, 13))
+        self.assertEqual([row[2] for row in database_connection.execute(
+            "pragma index_info(chat_log_channel_stream)")], ["channel_id", "stream_id", "spam_hash"])
+        database_connection.close()
+
+    def tearDown(self):
+        """Remove the archive."""
+        shutil.rmtree(self.directory)
+
+
+class TestIngest(unittest.TestCase):
+    """Test functionality of the single pass ingest."""
+
+    def setUp(self):
+        """Clean up the database and create streaming platform whose DAOs share a connection."""
+        clean_up()
+        self.connection_factory = PooledSqliteConnectionFactory()
+        self.twitch = StreamingPlatform("twitch.log")
+        self.twitch.set_spam_dao(SpamDaoSqlLiteImplementation("twitch.db", self.connection_factory))
+        self.twitch.set_chat_log_dao(ChatLogDaoSqlLiteImplementation("twitch.db", self.connection_factory))
+        self.twitch.set_comment_dao(CommentDaoJSONImpl("test_league2.json"))
+
+    def query_results(self):
+        """Return output of gettopspam, querychatlog and the viewership metrics of the test stream."""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.twitch.get_top_spam(36029255, 497295395)
+            self.twitch.query_chat_log(["stream_id eq 497295395"])
+        chat_log_dao = ChatLogDaoSqlLiteImplementation("twitch.db")
+        chat_log_dao.start_session(read_only=True)
+        viewership = chat_log_dao.get_viewership_metrics(36029255, 497295395)
+        chat_log_dao.close_session()
+        return output.getvalue(), viewership
+
+    def test_same_results_as_separate_commands(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+            self.twitch.parse_top_spam()
+        separate_results = self.query_results()
+        clean_up()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest(full_text=True)
+        self.assertEqual(self.query_results(), separate_results)
+
+        database_connection = sqlite3.connect("twitch.db")
+        self.assertEqual(database_connection.execute("select count(*) from viewership_rollup").fetchone()[0],
+                         len(separate_results[1][0]["per_minute"]))
+        database_connection.close()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.twitch.get_top_spam(36029255, 497295395, 1, 5)
+        self.assertEqual(len(json.loads(output.getvalue())), 5)
+
+    def test_one_transaction(self):
+        def fail(*arguments):
+            raise ValueError("disk full")
+        self.twitch.spam_dao.sort_and_insert_spam = fail
+        self.assertRaises(ValueError, self.twitch.ingest)
+        chat_log_dao = ChatLogDaoSqlLiteImplementation("twitch.db")
+        chat_log_dao.start_session(read_only=True)
+        self.assertEqual(chat_log_dao.get_all_with_channel_and_stream_id(36029255, 497295395), [])
+        chat_log_dao.close_session()
+
+    def test_full_text_match(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest(full_text=True)
+            self.twitch.ingest(full_text=True)
+        self.twitch.chat_log_dao.start_session(read_only=True)
+        chat_logs = self.twitch.chat_log_dao.select_where_filter_conditions_are_satisfied(["text match drop"])
+        self.twitch.chat_log_dao.close_session()
+        # case insensitive whole words, but not "!drops", and every row only once after ingesting twice
+        self.assertEqual(len(chat_logs), 19)
+        self.assertEqual(set(chat_log.text for chat_log in chat_logs), {"!drop", "!DROP"})
+
+    def test_match_without_index(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest()
+        self.twitch.chat_log_dao.start_session(read_only=True)
+        self.assertRaises(ValueError, self.twitch.chat_log_dao.select_where_filter_conditions_are_satisfied,
+                          ["text match drop"])
+        # streams left out by the other filters need no index
+        self.assertEqual(self.twitch.chat_log_dao.select_where_filter_conditions_are_satisfied(
+            ["stream_id eq 1", "text match drop"]), [])
+        self.twitch.chat_log_dao.close_session()
+
+    def test_match_after_chat_log_stored_again(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest(full_text=True)
+            self.twitch.store_chat_log()
+        self.twitch.chat_log_dao.start_session(read_only=True)
+        self.assertRaises(ValueError, self.twitch.chat_log_dao.select_where_filter_conditions_are_satisfied,
+                          ["text match drop"])
+        self.twitch.chat_log_dao.close_session()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest(full_text=True)
+        self.twitch.chat_log_dao.start_session(read_only=True)
+        self.assertEqual(len(self.twitch.chat_log_dao.select_where_filter_conditions_are_satisfied(
+            ["text match drop"])), 19)
+        self.twitch.chat_log_dao.close_session()
+
+    def test_match_of_index_without_indexed_streams(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest(full_text=True)
+        # indexes written before the indexed streams were recorded are searched whole
+        database_connection = sqlite3.connect("twitch.db")
+        database_connection.execute("drop table chat_log_fts_streams")
+        database_connection.commit()
+        database_connection.close()
+        for read_only in (True, False):
+            self.twitch.chat_log_dao.start_session(read_only=read_only)
+            self.assertEqual(len(self.twitch.chat_log_dao.select_where_filter_conditions_are_satisfied(
+                ["text match drop"])), 19)
+            self.twitch.chat_log_dao.close_session()
+
+    def test_memory_match_without_index(self):
+        chat_log_dao = ChatLogDaoMemoryImplementation(MemoryDatabase())
+        chat_log = ChatLog(1, 10, "!drop", "unicorn", "2019-10-23T11:51:19Z", 1)
+        chat_log_dao.insert(chat_log)
+        chat_log_dao.insert_full_text(chat_log)
+        self.assertRaises(ValueError, chat_log_dao.select_where_filter_conditions_are_satisfied, ["text match drop"])
+        chat_log_dao.save_full_text_stream(1, 10)
+        self.assertEqual(len(chat_log_dao.select_where_filter_conditions_are_satisfied(["text match drop"])), 1)
+        chat_log_dao.delete_with_channel_id_stream_id(1, 10)
+        chat_log_dao.insert(chat_log)
+        self.assertRaises(ValueError, chat_log_dao.select_where_filter_conditions_are_satisfied, ["text match drop"])
+
+    def tearDown(self):
+        """Close the shared connection."""
+        self.connection_factory.close_all()
+
+
+class TestPartialAggregates(unittest.TestCase):
+    """Test functionality of the partial aggregates and the merge command."""
+
+    def setUp(self):
+        """Split the second test export into three exports of the same stream, one of them compressed."""
+        self.directory = tempfile.mkdtemp()
+        with open("test_league2.json") as file:
+            comments = json.load(file)["comments"]
+        self.parts = []
+        for index, (opener, extension) in enumerate(((open, ""), (open, ""), (gzip.open, ".gz"))):
+            file_name = os.path.join(self.directory, "part{}.json{}".format(index, extension))
+            with opener(file_name, "wt") as file:
+                json.dump({"comments": comments[index::3]}, file)
+            self.parts.append(file_name)
+
+    def run_twitch(self, arguments, working_directory):
+        return subprocess.run([sys.executable, benchmark.TWITCH_SCRIPT] + arguments, cwd=working_directory,
+                              capture_output=True, text=True, check=True).stdout
+
+    def results(self, working_directory):
+        return [self.run_twitch(arguments, working_directory) for arguments in
+                (["gettopspam", "36029255", "497295395"],
+                 ["gettopspam", "36029255", "497295395", "--threshold", "1"],
+                 ["viewership", "36029255", "497295395"])]
+
+    def test_merge_of_worker_processes_equals_single_run(self):
+        single_directory = os.path.join(self.directory, "single")
+        os.mkdir(single_directory)
+        self.run_twitch(["storechatlog", os.path.abspath("test_league2.json")], single_directory)
+        self.run_twitch(["parsetopspam", os.path.abspath("test_league2.json")], single_directory)
+
+        workers = []
+        for index, part in enumerate(self.parts):
+            worker_directory = os.path.join(self.directory, "worker{}".format(index))
+            os.mkdir(worker_directory)
+            # the first worker only counts top spam, the others store the chat log as well
+            command = "parsetopspam" if index == 0 else "storechatlog"
+            workers.append(subprocess.Popen([sys.executable, benchmark.TWITCH_SCRIPT, command, part, "--partial",
+                                             os.path.join(self.directory, "partial{}.json.gz".format(index))],
+                                            cwd=worker_directory, stdout=subprocess.DEVNULL))
+        self.assertEqual([worker.wait() for worker in workers], [0, 0, 0])
+
+        merge_directory = os.path.join(self.directory, "merged")
+        os.mkdir(merge_directory)
+        partials = [os.path.join(self.directory, "partial{}.json.gz".format(index)) for index in range(3)]
+        self.assertIn("merged 133 comments into 1 top spam records", self.run_twitch(["merge"] + partials,
+                                                                                     merge_directory))
+        single_results = self.results(single_directory)
+        self.assertEqual(self.results(merge_directory), single_results)
+        self.assertEqual(json.loads(single_results[1])[0], {"occurrences": 18, "spam_text": "!drop",
+                                                            "user_count": 15})
+        self.assertEqual(len(json.loads(single_results[2])[0]["per_minute"]), 3)
+
+    def test_merge_in_any_order(self):
+        aggregates = []
+        for part in self.parts:
+            aggregate = PartialAggregate("36029255", "497295395")
+            comment_dao = CommentDaoJSONImpl(part)
+            for comment in comment_dao.iter_comments():
+                aggregate.add(comment_dao.get_chat_log_from_comment("36029255", "497295395", comment))
+            aggregates.append(PartialAggregate.from_dict(json.loads(json.dumps(aggregate.to_dict()))))
+        forward = merge_partial_aggregates(aggregates)
+        backward = merge_partial_aggregates(reversed(aggregates))
+        self.assertEqual(len(forward), 1)
+        self.assertEqual(forward[0].to_dict(), backward[0].to_dict())
+        self.assertEqual(forward[0].comments, 133)
+
+        chat_log_dao = ChatLogDaoMemoryImplementation(MemoryDatabase())
+        comment_dao = CommentDaoJSONImpl("test_league2.json")
+        for comment in comment_dao.iter_comments():
+            chat_log_dao.insert(comment_dao.get_chat_log_from_comment("36029255", "497295395", comment))
+        self.assertEqual(forward[0].viewership(), chat_log_dao.get_viewership_metrics("36029255", "497295395"))
+
+        self.assertRaises(ValueError, forward[0].merge, PartialAggregate("36029255", "1"))
+        self.assertRaises(ValueError, PartialAggregate.from_dict, {"format": "csv"})
+
+    def tearDown(self):
+        """Remove the parts and the databases of the workers."""
+        shutil.rmtree(self.directory)
+
+
+class TestArchive(unittest.TestCase):
+    """Test functionality of the columnar archive of chat logs."""
+
+    def setUp(self):
+        """Store chat log of the test stream with an archive in a temporary directory."""
+        clean_up()
+        self.archive_directory = tempfile.mkdtemp()
+        self.twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        self.chat_log_dao = ChatLogDaoArchiveImplementation(self.twitch.chat_log_dao, self.archive_directory)
+        self.twitch.set_chat_log_dao(self.chat_log_dao)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+
+    def query_results(self):
+        """Return output of gettopspam2 and querychatlog and the viewership metrics of the test stream."""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.twitch.get_top_spam2(36029255, 497295395)
+            self.twitch.query_chat_log(["user like s%", "offset gteq 20"])
+            self.twitch.query_chat_log(["chat_time gteq 2019-10-23", "text eq VoHiYo"])
+        self.chat_log_dao.start_session(read_only=True)
+        viewership = self.chat_log_dao.get_viewership_metrics(36029255, 497295395)
+        self.chat_log_dao.close_session()
+        return output.getvalue(), viewership
+
+    def count_database_rows(self):
+        database_connection = sqlite3.connect("twitch.db")
+        count = database_connection.execute("select count(*) from chat_log").fetchone()[0]
+        database_connection.close()
+        return count
+
+    def test_archived_stream_gives_same_results(self):
+        results = self.query_results()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(36029255, 497295395)
+        self.assertEqual(self.count_database_rows(), 0)
+        self.assertEqual(self.query_results(), results)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.restore_stream(36029255, 497295395)
+        self.assertEqual(os.listdir(self.archive_directory), [])
+        self.assertEqual(self.count_database_rows(), 133)
+        self.assertEqual(self.query_results(), results)
+
+    def test_match_of_archived_stream(self):
+        self.chat_log_dao.start_session()
+        for chat_log in self.chat_log_dao.get_all_with_channel_and_stream_id(36029255, 497295395):
+            self.chat_log_dao.insert_full_text(chat_log)
+        self.chat_log_dao.save_full_text_stream(36029255, 497295395)
+        self.chat_log_dao.save_changes()
+        self.chat_log_dao.close_session()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.twitch.query_chat_log(["text match drop"])
+            self.twitch.archive_stream(36029255, 497295395)
+            self.twitch.query_chat_log(["text match drop"])
+        indexed, archive, archived = output.getvalue().splitlines()
+        self.assertEqual(len(json.loads(indexed)), 19)
+        self.assertEqual(archived, indexed)
+
+    def test_segment_compact_and_mapped(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(36029255, 497295395)
+        segment_name = self.chat_log_dao.segment_name(36029255, 497295395)
+        self.assertLess(os.path.getsize(segment_name), os.path.getsize("test_league2.json") // 10)
+        with ChatLogSegment(segment_name) as segment:
+            text_ids = segment.column("text_ids")
+            self.assertIs(type(text_ids.obj), mmap.mmap)
+            self.assertEqual(len(text_ids), 133)
+
+    def test_storing_again_replaces_archive(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(36029255, 497295395)
+            self.twitch.store_chat_log()
+        self.assertEqual(os.listdir(self.archive_directory), [])
+        self.chat_log_dao.start_session(read_only=True)
+        self.assertEqual(len(self.chat_log_dao.select_where_filter_conditions_are_satisfied([])), 133)
+        self.chat_log_dao.close_session()
+
+    def test_irregular_values_round_trip(self):
+        chat_logs = [ChatLog(1, 2, "hello", "unicorn", "2019-10-23T11:51:19Z", 1.5),
+                     ChatLog(1, 2, "hello", "pony", "yesterday", 3),
+                     ChatLog(1, 2, "bye\n", "unicorn", "2019-10-23T11:51:19.5Z", -2)]
+        segment_name = os.path.join(self.archive_directory, "1_2.seg")
+        write_chat_log_segment(segment_name, 1, 2, chat_logs)
+        with ChatLogSegment(segment_name) as segment:
+            self.assertEqual([chat_log.convert_to_dict() for chat_log in segment.chat_logs()],
+                             [chat_log.convert_to_dict() for chat_log in chat_logs])
+            self.assertEqual([chat_log.convert_to_dict() for chat_log in segment.user_chat_logs(
+                lambda user: user == "unicorn")], [chat_logs[0].convert_to_dict(), chat_logs[2].convert_to_dict()])
+            self.assertEqual(segment.user_chat_logs(lambda user: False), [])
+
+    def test_user_chat_logs_of_segment(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(36029255, 497295395)
+        with ChatLogSegment(self.chat_log_dao.segment_name(36029255, 497295395)) as segment:
+            self.assertEqual([chat_log.convert_to_dict() for chat_log in segment.user_chat_logs(
+                lambda user: user == "D4jje81")], [chat_log.convert_to_dict() for chat_log in segment.chat_logs()
+                                                   if chat_log.user == "D4jje81"])
+
+    def tearDown(self):
+        """Remove the archive."""
+        shutil.rmtree(self.archive_directory)
+
+
+class TestChannelAnalytics(unittest.TestCase):
+    """Test functionality of the channel level commands."""
+
+    def setUp(self):
+        """Store chat log of three generated streams of one channel."""
+        clean_up()
+        self.directory = tempfile.mkdtemp()
+        self.twitch = setup_twitch("twitch.db", "twitch.log")
+        self.twitch.set_chat_log_dao(ChatLogDaoArchiveImplementation(self.twitch.chat_log_dao, self.directory))
+        self.comments = []
+        for stream_id in (1000, 1001, 1002):
+            file_name = os.path.join(self.directory, "{}.json".format(stream_id))
+            benchmark.generate_chat_export(file_name, 500, 40, 1.2, stream_id, seed=stream_id)
+            comment_dao = CommentDaoJSONImpl(file_name)
+            self.comments.append(comment_dao.get_all_comments())
+            self.twitch.set_comment_dao(comment_dao)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.twitch.store_chat_log()
+
+    def expected_top_spam(self, comments_of_streams, limit):
+        occurrences, users, streams = {}, {}, {}
+        for comments in comments_of_streams:
+            for comment in comments:
+                text = comment["message"]["body"]
+                occurrences[text] = occurrences.get(text, 0) + 1
+                users.setdefault(text, set()).add(comment["commenter"]["display_name"])
+            for text in set(comment["message"]["body"] for comment in comments):
+                streams[text] = streams.get(text, 0) + 1
+        ranked = sorted((text for text in occurrences if occurrences[text] > 10),
+                        key=lambda text: (-occurrences[text], -len(users[text]), text))[:limit]
+        return [{"occurrences": occurrences[text], "spam_text": text, "user_count": len(users[text]),
+                 "stream_count": streams[text]} for text in ranked]
+
+    def test_top_spam_merged_across_streams(self):
+        top_spam = json_output(self.twitch.channel_top_spam, benchmark.BENCHMARK_CHANNEL_ID, 50, 5)
+        self.assertEqual(top_spam, self.expected_top_spam(self.comments, 5))
+
+    def test_only_last_streams(self):
+        top_spam = json_output(self.twitch.channel_top_spam, benchmark.BENCHMARK_CHANNEL_ID, 2, 5)
+        self.assertEqual(top_spam, self.expected_top_spam(self.comments[1:], 5))
+
+    def test_archived_streams_included(self):
+        top_spam = json_output(self.twitch.channel_top_spam, benchmark.BENCHMARK_CHANNEL_ID, 50, 5)
+        viewership = json_output(self.twitch.channel_viewership, benchmark.BENCHMARK_CHANNEL_ID, 50)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(benchmark.BENCHMARK_CHANNEL_ID, 1001)
+        self.assertEqual(json_output(self.twitch.channel_top_spam, benchmark.BENCHMARK_CHANNEL_ID, 50, 5),
+                         top_spam)
+        self.assertEqual(json_output(self.twitch.channel_viewership, benchmark.BENCHMARK_CHANNEL_ID, 50),
+                         viewership)
+
+    def expected_spam_timeline(self, comments, window_seconds, threshold, limit):
+        windows = {}
+        for comment in comments:
+            windows.setdefault(int(comment["content_offset_seconds"] // window_seconds), []).append(comment)
+        timeline = []
+        for window in sorted(windows):
+            occurrences, users = {}, {}
+            for comment in windows[window]:
+                text = comment["message"]["body"]
+                occurrences[text] = occurrences.get(text, 0) + 1
+                users.setdefault(text, set()).add(comment["commenter"]["display_name"])
+            ranked = sorted((text for text in occurrences if occurrences[text] > threshold),
+                            key=lambda text: (-occurrences[text], -len(users[text]), text))[:limit]
+            timeline.append({"window": window, "start_offset": window * window_seconds,
+                             "end_offset": (window + 1) * window_seconds, "messages": len(windows[window]),
+                             "spam": [{"occurrences": occurrences[text], "spam_text": text,
+                                       "user_count": len(users[text])} for text in ranked]})
+        return timeline
+
+    def test_spam_timeline_per_window(self):
+        timeline = json_output(self.twitch.spam_timeline, benchmark.BENCHMARK_CHANNEL_ID, 1001, 1800, 2, 3)
+        self.assertEqual(timeline, self.expected_spam_timeline(self.comments[1], 1800, 2, 3))
+        self.assertEqual(sum(window["messages"] for window in timeline), 500)
+        self.assertTrue(any(window["spam"] for window in timeline))
+
+    def test_spam_timeline_window_and_limit_must_be_positive(self):
+        for option in ("--window", "--limit"):
+            for value in ("0", "-1"):
+                with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                    setup_argument_parser().parse_args(["spamtimeline", "1", "2", option, value])
+
+    def test_spam_timeline_of_whole_stream(self):
+        timeline = json_output(self.twitch.spam_timeline, benchmark.BENCHMARK_CHANNEL_ID, 1000, 86400, 10, 1000)
+        top_spam = json_output(self.twitch.get_top_spam2, benchmark.BENCHMARK_CHANNEL_ID, 1000)
+        self.assertEqual(len(timeline), 1)
+        self.assertEqual(timeline[0]["spam"], top_spam)
+
+    def test_spam_timeline_of_archived_and_memory_stream(self):
+        timeline = json_output(self.twitch.spam_timeline, benchmark.BENCHMARK_CHANNEL_ID, 1002, 600, 2, 5)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(benchmark.BENCHMARK_CHANNEL_ID, 1002)
+        self.assertEqual(json_output(self.twitch.spam_timeline, benchmark.BENCHMARK_CHANNEL_ID, 1002, 600, 2, 5),
+                         timeline)
+
+        memory_twitch = setup_twitch("twitch.db", "twitch.log")
+        memory_twitch.set_chat_log_dao(ChatLogDaoMemoryImplementation(MemoryDatabase()))
+        memory_twitch.set_comment_dao(CommentDaoJSONImpl(os.path.join(self.directory, "1002.json")))
+        with contextlib.redirect_stdout(io.StringIO()):
+            memory_twitch.store_chat_log()
+        self.assertEqual(json_output(memory_twitch.spam_timeline, benchmark.BENCHMARK_CHANNEL_ID, 1002, 600, 2, 5),
+                         timeline)
+
+    def test_viewership_per_stream(self):
+        viewership = json_output(self.twitch.channel_viewership, benchmark.BENCHMARK_CHANNEL_ID, 50)
+        self.assertEqual([stream["stream_id"] for stream in viewership], [1000, 1001, 1002])
+        self.assertEqual([stream["messages"] for stream in viewership], [500, 500, 500])
+        for stream in viewership:
+            self.assertLessEqual(stream["average_viewers"], stream["peak_viewers"])
+
+    def test_stream_index_used(self):
+        database_connection = sqlite3.connect("twitch.db")
+        plan = database_connection.execute("explain query plan select text, user, count(*) from chat_log where "
+                                           "channel_id = 1 and stream_id = 2 group by text, user").fetchall()
+        database_connection.close()
+        self.assertIn("chat_log_channel_stream", str(plan))
+
+    def tearDown(self):
+        """Remove the exports and the archive."""
+        shutil.rmtree(self.directory)
+
+
+class TestUserActivity(unittest.TestCase):
+    """Test functionality of the per user activity."""
+
+    def setUp(self):
+        """Store chat log of two streams sharing some users."""
+        clean_up()
+        self.directory = tempfile.mkdtemp()
+        self.twitch = setup_twitch("twitch.db", "twitch.log")
+        self.twitch.set_chat_log_dao(ChatLogDaoArchiveImplementation(self.twitch.chat_log_dao, self.directory))
+        self.chat_logs = [ChatLog(1, 10, "hello", "unicorn", "2019-10-23T11:51:19Z", 1),
+                          ChatLog(1, 10, "hi", "pony", "2019-10-23T11:51:20Z", 2),
+                          ChatLog(1, 10, "bye", "unicorn", "2019-10-23T11:52:21Z", 63),
+                          ChatLog(1, 11, "again", "unicorn", "2019-10-24T10:00:00Z", 5)]
+        chat_log_dao = self.twitch.chat_log_dao
+        chat_log_dao.start_session()
+        for chat_log in self.chat_logs:
+            chat_log_dao.insert(chat_log)
+        chat_log_dao.refresh_user_activity(1, 10)
+        chat_log_dao.refresh_user_activity(1, 11)
+        chat_log_dao.save_changes()
+        chat_log_dao.close_session()
+
+    def test_top_chatters(self):
+        self.assertEqual(json_output(self.twitch.top_chatters, 1, 10, 10),
+                         [{"user": "unicorn", "channel_id": 1, "stream_id": 10, "messages": 2,
+                           "first_seen": "2019-10-23T11:51:19Z", "last_seen": "2019-10-23T11:52:21Z"},
+                          {"user": "pony", "channel_id": 1, "stream_id": 10, "messages": 1,
+                           "first_seen": "2019-10-23T11:51:20Z", "last_seen": "2019-10-23T11:51:20Z"}])
+        self.assertEqual(len(json_output(self.twitch.top_chatters, 1, 10, 1)), 1)
+
+    def test_user_history_survives_archive(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(1, 10)
+        history = json_output(self.twitch.user_history, "unicorn", 2)
+        self.assertEqual((history["messages"], history["streams"]), (3, 2))
+        self.assertEqual((history["first_seen"], history["last_seen"]),
+                         ("2019-10-23T11:51:19Z", "2019-10-24T10:00:00Z"))
+        self.assertEqual([message["text"] for message in history["recent_messages"]], ["bye", "again"])
+        # segments of the streams the user did not chat in are not opened
+        with open(os.path.join(self.directory, "2_20.seg"), "w") as file:
+            file.write("not a segment")
+        history = json_output(self.twitch.user_history, "unicorn", 2)
+        self.assertEqual([message["text"] for message in history["recent_messages"]], ["bye", "again"])
+        for option in ("userhistory unicorn --messages", "topchatters 1 10 --limit"):
+            for value in ("0", "-1"):
+                with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                    setup_argument_parser().parse_args(option.split(" ") + [value])
+
+    def test_activity_maintained_by_store_chat_log(self):
+        self.twitch.set_comment_dao(CommentDaoJSONImpl("test_league2.json"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log(chunk_size=50)
+        top_chatters = json_output(self.twitch.top_chatters, 36029255, 497295395, 1000)
+        self.assertEqual(sum(chatter["messages"] for chatter in top_chatters), 133)
+
+    def test_user_index_used(self):
+        database_connection = sqlite3.connect("twitch.db")
+        plan = database_connection.execute("explain query plan select * from chat_log where user = 'unicorn' "
+                                           "order by chat_time desc, rowid desc limit 2").fetchall()
+        database_connection.close()
+        self.assertIn("chat_log_user", str(plan))
+        self.assertNotIn("TEMP B-TREE", str(plan))
+
+    def test_user_history_of_any_user_name(self):
+        chat_log_dao = self.twitch.chat_log_dao
+        chat_log_dao.start_session()
+        chat_log_dao.insert(ChatLog(1, 12, "hey", "O'Brien", "2019-10-25T10:00:00Z", 1))
+        chat_log_dao.insert(ChatLog(1, 12, "yo", "a b", "2019-10-25T10:00:01Z", 2))
+        chat_log_dao.refresh_user_activity(1, 12)
+        chat_log_dao.save_changes()
+        chat_log_dao.close_session()
+        for user, text in (("O'Brien", "hey"), ("a b", "yo")):
+            history = json_output(self.twitch.user_history, user, 10)
+            self.assertEqual(history["messages"], 1)
+            self.assertEqual([message["text"] for message in history["recent_messages"]], [text])
+
+    def test_activity_of_chat_log_stored_before_user_activity(self):
+        database_connection = sqlite3.connect("twitch.db")
+        database_connection.execute("drop table user_activity")
+        database_connection.commit()
+        # read only sessions aggregate the chat log
+        self.assertEqual(json_output(self.twitch.user_history, "unicorn", 10)["messages"], 3)
+        self.assertEqual(len(json_output(self.twitch.top_chatters, 1, 10, 10)), 2)
+        # the first write session fills the table
+        chat_log_dao = self.twitch.chat_log_dao
+        chat_log_dao.start_session()
+        chat_log_dao.get_top_chatters(1, 10, 10)
+        chat_log_dao.save_changes()
+        chat_log_dao.close_session()
+        self.assertEqual(database_connection.execute("select sum(messages) from user_activity").fetchone()[0], 4)
+        database_connection.close()
+
+    def tearDown(self):
+        """Remove the archive."""
+        shutil.rmtree(self.directory)
+
+
+class TestEmotesAndBadges(unittest.TestCase):
+    """Test functionality of the emote and badge side tables."""
+
+    def setUp(self):
+        """Clean up the database and create streaming platform whose DAOs share a connection."""
+        clean_up()
+        connection_factory = PooledSqliteConnectionFactory()
+        self.twitch = StreamingPlatform("twitch.log")
+        self.twitch.set_spam_dao(SpamDaoSqlLiteImplementation("twitch.db", connection_factory))
+        self.twitch.set_chat_log_dao(ChatLogDaoSqlLiteImplementation("twitch.db", connection_factory))
+        self.twitch.set_comment_dao(CommentDaoJSONImpl("test_league2.json"))
+
+    def test_comment_fragments(self):
+        comment_dao = CommentDaoJSONImpl("test_league2.json")
+        comments = comment_dao.get_all_comments()
+        emotes = [emote for comment in comments for emote in comment_dao.get_emotes_from_comment(comment)]
+        self.assertIn(("196892", "TwitchUnity"), emotes)
+        self.assertEqual(sum(1 for _, emote in emotes if emote == "PogChamp"), 32)
+        badges = [badge for comment in comments for badge, _ in comment_dao.get_badges_from_comment(comment)]
+        self.assertEqual(badges.count("subscriber"), 25)
+
+    def test_top_emotes(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log(chunk_size=50)
+            self.twitch.store_chat_log()
+        top_emotes = json_output(self.twitch.top_emotes, 36029255, 497295395, 2)
+        self.assertEqual(top_emotes[0], {"minute": 0, "emotes": [{"emote": "TwitchUnity", "count": 2},
+                                                                 {"emote": "BibleThump", "count": 1}]})
+        self.assertEqual(top_emotes[-1]["emotes"][0], {"emote": "PogChamp", "count": 32})
+        self.assertTrue(all(len(minute["emotes"]) <= 2 for minute in top_emotes))
+
+    def test_badge_share(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+        share = json_output(self.twitch.badge_share, 36029255, 497295395, "subscriber")
+        self.assertEqual((share["messages"], share["badge_messages"], share["message_share"]), (133, 25, 0.188))
+        self.assertEqual(share["badge_chatters"], 25)
+        self.assertEqual(json_output(self.twitch.badge_share, 1, 1, "subscriber")["message_share"], 0.0)
+
+    def test_same_results_with_ingest(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+        separate_results = (json_output(self.twitch.top_emotes, 36029255, 497295395, 5),
+                            json_output(self.twitch.badge_share, 36029255, 497295395, "premium"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.ingest()
+        self.assertEqual((json_output(self.twitch.top_emotes, 36029255, 497295395, 5),
+                          json_output(self.twitch.badge_share, 36029255, 497295395, "premium")),
+                         separate_results)
+
+
+class TestRetention(unittest.TestCase):
+    """Test functionality of the retention and purge commands."""
+
+    def setUp(self):
+        """Store the test stream, which ended on 2019-10-23, and a newer stream of another channel."""
+        clean_up()
+        self.archive_directory = tempfile.mkdtemp()
+        self.twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        self.twitch.set_chat_log_dao(ChatLogDaoArchiveImplementation(self.twitch.chat_log_dao,
+                                                                     self.archive_directory))
+        self.twitch.set_maintenance_dao(DatabaseMaintenanceDaoSqlLiteImplementation("twitch.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.store_chat_log()
+            self.twitch.parse_top_spam()
+        chat_log_dao = self.twitch.chat_log_dao
+        chat_log_dao.start_session()
+        chat_log_dao.insert(ChatLog(1, 10, "hello", "unicorn", "2019-11-30T10:00:00Z", 1))
+        chat_log_dao.save_changes()
+        chat_log_dao.close_session()
+        self.now = datetime.datetime(2019, 12, 1)
+
+    def count_rows(self, table_name):
+        database_connection = sqlite3.connect("twitch.db")
+        count = database_connection.execute("select count(*) from {}".format(table_name)).fetchone()[0]
+        database_connection.close()
+        return count
+
+    def test_batch_size_and_vacuum_pages_must_be_positive(self):
+        for option in ("--batch-size", "--vacuum-pages"):
+            for value in ("0", "-1"):
+                with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                    setup_argument_parser().parse_args(["purge", "36029255", "497295395", option, value])
+        self.assertRaises(ValueError, self.twitch.purge_streams, 36029255, 497295395, 0)
+        self.assertRaises(ValueError, self.twitch.purge_streams, 36029255, 497295395, -1)
+        self.assertRaises(ValueError, self.twitch.apply_retention, RetentionPolicy(30), vacuum_pages=0)
+        # nothing was deleted
+        self.assertEqual((self.count_rows("chat_log"), self.count_rows("top_spam")), (134, 1))
+
+    def test_dry_run(self):
+        report = json_output(self.twitch.apply_retention, RetentionPolicy(30), dry_run=True, now=self.now)
+        self.assertEqual(report, {"cutoff": "2019-11-01T00:00:00", "expired_streams": [[36029255, 497295395]]})
+        self.assertEqual(self.count_rows("chat_log"), 134)
+        report = json_output(self.twitch.apply_retention, RetentionPolicy(30, channel_id=1), dry_run=True,
+                             now=self.now)
+        self.assertEqual(report["expired_streams"], [])
+
+    def test_delete_in_batches(self):
+        report = json_output(self.twitch.apply_retention, RetentionPolicy(30), batch_size=50, now=self.now)
+        self.assertEqual(report["expired_streams"], [[36029255, 497295395]])
+        self.assertGreater(report["deleted_rows"], 133)
+        for table_name in ("chat_log", "user_activity", "chat_emote", "chat_badge", "top_spam"):
+            database_connection = sqlite3.connect("twitch.db")
+            self.assertEqual(database_connection.execute("select count(*) from {} where channel_id = 36029255".format(
+                table_name)).fetchone()[0], 0)
+            database_connection.close()
+        self.assertEqual(self.count_rows("chat_log"), 1)
+        self.assertEqual(report["storage"]["freelist_count"], 0)
+
+        database_connection = sqlite3.connect("twitch.db")
+        self.assertEqual(database_connection.execute("pragma auto_vacuum").fetchone()[0], 2)
+        self.assertGreater(database_connection.execute("select count(*) from sqlite_stat1").fetchone()[0], 0)
+        database_connection.close()
+        self.assertGreaterEqual(instrumentation.stage_calls["retention.delete_batch"], 4)
+
+    def test_archive(self):
+        report = json_output(self.twitch.apply_retention, RetentionPolicy(30, archive=True), now=self.now)
+        self.assertEqual(report["archived_rows"], 133)
+        self.assertEqual(self.count_rows("chat_log"), 1)
+        self.assertEqual(len(json_output(self.twitch.query_chat_log, ["stream_id eq 497295395"])), 133)
+        # archived streams expire again by the time of their last message, but are not archived twice
+        report = json_output(self.twitch.apply_retention, RetentionPolicy(30, archive=True), now=self.now)
+        self.assertEqual((report["expired_streams"], report["archived_rows"]), ([[36029255, 497295395]], 0))
+
+        report = json_output(self.twitch.purge_streams, 36029255)
+        self.assertEqual(report["purged_streams"], [[36029255, 497295395]])
+        self.assertEqual(os.listdir(self.archive_directory), [])
+        self.assertEqual(json_output(self.twitch.query_chat_log, ["stream_id eq 497295395"]), [])
+
+    def test_interrupted_archive_finished(self):
+        # the process stops after the segment is written, before the deletion of the rows is committed
+        chat_log_dao = self.twitch.chat_log_dao
+        chat_log_dao.start_session()
+        chat_log_dao.archive_stream(36029255, 497295395)
+        chat_log_dao.close_session()
+        self.assertTrue(chat_log_dao.is_archived(36029255, 497295395))
+        self.assertEqual(self.count_rows("chat_log"), 134)
+        self.assertEqual(len(json_output(self.twitch.query_chat_log, ["stream_id eq 497295395"])), 133)
+        self.assertEqual(len(json_output(self.twitch.user_history, "D4jje81", 100)["recent_messages"]), 5)
+
+        report = json_output(self.twitch.apply_retention, RetentionPolicy(30, archive=True), now=self.now)
+        self.assertEqual(report["archived_rows"], 133)
+        self.assertEqual(self.count_rows("chat_log"), 1)
+        self.assertEqual(len(json_output(self.twitch.query_chat_log, ["stream_id eq 497295395"])), 133)
+
+    def test_purge_stream(self):
+        report = json_output(self.twitch.purge_streams, 1, 10)
+        self.assertEqual((report["purged_streams"], report["deleted_rows"]), ([[1, 10]], 1))
+        self.assertEqual(self.count_rows("chat_log"), 133)
+
+    def tearDown(self):
+        """Remove the archive."""
+        shutil.rmtree(self.archive_directory)
+
+
+class TestShardedChatLog(unittest.TestCase):
+    """Test functionality of the per-channel shards."""
+
+    def setUp(self):
+        """Create shards for two channels in a temporary directory."""
+        self.shard_dir = tempfile.mkdtemp()
+        self.shard_router = ShardRouter(self.shard_dir)
+        self.chat_log_dao = ChatLogDaoShardedImplementation(self.shard_router)
+        self.chat_log_dao.start_session()
+        self.chat_log_dao.insert(ChatLog(1, 10, "hello", "unicorn", "2019-10-23T11:51:19Z", 1))
+        self.chat_log_dao.insert(ChatLog(2, 20, "hi", "pony", "2019-10-23T11:51:20Z", 2))
+        self.chat_log_dao.insert(ChatLog(1, 10, "bye", "unicorn", "2019-10-23T11:51:21Z", 3))
+        self.chat_log_dao.save_changes()
+        self.chat_log_dao.close_session()
+
+    def test_rows_routed_to_channel_shards(self):
+        self.assertEqual(self.shard_router.all_database_names(),
+                         [self.shard_router.database_name(1), self.shard_router.database_name(2)])
+        self.chat_log_dao.start_session()
+        self.assertEqual(len(self.chat_log_dao.get_all_with_channel_and_stream_id(1, 10)), 2)
+        self.chat_log_dao.close_session()
+
+    def test_fan_out_query_merged_by_chat_time(self):
+        self.chat_log_dao.start_session()
+        chat_logs = self.chat_log_dao.select_where_filter_conditions_are_satisfied(["offset gteq 1"])
+        self.chat_log_dao.close_session()
+        self.assertEqual([chat_log.text for chat_log in chat_logs], ["hello", "hi", "bye"])
+
+    def test_query_restricted_to_one_channel(self):
+        self.chat_log_dao.start_session()
+        chat_logs = self.chat_log_dao.select_where_filter_conditions_are_satisfied(["channel_id eq 2"])
+        self.chat_log_dao.close_session()
+        self.assertEqual([chat_log.text for chat_log in chat_logs], ["hi"])
+
+    def run_command(self, *command_line):
+        arguments = setup_argument_parser().parse_args(list(command_line))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            process_arguments(arguments, os.path.join(self.shard_dir, "unsharded.db"), "twitch.log")
+        return output.getvalue()
+
+    def test_segments_kept_with_their_database(self):
+        self.run_command("--shard-dir", self.shard_dir, "archive", "1", "10")
+        self.assertTrue(os.path.exists(os.path.join(self.shard_dir, ARCHIVE_DIRECTORY, "1_10.seg")))
+        self.assertIn("hello", self.run_command("--shard-dir", self.shard_dir, "querychatlog", "channel_id eq 1"))
+        # the unsharded database neither stores the stream nor reads the segments of the shards
+        self.assertNotIn("hello", self.run_command("querychatlog", "channel_id eq 1"))
+        self.assertEqual(archive_directory(MockArgument(None, None, "archive"), "twitch.db"),
+                         "twitch.db" + ARCHIVE_DIRECTORY_SUFFIX)
+
+    def tearDown(self):
+        """Remove the shards."""
+        shutil.rmtree(self.shard_dir)
+
+
+class TestConcurrentReaders(unittest.TestCase):
+    """Test that read only sessions are not blocked by a running ingest."""
+
+    def setUp(self):
+        """Store chat log and keep a write transaction open."""
+        clean_up()
+        setup_twitch("twitch.db", "twitch.log", "test_league2.json").store_chat_log()
+        self.writer = ChatLogDaoSqlLiteImplementation("twitch.db")
+        self.writer.start_session()
+        self.writer.delete_with_channel_id_stream_id(36029255, 497295395)
+
+    def test_reader_sees_committed_rows(self):
+        reader = ChatLogDaoSqlLiteImplementation("twitch.db", SqliteConnectionFactory(busy_timeout=0.1))
+        reader.start_session(read_only=True)
+        self.assertEqual(len(reader.get_all_with_channel_and_stream_id(36029255, 497295395)), 133)
+        reader.close_session()
+
+    def test_database_in_wal_mode(self):
+        connection = sqlite3.connect("twitch.db")
+        self.assertEqual(connection.execute("pragma journal_mode").fetchone()[0], "wal")
+        connection.close()
+
+    def test_read_only_session_without_table(self):
+        reader = SpamDaoSqlLiteImplementation("twitch.db")
+        reader.start_session(read_only=True)
+        self.assertEqual(reader.get_all_wth_channel_and_stream_id(36029255, 497295395), [])
+        reader.close_session()
+
+    def tearDown(self):
+        """Roll back the write transaction."""
+        self.writer.close_session()
+
+
+class TestPayloadLogging(unittest.TestCase):
+    """Test asynchronous logging and the payload logging modes."""
+
+    def setUp(self):
+        """Store chat log and log asynchronously to a separate file."""
+        clean_up()
+        self.twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        self.twitch.store_chat_log()
+        self.log_dir = tempfile.mkdtemp()
+        self.log_file_name = os.path.join(self.log_dir, "async.log")
+        configure_logging(self.log_file_name)
+
+    def read_log(self):
+        flush_logging()
+        with open(self.log_file_name) as file:
+            return file.readlines()
+
+    def test_full_payload(self):
+        self.twitch.query_chat_log(['stream_id eq 497295395', 'user eq seabunnei'])
+        self.assertEqual(self.read_log(), [
+            'INFO:root:[{"channel_id": 36029255, "chat_time": "2019-10-23T11:51:19.859498086Z", "offset": 29, ' +
+            '"stream_id": 497295395, "text": "VoHiYo", "user": "seabunnei"}]\n'])
+
+    def test_summary_payload(self):
+        self.twitch.set_payload_logging("summary")
+        self.twitch.query_chat_log(['stream_id eq 497295395'])
+        content = self.read_log()
+        self.assertEqual(len(content), 1)
+        self.assertTrue(content[0].startswith("INFO:root:returned 133 records ("))
+
+    def test_truncated_payload(self):
+        self.twitch.set_payload_logging("truncated")
+        self.twitch.query_chat_log(['stream_id eq 497295395'])
+        content = self.read_log()
+        self.assertEqual(len(content), 1)
+        self.assertTrue(content[0].endswith("more bytes)\n"))
+        self.assertLess(len(content[0]), TRUNCATED_PAYLOAD_LENGTH + 100)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, self.twitch.set_payload_logging, "everything")
+
+    def tearDown(self):
+        """Go back to synchronous logging to twitch.log."""
+        configure_logging("twitch.log", asynchronous=False)
+        shutil.rmtree(self.log_dir)
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Test timing spans and the Prometheus output."""
+
+    def setUp(self):
+        """Store chat log with SQL timing enabled."""
+        clean_up()
+        instrumentation.reset()
+        instrumentation.sql_timing_enabled = True
+        self.twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        self.twitch.store_chat_log(chunk_size=100)
+        self.twitch.get_top_spam2(36029255, 497295395)
+
+    def test_stages_recorded(self):
+        self.assertEqual(instrumentation.stage_calls["storechatlog.insert"], 2)
+        # chat log rows, the three checkpoints, and the user activity filled from the chat log when its table is
+        # created and then refreshed for the stream
+        self.assertEqual(instrumentation.stage_calls["sql.insert"], 138)
+        self.assertEqual(instrumentation.counters[("rows", "storechatlog.insert")], 133)
+        self.assertIn("gettopspam2.query", instrumentation.stage_calls)
+        self.assertIn("chat_log_dao.count_spam", instrumentation.stage_calls)
+
+    def test_bytes_read_counted(self):
+        self.assertEqual(instrumentation.counters[("bytes_read", "comment_dao.json_parse")],
+                         os.path.getsize("test_league2.json"))
+
+    def test_prometheus_format(self):
+        lines = instrumentation.to_prometheus().splitlines()
+        self.assertIn('twitch_stage_duration_seconds_count{stage="storechatlog.insert"} 2', lines)
+        self.assertIn('twitch_rows_total{stage="storechatlog.insert"} 133', lines)
+        self.assertIn("# TYPE twitch_stage_duration_seconds summary", lines)
+
+    def tearDown(self):
+        """Turn SQL timing off again."""
+        instrumentation.sql_timing_enabled = False
+        instrumentation.reset()
+
+
+class TestBenchmarkGenerator(unittest.TestCase):
+    """Test the synthetic chat export generator of the benchmark suite."""
+
+    def setUp(self):
+        """Generate the same export twice."""
+        self.directory = tempfile.mkdtemp()
+        self.file_names = [os.path.join(self.directory, name) for name in ["a.json", "b.json"]]
+        for file_name in self.file_names:
+            benchmark.generate_chat_export(file_name, 2000, 100, 1.2, 1234, seed=7)
+
+    def test_same_seed_same_export(self):
+        with open(self.file_names[0]) as first, open(self.file_names[1]) as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_export_readable_by_comment_dao(self):
+        comment_dao = CommentDaoJSONImpl(self.file_names[0])
+        self.assertEqual(len(comment_dao.get_all_comments()), 2000)
+        self.assertEqual(comment_dao.get_channel_and_stream_id(0), (str(benchmark.BENCHMARK_CHANNEL_ID), "1234"))
+        comments_count, comments_user_count = comment_dao.count_comments_and_users()
+        self.assertLessEqual(len(set().union(*comments_user_count.values())), 100)
+        # Zipf skew makes the most frequent message much more common than the median one
+        counts = sorted(comments_count.values(), reverse=True)
+        self.assertGreater(counts[0], 10 * counts[len(counts) // 2])
+
+    def test_percentile(self):
+        self.assertEqual(benchmark.percentile([3, 1, 2, 4], 0.5), 2)
+        self.assertEqual(benchmark.percentile([3, 1, 2, 4], 0.99), 4)
+
+    def tearDown(self):
+        """Remove the exports."""
+        shutil.rmtree(self.directory)
+
+
+class TestBatch(unittest.TestCase):
+    """Test functionality of the batch command."""
+
+    def setUp(self):
+        """Write a batch file mixing the supported line formats."""
+        clean_up()
+        clean_log_file('twitch.log')
+        self.directory = tempfile.mkdtemp()
+        self.batch_file_name = os.path.join(self.directory, "batch.txt")
+        with open(self.batch_file_name, "w") as file:
+            file.write("# load the stream\n")
+            file.write("storechatlog test_league2.json\n")
+            file.write('["parsetopspam", "test_league2.json"]\n')
+            file.write('{"command": "gettopspam", "args": [36029255, 497295395]}\n')
+            file.write("querychatlog 'user eq seabunnei'\n")
+            file.write("gettopspam not-a-number 1\n")
+
+    def run_batch(self, *options):
+        arguments = setup_argument_parser().parse_args(["batch", self.batch_file_name] + list(options))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+            status = process_arguments(arguments, "twitch.db", "twitch.log")
+        return status, output.getvalue().splitlines()
+
+    def test_read_batch_commands(self):
+        with open(self.batch_file_name) as file:
+            self.assertEqual(read_batch_commands(file), [["storechatlog", "test_league2.json"],
+                                                         ["parsetopspam", "test_league2.json"],
+                                                         ["gettopspam", "36029255", "497295395"],
+                                                         ["querychatlog", "user eq seabunnei"],
+                                                         ["gettopspam", "not-a-number", "1"]])
+
+    def test_jobs_keep_order(self):
+        with open(self.batch_file_name, "w") as file:
+            file.write("gettopspam 36029255 497295395\n")
+            file.write("querychatlog 'user eq seabunnei'\n")
+            file.write("gettopspam2 36029255 497295395\n")
+            file.write("--max-rows 10 querychatlog 'channel_id eq 36029255'\n")
+            file.write("topchatters 36029255 497295395\n")
+        setup_twitch("twitch.db", "twitch.log", "test_league2.json").store_chat_log()
+        with contextlib.redirect_stdout(io.StringIO()):
+            setup_twitch("twitch.db", "twitch.log", "test_league2.json").parse_top_spam()
+        status, lines = self.run_batch()
+        self.assertEqual(status, -1)
+        self.assertEqual(self.run_batch("--jobs", "3"), (status, lines))
+        self.assertEqual(lines[0], '[{"occurrences": 18, "spam_text": "!drop", "user_count": 15}]')
+        delimiters = [json.loads(line[len(BATCH_DELIMITER):]) for line in lines if line.startswith(BATCH_DELIMITER)]
+        self.assertEqual([delimiter["status"] for delimiter in delimiters], [0, 0, 0, -1, 0])
+
+    def test_failed_command_releases_write_lock(self):
+        with open(self.batch_file_name, "w") as file:
+            file.write("createchannel first 1\n")
+            file.write("createchannel duplicate 1\n")
+            file.write("createchannel second 2\n")
+        status, lines = self.run_batch()
+        self.assertEqual(status, -1)
+        delimiters = [json.loads(line[len(BATCH_DELIMITER):]) for line in lines if line.startswith(BATCH_DELIMITER)]
+        self.assertEqual([delimiter["status"] for delimiter in delimiters], [0, -1, 0])
+        connection = sqlite3.connect("twitch.db", timeout=0.1)
+        connection.execute("insert into channels values (3, 'third')")
+        connection.commit()
+        connection.close()
+
+    def test_exit_status_of_failed_batch(self):
+        completed = subprocess.run([sys.executable, benchmark.TWITCH_SCRIPT, "batch", self.batch_file_name],
+                                   cwd=self.directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.assertNotEqual(completed.returncode, 0)
+
+    def test_results_delimited(self):
+        status, lines = self.run_batch()
+        self.assertEqual(status, -1)
+        self.assertEqual(lines[4], '[{"occurrences": 18, "spam_text": "!drop", "user_count": 15}]')
+        delimiters = [json.loads(line[len(BATCH_DELIMITER):]) for line in lines if line.startswith(BATCH_DELIMITER)]
+        self.assertEqual([delimiter["status"] for delimiter in delimiters], [0, 0, 0, 0, 2])
+        self.assertEqual(lines[5], BATCH_DELIMITER + '{"command": "gettopspam", "index": 2, "status": 0}')
+
+    def tearDown(self):
+        """Remove the batch file."""
+        shutil.rmtree(self.directory)
+
+
+class TestQueryBudget(unittest.TestCase):
+    """Test time and row budgets and cancellation of queries."""
+
+    # counts to a billion, which takes minutes unless interrupted
+    HEAVY_QUERY = """with recursive numbers(n) as (select 1 union all select n + 1 from numbers where n < 1000000000)
+        select count(*) from numbers"""
+
+    def setUp(self):
+        """Store chat log."""
+        clean_up()
+        clean_log_file('twitch.log')
+        setup_twitch("twitch.db", "twitch.log", "test_league2.json").store_chat_log()
+
+    def run_heavy_query(self, budget):
+        start = time.monotonic()
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with query_budget(budget):
+                connection = SqliteConnectionFactory().connect(":memory:")
+                try:
+                    connection.execute(self.HEAVY_QUERY).fetchall()
+                finally:
+                    connection.close()
+        return str(context.exception), time.monotonic() - start
+
+    def run_command(self, *command_arguments):
+        arguments = setup_argument_parser().parse_args(list(command_arguments))
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as errors:
+            status = process_arguments(arguments, "twitch.db", "twitch.log")
+        return status, errors.getvalue()
+
+    def test_time_budget(self):
+        message, seconds = self.run_heavy_query(QueryBudget(max_seconds=0.2))
+        self.assertEqual(message, "query ran longer than 0.2 seconds")
+        self.assertLess(seconds, 5)
+
+    def test_cancel_from_other_thread(self):
+        budget = QueryBudget()
+        threading.Timer(0.2, budget.cancel).start()
+        message, seconds = self.run_heavy_query(budget)
+        self.assertEqual(message, "query cancelled")
+        self.assertLess(seconds, 5)
+
+    def test_row_budget(self):
+        status, errors = self.run_command("--max-rows", "100", "querychatlog", "channel_id eq 36029255")
+        self.assertEqual(status, -1)
+        self.assertEqual(errors, "querychatlog stopped: query returned more than 100 rows\n")
+        self.assertEqual(self.run_command("--max-rows", "1000", "querychatlog", "channel_id eq 36029255"), (0, ""))
+
+    def test_row_budget_counts_result_rows(self):
+        # querychatlog returns 5 rows and gettopspam 1, after looking up their tables
+        self.assertEqual(self.run_command("--max-rows", "5", "querychatlog", "user eq D4jje81"), (0, ""))
+        self.assertEqual(self.run_command("--max-rows", "4", "querychatlog", "user eq D4jje81")[0], -1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            setup_twitch("twitch.db", "twitch.log", "test_league2.json").parse_top_spam()
+        self.assertEqual(self.run_command("--max-rows", "1", "gettopspam", "36029255", "497295395"), (0, ""))
+        self.assertEqual(self.run_command("--max-rows", "0", "gettopspam", "36029255", "497295395")[0], -1)
+
+    def test_pooled_connection_forgets_budget(self):
+        connection_factory = PooledSqliteConnectionFactory()
+        with query_budget(QueryBudget(max_rows=1)):
+            connection = connection_factory.connect("twitch.db", read_only=True)
+            with self.assertRaises(QueryBudgetExceeded):
+                connection.execute("select * from chat_log").fetchall()
+            connection_factory.release(connection)
+        connection = connection_factory.connect("twitch.db", read_only=True)
+        self.assertEqual(len(connection.execute("select * from chat_log").fetchall()), 133)
+        connection_factory.close_all()
+
+
+class TestAdmissionController(unittest.TestCase):
+    """Test that heavy commands leave the reserved slots to cheap ones."""
+
+    def test_cheap_job_overtakes_waiting_heavy_job(self):
+        controller = AdmissionController(2, 1)
+        jobs = ["heavy 1", "heavy 2", "cheap"]
+        is_cheap = lambda job: job == "cheap"
+        self.assertEqual(controller.admit(jobs, is_cheap), "heavy 1")
+        self.assertEqual(controller.admit(jobs, is_cheap), "cheap")
+        self.assertEqual(jobs, ["heavy 2"])
+
+        admitted = []
+        thread = threading.Thread(target=lambda: admitted.append(controller.admit(jobs, is_cheap)))
+        thread.start()
+        # the only slot left is reserved, so the heavy job waits until the other heavy job is done
+        controller.release(True)
+        thread.join(0.2)
+        self.assertEqual(admitted, [])
+        controller.release(False)
+        thread.join()
+        self.assertEqual(admitted, ["heavy 2"])
+        self.assertIsNone(controller.admit(jobs, is_cheap))
+
+    def test_reserved_slots_must_leave_one(self):
+        with self.assertRaises(ValueError):
+            AdmissionController(2, 2)
+
+
+class TestExport(unittest.TestCase):
+    """Test functionality of the export command."""
+
+    def setUp(self):
+        """Store the test stream with its rollups and top spam."""
+        clean_up()
+        self.directory = tempfile.mkdtemp()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for command in (["ingest", "test_league2.json"], ["parsetopspam", "test_league2.json"]):
+                process_arguments(setup_argument_parser().parse_args(command), "twitch.db", "twitch.log")
+        self.twitch = setup_twitch("twitch.db", "twitch.log", "test_league2.json")
+        self.twitch.set_chat_log_dao(ChatLogDaoArchiveImplementation(self.twitch.chat_log_dao,
+                                                                     os.path.join(self.directory, "archive")))
+
+    def export(self, *arguments, **keyword_arguments):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.twitch.export_streams(36029255, *arguments, **keyword_arguments)
+        return json.loads(output.getvalue())
+
+    def read_csv(self, file_names, opener=open):
+        rows = []
+        for file_name in file_names:
+            with opener(file_name, "rt", newline="") as file:
+                rows += list(csv.reader(file))[1:]
+        return rows
+
+    def test_csv_matches_database(self):
+        report = self.export(directory=self.directory)
+        self.assertEqual(report["rows"], {"chat_log": 133, "top_spam": 1, "viewership_rollup": 3})
+        with contextlib.closing(sqlite3.connect("twitch.db")) as connection:
+            expected = [[str(value) for value in row] for row in connection.execute(
+                "select channel_id, stream_id, text, user, chat_time, offset from chat_log")]
+        files = [exported_file["file"] for exported_file in report["files"] if exported_file["table"] == "chat_log"]
+        self.assertEqual(self.read_csv(files), expected)
+
+    def test_chunked_compressed_files(self):
+        report = self.export([497295395], ["chat_log"], self.directory, "csv", "gzip", 50, 1)
+        self.assertEqual([exported_file["rows"] for exported_file in report["files"]], [50, 50, 33])
+        rows = self.read_csv([exported_file["file"] for exported_file in report["files"]], gzip.open)
+        self.assertEqual(rows, self.read_csv([self.export([497295395], ["chat_log"], self.directory, rows_per_file=0)
+                                              ["files"][0]["file"]]))
+
+    def test_ndjson_of_archived_stream(self):
+        before = self.export([497295395], ["chat_log", "user_activity"], self.directory, "ndjson")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.twitch.archive_stream(36029255, 497295395)
+        after = self.export([497295395], ["chat_log", "user_activity"], os.path.join(self.directory, "archived"),
+                            "ndjson")
+        self.assertEqual(after["rows"], {"chat_log": 133, "user_activity": 114})
+        for before_file, after_file in zip(before["files"], after["files"]):
+            with open(before_file["file"]) as first, open(after_file["file"]) as second:
+                self.assertEqual(first.read(), second.read())
+
+    def test_memory_backend_exports_same_rows(self):
+        outputs = []
+        for backend in ("sqlite", "memory"):
+            clean_up()
+            directory = os.path.join(self.directory, backend)
+            batch_file_name = os.path.join(self.directory, "batch.txt")
+            with open(batch_file_name, "w") as file:
+                file.write("ingest test_league2.json\nparsetopspam test_league2.json\n")
+                file.write("export 36029255 --format ndjson --rows-per-file 40 --tables {} --output-dir {}\n".format(
+                    ",".join(EXPORT_COLUMNS), directory))
+            arguments = setup_argument_parser().parse_args(["--backend", backend, "batch", batch_file_name])
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(process_arguments(arguments, "twitch.db", "twitch.log"), 0)
+            contents = {}
+            for file_name in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, file_name)) as file:
+                    contents[file_name] = file.read()
+            outputs.append(contents)
+        self.assertEqual(len(outputs[0]), 9)
+        self.assertEqual(outputs[1], outputs[0])
+
+    def test_rows_per_file_and_workers_validated(self):
+        for option, value in (("--rows-per-file", "-1"), ("--workers", "0"), ("--workers", "-1")):
+            with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                setup_argument_parser().parse_args(["export", "36029255", option, value])
+        self.assertEqual(setup_argument_parser().parse_args(["export", "36029255", "--rows-per-file", "0"])
+                         .rows_per_file, 0)
+
+    def test_unknown_table(self):
+        self.assertRaises(ValueError, self.export, [497295395], ["chat_emote"], self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestMemoryBackend(unittest.TestCase):
+    """Test functionality of the in-memory DAOs."""
+
+    def setUp(self):
+        """Write a batch file that stores and reports the test stream."""
+        clean_up()
+        self.directory = tempfile.mkdtemp()
+        self.batch_file_name = os.path.join(self.directory, "batch.txt")
+        with open(self.batch_file_name, "w") as file:
+            file.write("createchannel RiotGames 36029255\n")
+            file.write("ingest test_league2.json --full-text\n")
+            file.write("parsetopspam test_league2.json\n")
+            for command in ("gettopspam", "gettopspam2", "viewership", "topchatters", "topemotes", "badgeshare"):
+                file.write("{} 36029255 497295395\n".format(command))
+            file.write("querychatlog 'stream_id eq 497295395' 'user like s%'\n")
+            file.write("querychatlog 'offset gteq 4500' 'offset lt 4510'\n")
+            file.write("querychatlog 'chat_time gteq 2019-10-21' 'chat_time lt 2019-10-21T11:22'\n")
+            file.write("querychatlog 'user eq guyan'\n")
+            file.write("querychatlog 'text match drop'\n")
+            file.write("userhistory guyan\n")
+            file.write("channeltopspam 36029255 --threshold 2\n")
+            file.write("channelviewership 36029255\n")
+            file.write("storechatlog test_league2.json\n")
+            file.write("querychatlog 'text eq PogChamp'\n")
+            file.write("createchannel RiotGames 36029255\n")
+
+    def run_batch(self, backend):
+        arguments = setup_argument_parser().parse_args(["--backend", backend, "--archive-dir", self.directory,
+                                                        "batch", self.batch_file_name])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+            status = process_arguments(arguments, "twitch.db", "twitch.log")
+        return status, output.getvalue()
+
+    def test_same_output_as_sqlite(self):
+        sqlite_output = self.run_batch("sqlite")
+        clean_up()
+        memory_output = self.run_batch("memory")
+        self.assertEqual(memory_output, sqlite_output)
+        self.assertIn('"text": "!drop"', memory_output[1])
+        # creating the channel twice fails with both backends
+        self.assertEqual(memory_output[0], -1)
+
+    def test_nothing_written_to_database(self):
+        self.run_batch("memory")
+        database_connection = sqlite3.connect("twitch.db")
+        self.assertEqual(database_connection.execute("select count(*) from sqlite_master where name in "
+                                                     "('chat_log', 'top_spam', 'channels')").fetchone()[0], 0)
+        database_connection.close()
+
+    def test_rows_sorted_by_chat_time(self):
+        memory_database = MemoryDatabase()
+        chat_log_dao = ChatLogDaoMemoryImplementation(memory_database)
+        for chat_time, text in (("2019-10-23T11:51:20Z", "b"), ("2019-10-23T11:51:19Z", "a"),
+                                ("2019-10-23T11:52:00Z", "c")):
+            chat_log_dao.insert(ChatLog("1", "10", text, "unicorn", chat_time, 1.0))
+        self.assertEqual([chat_log.text for chat_log in chat_log_dao.get_all_with_channel_and_stream_id(1, 10)],
+                         ["b", "a", "c"])
+        chat_logs = chat_log_dao.select_where_filter_conditions_are_satisfied(["chat_time gt 2019-10-23T11:51:19Z"])
+        self.assertEqual([chat_log.text for chat_log in chat_logs], ["b", "c"])
+        self.assertEqual((chat_logs[0].channel_id, chat_logs[0].offset), (1, 1))
+        self.assertEqual(chat_log_dao.get_last_chat_times(), {(1, 10): "2019-10-23T11:52:00Z"})
+        self.assertEqual(chat_log_dao.delete_stream_batch(1, 10, 1), 3)
+        self.assertEqual(memory_database.chat_log_user, {})
+
+    def test_numeric_affinity(self):
+        self.assertEqual([sqlite_numeric_affinity(value) for value in ("12", " 7 ", "1.0", "1.5", "1e3", "0x10",
+                                                                       "12abc", 3.0)],
+                         [12, 7, 1, 1.5, 1000, "0x10", "12abc", 3])
+
+    def tearDown(self):
+        """Remove the batch file."""
+        shutil.rmtree(self.directory)
+
+
+class TestWatch(unittest.TestCase):
+    """Test functionality of the watch command."""
+
+    def setUp(self):
+        """Drop two exports, a partially written one and an unrelated file into a directory."""
+        self.directory = tempfile.mkdtemp()
+        self.database_directory = tempfile.mkdtemp()
+        self.database_name = os.path.join(self.database_directory, "watch.db")
+        benchmark.generate_chat_export(os.path.join(self.directory, "first.json"), 300, 20, 1.2, 1001, seed=1)
+        benchmark.generate_chat_export(os.path.join(self.directory, "second.json"), 200, 20, 1.2, 1002, seed=2)
+        with open(os.path.join(self.directory, "partial.json"), "w") as file:
+            file.write('{"comments": [{"channel_id": "1"')
+        with open(os.path.join(self.directory, "notes.txt"), "w") as file:
+            file.write("not a chat export")
+
+    def run_watch(self):
+        arguments = setup_argument_parser().parse_args(["watch", self.directory, "--once", "--polling", "--settle",
+                                                        "0", "--poll-interval", "0.01"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process_arguments(arguments, self.database_name, "twitch.log")
+
+    def count_by_state(self):
+        queue_dao = IngestQueueDaoSqlLiteImplementation(self.database_name)
+        queue_dao.start_session(read_only=True)
+        states = queue_dao.count_by_state()
+        queue_dao.close_session()
+        return states
+
+    def test_exports_ingested(self):
+        self.assertEqual(self.run_watch(), -1)
+        self.assertEqual(self.count_by_state(), {"done": 2, "failed": 1})
+        connection = sqlite3.connect(self.database_name)
+        self.assertEqual(connection.execute("select stream_id, count(*) from chat_log group by stream_id").fetchall(),
+                         [(1001, 300), (1002, 200)])
+        self.assertEqual(connection.execute("select distinct stream_id from top_spam order by stream_id").fetchall(),
+                         [(1001,), (1002,)])
+        connection.close()
+
+    def test_exports_of_same_stream_ingested_one_at_a_time(self):
+        for copy in range(4):
+            shutil.copy("test_league2.json", os.path.join(self.directory, "league{}.json".format(copy)))
+        arguments = setup_argument_parser().parse_args(["watch", self.directory, "--once", "--polling", "--settle",
+                                                        "0", "--poll-interval", "0.01", "--workers", "4"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_arguments(arguments, self.database_name, "twitch.log")
+        self.assertEqual(self.count_by_state(), {"done": 6, "failed": 1})
+        connection = sqlite3.connect(self.database_name)
+        self.assertEqual(connection.execute("select count(*) from chat_log where stream_id = 497295395").fetchone(),
+                         (133,))
+        connection.close()
+
+    def test_stream_lock_shared_by_exports_of_stream(self):
+        service = WatchService(self.directory, None, None)
+        self.assertIs(service.stream_lock(("1", "2")), service.stream_lock(("1", "2")))
+        self.assertIsNot(service.stream_lock(("1", "2")), service.stream_lock(("1", "3")))
+
+    def test_unchanged_files_not_ingested_again(self):
+        self.run_watch()
+        self.assertEqual(self.run_watch(), 0)
+        with open(os.path.join(self.directory, "partial.json"), "a") as file:
+            file.write("}]}")
+        self.assertEqual(self.run_watch(), -1)
+        self.assertEqual(self.count_by_state(), {"done": 2, "failed": 1})
+
+    def test_interrupted_files_queued_again(self):
+        queue_dao = IngestQueueDaoSqlLiteImplementation(self.database_name)
+        queue_dao.start_session()
+        queue_dao.enqueue("a.json", 1, 1)
+        queue_dao.enqueue("b.json", 1, 1)
+        self.assertEqual(queue_dao.claim(), "a.json")
+        self.assertEqual(queue_dao.requeue_running(), 1)
+        self.assertEqual(queue_dao.count_by_state(), {"pending": 2})
+        self.assertFalse(queue_dao.enqueue("a.json", 1, 1))
+        queue_dao.close_session()
+
+    def test_debouncer_waits_for_file_to_settle(self):
+        path = os.path.join(self.directory, "first.json")
+        debouncer = Debouncer(0)
+        debouncer.touch(path)
+        self.assertEqual(debouncer.settled(), [])
+        with open(path, "a") as file:
+            file.write(" ")
+        self.assertEqual(debouncer.settled(), [])
+        self.assertEqual([ready[0] for ready in debouncer.settled()], [path])
+        self.assertEqual(debouncer.pending, {})
+
+    def test_inotify_reports_written_file(self):
+        try:
+            watcher = InotifyWatcher(self.directory)
+        except OSError:  # pragma: no cover
+            self.skipTest("inotify is not available")  # pragma: no cover
+        path = os.path.join(self.directory, "third.json")
+        with open(path, "w") as file:
+            file.write("{}")
+        self.assertIn(path, watcher.wait(1.0))
+        watcher.close()
+
+    def tearDown(self):
+        """Remove the directory and the queue database."""
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.database_directory)
+
+
+class TestLazyStartup(unittest.TestCase):
+    """Test that parsing the command line does not load the rest of the application."""
+
+    def test_parsing_arguments_imports_nothing_else(self):
+        code = ("import sys, twitch; twitch.setup_argument_parser().parse_args(['gettopspam', '1', '2']); "
+                "print(sorted(set(sys.modules) & {'streaming_platform', 'dao', 'sqlite3', 'logging', 'json'}))")
+        output = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(output.decode().strip(), "[]")
+
+    def test_only_needed_dao_created(self):
+        arguments = setup_argument_parser().parse_args(["gettopspam", "1", "2"])
+        twitch = create_streaming_platform(arguments, "twitch.db", "twitch.log")
+        self.assertIsNotNone(twitch.spam_dao)
+        self.assertIsNone(twitch.chat_log_dao)
+        self.assertIsNone(twitch.channel_dao)
+
+
 class TestFactoryClasses(unittest.TestCase):
     """Test functionality of ChatLogFactory and SpamFactory."""
     def setUp(self):
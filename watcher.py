@@ -0,0 +1,249 @@
+"""Ingests chat export files as they are dropped into a directory, for the watch command of twitch.py."""
+import fnmatch
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from config import *
+from dao import *
+
+# inotify(7) event bits and the layout of struct inotify_event without its name
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def list_directory(directory):
+    """Return paths of all the regular files in directory."""
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries if entry.is_file()]
+
+
+class InotifyWatcher:
+    """Reports files of a directory that are created, written or moved into it, using Linux inotify."""
+
+    def __init__(self, directory):
+        import ctypes
+        self.directory = directory
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.file_descriptor = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.file_descriptor < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.file_descriptor, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.file_descriptor)
+            raise OSError(error, "inotify_add_watch failed for {}".format(directory))
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for changes and return set of paths of the changed files."""
+        readable, _, _ = select.select([self.file_descriptor], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.file_descriptor, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, so look at everything
+                paths.update(list_directory(self.directory))
+            elif name:
+                paths.add(os.path.join(self.directory, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        """Stop watching the directory."""
+        os.close(self.file_descriptor)
+
+
+class PollingWatcher:
+    """Reports files of a directory whose size or modification time changed, by listing the directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot = self.__take_snapshot()
+
+    def __take_snapshot(self):
+        snapshot = {}
+        for path in list_directory(self.directory):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        """Sleep timeout seconds and return set of paths of the files that changed meanwhile."""
+        time.sleep(timeout)
+        snapshot = self.__take_snapshot()
+        paths = set(path for path, version in snapshot.items() if self.snapshot.get(path) != version)
+        self.snapshot = snapshot
+        return paths
+
+    def close(self):
+        """Nothing to release."""
+
+
+def create_watcher(directory, polling=False):
+    """Return InotifyWatcher of directory, or PollingWatcher if polling is set or inotify is not available."""
+    if not polling:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as error:
+            logging.info("inotify not available ({}), polling {}".format(error, directory))
+    return PollingWatcher(directory)
+
+
+class Debouncer:
+    """Holds back files that are still being written until their size and modification time stayed the same for
+    settle_seconds."""
+
+    def __init__(self, settle_seconds):
+        self.settle_seconds = settle_seconds
+        # path -> (size, modification time, monotonic time since when the file stayed the same)
+        self.pending = {}
+
+    def touch(self, path):
+        """Start watching path, unless already watched."""
+        if path not in self.pending:
+            self.pending[path] = (None, None, time.monotonic())
+
+    def settled(self):
+        """Return list of (path, size, modification time) of the files that stopped changing and forget them."""
+        now = time.monotonic()
+        ready = []
+        for path, (size, modified_time, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, modified_time):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - since >= self.settle_seconds:
+                del self.pending[path]
+                ready.append((path, size, modified_time))
+        return ready
+
+
+class WatchService:
+    """
+    Runs parsetopspam and storechatlog on every chat export written to directory, with one parse per file.
+
+    Settled files are recorded in the ingest_queue table created by queue_dao_factory, and only as many of them are
+    taken out of it as there are idle workers, so a burst of uploads waits on disk instead of in memory. Files left
+    running by a stopped service are queued again on start. Every worker uses its own streaming platform returned by
+    platform_factory, and exports of the same stream are ingested one at a time, as storechatlog first deletes the
+    chat log of the stream it stores.
+    """
+
+    def __init__(self, directory, queue_dao_factory, platform_factory, workers=WATCH_WORKERS,
+                 settle_seconds=WATCH_SETTLE_SECONDS, poll_interval=WATCH_POLL_INTERVAL, pattern=WATCH_PATTERN,
+                 polling=False):
+        self.directory = directory
+        self.queue_dao_factory = queue_dao_factory
+        self.platform_factory = platform_factory
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.pattern = pattern
+        self.polling = polling
+        self.debouncer = Debouncer(settle_seconds)
+        self.stream_locks = {}
+        self.stream_locks_lock = threading.Lock()
+
+    def stream_lock(self, channel_and_stream_id):
+        """Return the lock held by the worker ingesting an export of the stream."""
+        with self.stream_locks_lock:
+            return self.stream_locks.setdefault(channel_and_stream_id, threading.Lock())
+
+    def is_chat_export(self, path):
+        """Return whether path looks like a chat export and not like a hidden or temporary file."""
+        name = os.path.basename(path)
+        return not name.startswith(".") and fnmatch.fnmatch(name, self.pattern)
+
+    def process(self, path):
+        """Parse file at path once, store its top spam and chat log and record the outcome in the queue. Return the
+        new state of the file."""
+        state, error = "done", None
+        try:
+            twitch = self.platform_factory()
+            comment_dao = CommentDaoJSONImpl(path, twitch.json_decoder)
+            twitch.set_comment_dao(comment_dao)
+            # the file is parsed here, and the commands use the comments kept by comment_dao
+            with self.stream_lock(comment_dao.get_channel_and_stream_id(0)):
+                twitch.parse_top_spam()
+                twitch.store_chat_log()
+        except Exception as exception:
+            logging.exception("failed to ingest {}".format(path))
+            state, error = "failed", str(exception)
+
+        queue_dao = self.queue_dao_factory()
+        queue_dao.start_session()
+        queue_dao.finish(path, state, error)
+        queue_dao.save_changes()
+        queue_dao.close_session()
+        return state
+
+    def run(self, once=False):
+        """Ingest files until interrupted, or with once set until every file present at start has been ingested.
+        Return 0 if every file was ingested, -1 otherwise."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        watcher = create_watcher(self.directory, self.polling)
+        queue_dao = self.queue_dao_factory()
+        queue_dao.start_session()
+        if queue_dao.requeue_running():
+            logging.info("queued again files left running in {}".format(self.directory))
+        queue_dao.save_changes()
+        for path in list_directory(self.directory):
+            if self.is_chat_export(path):
+                self.debouncer.touch(path)
+
+        running = set()
+        failed_count = 0
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                while True:
+                    for path, size, modified_time in self.debouncer.settled():
+                        if queue_dao.enqueue(path, size, modified_time):
+                            logging.info("queued {}".format(path))
+                    queue_dao.save_changes()
+
+                    finished = set(future for future in running if future.done())
+                    failed_count += sum(1 for future in finished if future.result() == "failed")
+                    running -= finished
+                    queue_empty = False
+                    while len(running) < self.workers:
+                        path = queue_dao.claim()
+                        queue_dao.save_changes()
+                        if path is None:
+                            queue_empty = True
+                            break
+                        running.add(executor.submit(self.process, path))
+
+                    if once and queue_empty and not running and not self.debouncer.pending:
+                        break
+                    for path in watcher.wait(self.poll_interval):
+                        if self.is_chat_export(path):
+                            self.debouncer.touch(path)
+        finally:
+            watcher.close()
+            queue_dao.close_session()
+
+        return -1 if failed_count else 0